@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import sys
+import time
+import warnings
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+
+from .synthetic import ADMIN_ID
+from .synthetic import ADMINISTRATOR
+from .synthetic import APPLICATION_ID
+from .synthetic import BLACKLIST_CHANNEL_ID
+from .synthetic import CATEGORY_ID
+from .synthetic import GUILD_ID
+from .synthetic import ROLE_BASE
+from .synthetic import TIMESTAMP
+from .synthetic import SyntheticGuild
+
+### @package bot_runner
+#
+# Runs the bot against the fake server and times one command, one process per command so the memory numbers
+# aren't polluted by earlier runs. Started by 'benchmarks.run' with a scratch directory as working directory,
+# prints the measurements as one json line.
+#
+# The commands are called directly with interactions / contexts built from payloads, the bot doesn't wait for
+# INTERACTION_CREATE events. Everything after that (API calls, rate-limits, gateway events) is the real code path.
+#
+
+SNAPSHOT_FILE = "data/role_info_benchmark.json"
+RSS_SAMPLE_INTERVAL = 0.05
+ADMIN = SyntheticGuild.member_payload(ADMIN_ID, "admin", [ROLE_BASE])
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--command", required=True)
+    parser.add_argument("--mode", choices=("eager", "lazy", "compact"), default="eager")
+    parser.add_argument("--time-scale", type=float, default=0.002)
+    parser.add_argument("--members", type=int, default=30000)
+    parser.add_argument("--modules", type=int, default=78)
+    parser.add_argument("--roles-per-module", type=int, default=25)
+    return parser.parse_args(argv)
+
+
+def write_inputs(guild: SyntheticGuild):
+    """The files the commands read, derived from the same guild the fake server serves"""
+    data = Path("data")
+    data.mkdir(exist_ok=True)
+    mapping = json.dumps(guild.role_mapping())
+    (data / "fix.json").write_text(mapping)
+    (data / "roles_dump-edited.json").write_text(mapping)
+    Path(SNAPSHOT_FILE).write_text(json.dumps(guild.role_backup()))
+
+
+def peak_rss_mb() -> float:
+    # KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class Benchmark:
+    def __init__(self, bot, args: argparse.Namespace):
+        self.bot = bot
+        self.args = args
+        self.interactions = 0
+
+    @property
+    def guild(self):
+        return self.bot.get_guild(GUILD_ID)
+
+    @property
+    def cog(self):
+        return self.bot.get_cog("Misc")
+
+    def interaction(self, name: str):
+        """An interaction of the admin using the slash command 'name' in the blacklist channel"""
+        import discord
+
+        self.interactions += 1
+        data = {
+            # created now, so the token counts as valid (progress updates check for expiry)
+            "id": str(discord.utils.time_snowflake(discord.utils.utcnow()) + self.interactions),
+            "application_id": str(APPLICATION_ID),
+            "type": 2,
+            "token": f"benchmark-{self.interactions}",
+            "version": 1,
+            "guild_id": str(GUILD_ID),
+            "channel_id": str(BLACKLIST_CHANNEL_ID),
+            "channel": {"id": str(BLACKLIST_CHANNEL_ID), "type": 0},
+            "member": {**ADMIN, "permissions": ADMINISTRATOR},
+            "data": {"id": "1", "name": name, "type": 1},
+            "locale": "en-US",
+            "guild_locale": "en-US",
+            "app_permissions": ADMINISTRATOR,
+            "entitlements": [],
+            "attachment_size_limit": 25 * 2**20,
+        }
+        return discord.Interaction(data=data, state=self.bot._connection)
+
+    async def context(self, content: str):
+        """Context of a chat command the admin sent to the blacklist channel"""
+        import discord
+
+        channel = self.guild.get_channel(BLACKLIST_CHANNEL_ID)
+        data = {
+            "id": str(910000000000000000),
+            "channel_id": str(BLACKLIST_CHANNEL_ID),
+            "guild_id": str(GUILD_ID),
+            "author": ADMIN["user"],
+            "member": {k: v for k, v in ADMIN.items() if k != "user"},
+            "content": content,
+            "timestamp": TIMESTAMP,
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+        }
+        message = discord.Message(state=self.bot._connection, channel=channel, data=data)
+        return await self.bot.get_context(message)
+
+    async def wait_for_jobs(self):
+        """merge, checksum and move_to_old_role only queue a background job, wait until the scheduler ran it"""
+        from discord_bot.utils.jobs import DONE
+
+        scheduler = self.bot.jobs
+        while scheduler.running or scheduler.store.queued():
+            await asyncio.sleep(0.02)
+        for job in scheduler.store.jobs(GUILD_ID):
+            if job.state != DONE:
+                raise RuntimeError(f"Job #{job.id} ({job.kind}) is {job.state}: {job.error}")
+
+    async def merge(self):
+        await self.cog.merge.callback(self.cog, await self.context("b!merge"))
+        await self.wait_for_jobs()
+
+    async def sort(self):
+        await self.cog.sort.callback(self.cog, await self.context("b!sort"))
+
+    async def role_backup(self):
+        await self.cog.role_backup.callback(self.cog, self.interaction("role_backup"))
+
+    async def checksum(self):
+        await self.cog.checksum.callback(self.cog, self.interaction("checksum"), snapshot_file=SNAPSHOT_FILE)
+        await self.wait_for_jobs()
+
+    async def move_to_old_role(self):
+        await self.cog.move_to_old_role.callback(
+            self.cog,
+            self.interaction("move_to_old_role"),
+            self.guild.get_channel(CATEGORY_ID),
+            self.guild.get_channel(BLACKLIST_CHANNEL_ID),
+        )
+        await self.wait_for_jobs()
+
+    async def finish_channels(self):
+        await self.cog.commit.callback(
+            self.cog, self.interaction("finish_channels"), self.guild.get_channel(CATEGORY_ID), "WS23"
+        )
+
+    # the methods above, named like the commands
+    COMMANDS = ("merge", "sort", "role_backup", "checksum", "move_to_old_role", "finish_channels")
+
+    async def wait_until_loaded(self):
+        """Ready, cogs loaded and commands synced: on_ready sets the presence as its last step"""
+        while not self.bot.is_ready() or self.guild is None or self.guild.me is None or self.guild.me.activity is None:
+            await asyncio.sleep(0.01)
+
+    async def stats(self) -> dict:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{self.args.port}/_bench/stats") as response:
+                return await response.json()
+
+    async def run(self) -> dict:
+        from discord_bot.utils.members import resident_memory_mb
+
+        started = time.monotonic()
+        bot_task = asyncio.create_task(self.bot.start("benchmark"))
+        loaded = asyncio.create_task(self.wait_until_loaded())
+        await asyncio.wait((bot_task, loaded), timeout=600, return_when=asyncio.FIRST_COMPLETED)
+        if bot_task.done():
+            # raises what stopped the bot, e.g. a payload the fake server is missing
+            loaded.cancel()
+            bot_task.result()
+            raise RuntimeError("The bot stopped before it was ready")
+        if not loaded.done():
+            raise TimeoutError("The bot wasn't ready after 600s")
+        startup = time.monotonic() - started
+        rss_ready = resident_memory_mb()
+
+        samples = [rss_ready]
+
+        async def sample_rss():
+            while True:
+                samples.append(resident_memory_mb())
+                await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+        before = await self.stats()
+        sampler = asyncio.create_task(sample_rss())
+        started = time.monotonic()
+        await getattr(self, self.args.command)()
+        seconds = time.monotonic() - started
+        sampler.cancel()
+        after = await self.stats()
+
+        await self.bot.close()
+        await bot_task
+
+        calls = {
+            route: count - before["calls"].get(route, 0)
+            for route, count in after["calls"].items()
+            if count != before["calls"].get(route, 0)
+        }
+        # everything that isn't answering the interaction counts as work of the command
+        api_calls = sum(
+            c for route, c in calls.items() if not route.startswith(("POST /interactions", "POST /webhooks"))
+        )
+        return {
+            "command": self.args.command,
+            "mode": self.args.mode,
+            "members": self.args.members,
+            "startup_seconds": round(startup, 3),
+            "seconds": round(seconds, 3),
+            "api_calls": api_calls,
+            "ops_per_second": round(api_calls / seconds, 1) if seconds else None,
+            "rate_limited": sum(after["rate_limited"].values()) - sum(before["rate_limited"].values()),
+            "global_rate_limited": after["global_rate_limited"] - before["global_rate_limited"],
+            "rss_ready_mib": round(rss_ready, 1),
+            "rss_peak_mib": round(max(max(samples), peak_rss_mb()), 1),
+            "calls": calls,
+        }
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    guild = SyntheticGuild(members=args.members, modules=args.modules, roles_per_module=args.roles_per_module)
+    write_inputs(guild)
+
+    # the bot reads these on import
+    os.environ["LAZY_MEMBERS"] = str(args.mode == "lazy").lower()
+    os.environ["COMPACT_MEMBERS"] = str(args.mode == "compact").lower()
+    os.environ.pop("METRICS_PORT", None)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+    import discord
+    import yarl
+    from discord.gateway import DiscordWebSocket
+
+    # every request and the gateway go to the fake server
+    discord.http.Route.BASE = f"http://127.0.0.1:{args.port}/api/v10"
+    DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(f"ws://127.0.0.1:{args.port}/gateway")
+    warnings.filterwarnings("ignore", category=ResourceWarning)
+
+    bot_module = importlib.import_module("discord_bot.main")
+    from discord_bot.utils.tutor_store import TutorStore
+
+    TutorStore().add_many((channel_id, m) for channel_id, members in guild.tutors.items() for m in members)
+    # the fake server runs on scaled time, the global limit has to as well
+    bot_module.bot.rate_limits.global_window = args.time_scale
+
+    result = asyncio.run(Benchmark(bot_module.bot, args).run())
+    print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+import asyncio
+import itertools
+import json
+import re
+import time
+from collections import Counter
+from collections import deque
+from typing import Optional
+
+from aiohttp import WSMsgType
+from aiohttp import web
+
+from .synthetic import ADMIN_ID
+from .synthetic import APPLICATION_ID
+from .synthetic import BLACKLIST_CHANNEL_ID
+from .synthetic import BOT_ID
+from .synthetic import GUILD_ID
+from .synthetic import TIMESTAMP
+from .synthetic import SyntheticGuild
+from .synthetic import user_payload
+
+### @package fake_discord
+#
+# Local stand-in for the discord REST API and gateway, serving a SyntheticGuild.
+# Implements the endpoints the bulk commands use, sends the gateway events discord would send for every change
+# and enforces rate-limit buckets with the same headers and 429 responses discord uses.
+#
+# Bucket windows are multiplied by time_scale, so a run that would take hours against discord takes minutes.
+#
+
+API = "/api/v10"
+SNOWFLAKE = re.compile(r"^\d{15,21}$")
+# requests per window (seconds, before scaling) per route, the first matching pattern wins
+ROUTE_LIMITS = [
+    (re.compile(r"^PATCH /guilds/\d+/members/\{id\}$"), (10, 10.0)),
+    (re.compile(r"^(POST|PATCH|DELETE) /guilds/\d+/roles"), (10, 10.0)),
+    (re.compile(r"^(POST /channels/\d+/messages|PATCH /channels/\d+/messages/\{id\})$"), (5, 5.0)),
+    (re.compile(r"^(PUT|GET) /channels/\d+/messages/pins"), (5, 5.0)),
+    (re.compile(r"^GET /guilds/\d+/members$"), (10, 10.0)),
+]
+DEFAULT_LIMIT = (50, 1.0)
+GLOBAL_LIMIT = 50
+# interaction responses and followups don't count against the global limit
+GLOBAL_EXEMPT = ("interactions", "webhooks")
+
+
+def bucket_key(method: str, path: str) -> str:
+    """Route with the first id after guilds/channels kept (discords major parameter), other ids replaced"""
+    parts = path.removeprefix(API).split("/")
+    if parts[1] in GLOBAL_EXEMPT and len(parts) > 3:
+        # the interaction / webhook token
+        parts[3] = "{token}"
+    normalized = [
+        "{id}" if SNOWFLAKE.match(part) and not (i == 2 and parts[1] in ("guilds", "channels")) else part
+        for i, part in enumerate(parts)
+    ]
+    return f"{method} {'/'.join(normalized)}"
+
+
+def json_response(data, status: int = 200, headers: Optional[dict] = None) -> web.Response:
+    """discord.py only parses bodies of type 'application/json' without charset, aiohttp would add one"""
+    return web.Response(body=json.dumps(data).encode(), status=status, headers=headers, content_type="application/json")
+
+
+class FakeDiscord:
+    """
+    The fake API. Call reset() before every bot run, stats() returns the calls since then.
+    """
+
+    def __init__(self, time_scale: float = 0.002, **guild_options):
+        self.time_scale = time_scale
+        self.guild_options = guild_options
+        self.sockets: set[web.WebSocketResponse] = set()
+        self.ids = itertools.count(800000000000000000)
+        self.port: Optional[int] = None
+        self.reset()
+
+    def reset(self, **guild_options):
+        """Fresh guild and counters"""
+        self.guild_options.update(guild_options)
+        self.guild = SyntheticGuild(**self.guild_options)
+        # bucket -> [remaining, reset_at]
+        self.buckets: dict[str, list] = {}
+        self.global_window: deque[float] = deque()
+        self.calls: Counter[str] = Counter()
+        self.rate_limited: Counter[str] = Counter()
+        self.global_rate_limited = 0
+        self.messages: dict[int, list[dict]] = {
+            BLACKLIST_CHANNEL_ID: [self.message(BLACKLIST_CHANNEL_ID, "no blacklist")]
+        }
+        self.pins: dict[int, list[dict]] = {}
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "total": sum(self.calls.values()),
+            "rate_limited": dict(self.rate_limited),
+            "global_rate_limited": self.global_rate_limited,
+        }
+
+    # --- payloads
+
+    def message(self, channel_id: int, content: str, author_id: int = ADMIN_ID) -> dict:
+        author = self.guild.members[author_id]
+        return {
+            "id": str(next(self.ids)),
+            "channel_id": str(channel_id),
+            "guild_id": str(GUILD_ID),
+            "author": author["user"],
+            "member": {k: v for k, v in author.items() if k != "user"},
+            "content": content,
+            "timestamp": TIMESTAMP,
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+
+    # --- gateway
+
+    async def dispatch(self, event: str, data: dict):
+        for ws in list(self.sockets):
+            ws.sequence += 1
+            await ws.send_str(json.dumps({"op": 0, "t": event, "s": ws.sequence, "d": data}))
+
+    async def gateway(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        ws.sequence = 0
+        await ws.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": 41250}}))
+
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            payload = json.loads(msg.data)
+            if payload["op"] == 1:
+                await ws.send_str(json.dumps({"op": 11}))
+            elif payload["op"] == 2:
+                self.sockets.add(ws)
+                await self.dispatch("READY", self.ready_payload())
+                members = [self.guild.members[BOT_ID], self.guild.members[ADMIN_ID]]
+                await self.dispatch("GUILD_CREATE", self.guild.guild_payload(members))
+            elif payload["op"] == 8:
+                await self.send_chunks(payload["d"])
+
+        self.sockets.discard(ws)
+        return ws
+
+    def ready_payload(self) -> dict:
+        return {
+            "v": 10,
+            "user": {**user_payload(BOT_ID, "bench-bot", bot=True), "verified": True, "mfa_enabled": False},
+            "guilds": [{"id": str(GUILD_ID), "unavailable": True}],
+            "session_id": "benchmark",
+            "resume_gateway_url": f"ws://127.0.0.1:{self.port}/gateway",
+            "application": {"id": str(APPLICATION_ID), "flags": 0},
+            "private_channels": [],
+        }
+
+    async def send_chunks(self, request: dict):
+        members = list(self.guild.members.values())
+        chunks = [members[i : i + 1000] for i in range(0, len(members), 1000)]
+        for index, chunk in enumerate(chunks):
+            data = {"guild_id": str(GUILD_ID), "members": chunk, "chunk_index": index, "chunk_count": len(chunks)}
+            if "nonce" in request:
+                data["nonce"] = request["nonce"]
+            await self.dispatch("GUILD_MEMBERS_CHUNK", data)
+
+    # --- rate-limits
+
+    @web.middleware
+    async def rate_limits(self, request: web.Request, handler) -> web.StreamResponse:
+        if not request.path.startswith(API):
+            return await handler(request)
+
+        bucket = bucket_key(request.method, request.path)
+        self.calls[bucket] += 1
+        now = time.monotonic()
+
+        if request.path.split("/")[3] not in GLOBAL_EXEMPT:
+            while self.global_window and self.global_window[0] <= now - self.time_scale:
+                self.global_window.popleft()
+            if len(self.global_window) >= GLOBAL_LIMIT:
+                self.global_rate_limited += 1
+                retry_after = self.global_window[0] + self.time_scale - now
+                return self.too_many_requests(
+                    retry_after, {"X-RateLimit-Global": "true", "X-RateLimit-Scope": "global"}
+                )
+            self.global_window.append(now)
+
+        limit, window = next((rate for pattern, rate in ROUTE_LIMITS if pattern.match(bucket)), DEFAULT_LIMIT)
+        window *= self.time_scale
+        state = self.buckets.setdefault(bucket, [limit, 0.0])
+        if now >= state[1]:
+            state[0], state[1] = limit, now + window
+        headers = {
+            "X-RateLimit-Bucket": str(abs(hash(bucket))),
+            "X-RateLimit-Limit": str(limit),
+            "X-RateLimit-Reset": str(time.time() + state[1] - now),
+            "X-RateLimit-Reset-After": f"{state[1] - now:.3f}",
+        }
+        if state[0] == 0:
+            self.rate_limited[bucket] += 1
+            return self.too_many_requests(state[1] - now, {**headers, "X-RateLimit-Remaining": "0"})
+
+        state[0] -= 1
+        response = await handler(request)
+        response.headers.update({**headers, "X-RateLimit-Remaining": str(state[0])})
+        return response
+
+    @staticmethod
+    def too_many_requests(retry_after: float, headers: dict) -> web.Response:
+        body = {
+            "message": "You are being rate limited.",
+            "retry_after": retry_after,
+            "global": "Global" in str(headers),
+        }
+        return json_response(body, status=429, headers={**headers, "Retry-After": f"{retry_after:.3f}"})
+
+    # --- REST
+
+    @staticmethod
+    async def body(request: web.Request) -> dict:
+        """JSON body of a request, for multipart requests (file uploads) the 'payload_json' part"""
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+            return json.loads(form.get("payload_json", "{}"))
+        return {}
+
+    async def user(self, _request):
+        return json_response(self.ready_payload()["user"])
+
+    async def application(self, _request):
+        return json_response(
+            {
+                "id": str(APPLICATION_ID),
+                "name": "bench-bot",
+                "icon": None,
+                "description": "",
+                "bot_public": True,
+                "bot_require_code_grant": False,
+                "owner": user_payload(ADMIN_ID, "admin"),
+                "verify_key": "0" * 64,
+                "flags": 0,
+                "team": None,
+            }
+        )
+
+    async def commands(self, _request):
+        return json_response([])
+
+    async def get_guild(self, _request):
+        return json_response(self.guild.guild_payload([]))
+
+    async def get_roles(self, _request):
+        return json_response(list(self.guild.roles.values()))
+
+    async def create_role(self, request):
+        body = await self.body(request)
+        role_id = next(self.ids)
+        role = self.guild.role_payload(role_id, body.get("name", "new role"), 1)
+        self.guild.roles[role_id] = role
+        await self.dispatch("GUILD_ROLE_CREATE", {"guild_id": str(GUILD_ID), "role": role})
+        return json_response(role)
+
+    async def edit_role(self, request):
+        role = self.guild.roles.get(int(request.match_info["role_id"]))
+        if role is None:
+            return json_response({"message": "Unknown Role", "code": 10011}, status=404)
+        role.update({k: v for k, v in (await self.body(request)).items() if k in role})
+        await self.dispatch("GUILD_ROLE_UPDATE", {"guild_id": str(GUILD_ID), "role": role})
+        return json_response(role)
+
+    async def move_roles(self, request):
+        for change in await self.body(request):
+            role = self.guild.roles.get(int(change["id"]))
+            if role is not None and role["position"] != change["position"]:
+                role["position"] = change["position"]
+                await self.dispatch("GUILD_ROLE_UPDATE", {"guild_id": str(GUILD_ID), "role": role})
+        return json_response(list(self.guild.roles.values()))
+
+    async def delete_role(self, request):
+        role_id = int(request.match_info["role_id"])
+        if self.guild.roles.pop(role_id, None) is None:
+            return json_response({"message": "Unknown Role", "code": 10011}, status=404)
+        await self.dispatch("GUILD_ROLE_DELETE", {"guild_id": str(GUILD_ID), "role_id": str(role_id)})
+        return web.Response(status=204)
+
+    async def list_members(self, request):
+        limit = int(request.query.get("limit", 1))
+        after = int(request.query.get("after", 0))
+        members = [m for member_id, m in sorted(self.guild.members.items()) if member_id > after][:limit]
+        return json_response(members)
+
+    async def edit_member(self, request):
+        member = self.guild.members.get(int(request.match_info["member_id"]))
+        if member is None:
+            return json_response({"message": "Unknown Member", "code": 10007}, status=404)
+        body = await self.body(request)
+        if "roles" in body:
+            member["roles"] = [str(r) for r in body["roles"] if int(r) in self.guild.roles]
+        await self.dispatch("GUILD_MEMBER_UPDATE", {"guild_id": str(GUILD_ID), **member})
+        return json_response(member)
+
+    async def get_messages(self, request):
+        limit = int(request.query.get("limit", 50))
+        messages = self.messages.get(int(request.match_info["channel_id"]), [])
+        return json_response(list(reversed(messages))[:limit])
+
+    async def send_message(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        message = self.message(channel_id, (await self.body(request)).get("content", ""), author_id=BOT_ID)
+        self.messages.setdefault(channel_id, []).append(message)
+        return json_response(message)
+
+    async def edit_message(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        message_id = request.match_info["message_id"]
+        message = next((m for m in self.messages.get(channel_id, []) if m["id"] == message_id), None)
+        if message is None:
+            return json_response({"message": "Unknown Message", "code": 10008}, status=404)
+        message.update({k: v for k, v in (await self.body(request)).items() if k == "content"})
+        return json_response({**message, "edited_timestamp": TIMESTAMP})
+
+    async def get_pins(self, request):
+        pins = self.pins.get(int(request.match_info["channel_id"]), [])
+        return json_response({"items": [{"pinned_at": TIMESTAMP, "message": m} for m in pins], "has_more": False})
+
+    async def pin(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        message_id = request.match_info["message_id"]
+        message = next((m for m in self.messages.get(channel_id, []) if m["id"] == message_id), None)
+        if message is None:
+            return json_response({"message": "Unknown Message", "code": 10008}, status=404)
+        self.pins.setdefault(channel_id, []).insert(0, {**message, "pinned": True})
+        return web.Response(status=204)
+
+    async def interaction_callback(self, request):
+        body = await self.body(request)
+        return json_response(
+            {
+                "interaction": {
+                    "id": request.match_info["interaction_id"],
+                    "type": 2,
+                    "response_message_loading": body.get("type") == 5,
+                    "response_message_ephemeral": bool(body.get("data", {}).get("flags", 0) & 64),
+                },
+                "resource": {"type": body.get("type", 4)},
+            }
+        )
+
+    async def followup(self, request):
+        message = self.message(BLACKLIST_CHANNEL_ID, (await self.body(request)).get("content", ""), author_id=BOT_ID)
+        return json_response({**message, "webhook_id": str(APPLICATION_ID)})
+
+    async def edit_original_response(self, request):
+        """The deferred response of an interaction, where the progress of slash commands is shown"""
+        content = (await self.body(request)).get("content", "")
+        message = self.message(BLACKLIST_CHANNEL_ID, content, author_id=BOT_ID)
+        return json_response({**message, "webhook_id": str(APPLICATION_ID), "edited_timestamp": TIMESTAMP})
+
+    async def bench_stats(self, _request):
+        return json_response(self.stats())
+
+    async def bench_reset(self, request):
+        self.reset(**{k: int(v) for k, v in request.query.items()})
+        return json_response(self.stats())
+
+    async def not_implemented(self, request):
+        return json_response({"message": f"{request.method} {request.path} isn't faked", "code": 0}, status=404)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.rate_limits], client_max_size=2**30)
+        routes = [
+            ("GET", "/gateway", self.gateway),
+            ("GET", "/users/@me", self.user),
+            ("GET", "/oauth2/applications/@me", self.application),
+            ("PUT", "/applications/{app}/commands", self.commands),
+            ("PUT", "/applications/{app}/guilds/{guild_id}/commands", self.commands),
+            ("GET", "/guilds/{guild_id}", self.get_guild),
+            ("GET", "/guilds/{guild_id}/roles", self.get_roles),
+            ("POST", "/guilds/{guild_id}/roles", self.create_role),
+            ("PATCH", "/guilds/{guild_id}/roles", self.move_roles),
+            ("PATCH", "/guilds/{guild_id}/roles/{role_id}", self.edit_role),
+            ("DELETE", "/guilds/{guild_id}/roles/{role_id}", self.delete_role),
+            ("GET", "/guilds/{guild_id}/members", self.list_members),
+            ("PATCH", "/guilds/{guild_id}/members/{member_id}", self.edit_member),
+            ("GET", "/channels/{channel_id}/messages", self.get_messages),
+            ("POST", "/channels/{channel_id}/messages", self.send_message),
+            ("PATCH", "/channels/{channel_id}/messages/{message_id}", self.edit_message),
+            ("GET", "/channels/{channel_id}/messages/pins", self.get_pins),
+            ("PUT", "/channels/{channel_id}/messages/pins/{message_id}", self.pin),
+            ("POST", "/interactions/{interaction_id}/{token}/callback", self.interaction_callback),
+            ("POST", "/webhooks/{app}/{token}", self.followup),
+            ("PATCH", "/webhooks/{app}/{token}/messages/@original", self.edit_original_response),
+        ]
+        for method, path, handler in routes:
+            app.router.add_route(method, path if path == "/gateway" else API + path, handler)
+        app.router.add_route("*", API + "/{tail:.*}", self.not_implemented)
+        # control of the benchmark, not rate-limited
+        app.router.add_get("/_bench/stats", self.bench_stats)
+        app.router.add_post("/_bench/reset", self.bench_reset)
+        return app
+
+    async def start(self, port: int = 0) -> web.AppRunner:
+        """Serve on 127.0.0.1, a free port is picked if port is 0"""
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return runner
+
+
+async def serve_forever(port: int):
+    fake = FakeDiscord()
+    await fake.start(port)
+    print(f"Fake discord on http://127.0.0.1:{fake.port}{API}, gateway ws://127.0.0.1:{fake.port}/gateway")
+    await asyncio.Event().wait()
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from .bot_runner import Benchmark
+from .fake_discord import FakeDiscord
+
+### @package run
+#
+# Benchmark suite of the bulk commands: 'python -m benchmarks.run'
+#
+# Starts the fake discord server with a synthetic guild, runs every command in a fresh bot process against it
+# and writes the results to 'benchmarks/results/<time>.json'.
+# The run is compared with the newest earlier result of the same size and mode,
+# commands that got slower or use more memory than REGRESSION_THRESHOLD are reported and fail the run.
+#
+
+RESULTS_DIR = Path(__file__).parent / "results"
+REPO_ROOT = Path(__file__).resolve().parent.parent
+# relative change that counts as a regression
+REGRESSION_THRESHOLD = 0.2
+# measurements compared against the baseline, all 'lower is better'
+COMPARED = ("seconds", "api_calls", "rss_peak_mib")
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark the bulk commands")
+    parser.add_argument("--commands", nargs="+", choices=Benchmark.COMMANDS, default=list(Benchmark.COMMANDS))
+    parser.add_argument("--mode", choices=("eager", "lazy", "compact"), default="eager", help="member cache mode")
+    parser.add_argument("--members", type=int, default=30000)
+    parser.add_argument("--modules", type=int, default=78)
+    parser.add_argument("--roles-per-module", type=int, default=25)
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=0.002,
+        help="rate-limit windows are multiplied with this, 1 is as slow as discord",
+    )
+    parser.add_argument("--baseline", type=Path, help="result file to compare with, default: the newest matching one")
+    parser.add_argument("--no-save", action="store_true", help="don't write the results file")
+    return parser.parse_args(argv)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_command(fake: FakeDiscord, args: argparse.Namespace, command: str) -> dict:
+    """Run a single command in a new bot process against a fresh guild"""
+    fake.reset(members=args.members, modules=args.modules, roles_per_module=args.roles_per_module)
+    with tempfile.TemporaryDirectory(prefix=f"bench-{command}-") as workdir:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "benchmarks.bot_runner",
+            f"--port={fake.port}",
+            f"--command={command}",
+            f"--mode={args.mode}",
+            f"--time-scale={args.time_scale}",
+            f"--members={args.members}",
+            f"--modules={args.modules}",
+            f"--roles-per-module={args.roles_per_module}",
+            cwd=workdir,
+            env={"PYTHONPATH": str(REPO_ROOT), "PATH": ""},
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await process.communicate()
+
+    if process.returncode != 0 or not stdout.strip():
+        log = stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(f"'{command}' failed with exit code {process.returncode}:\n" + "\n".join(log[-30:]))
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def find_baseline(meta: dict) -> Optional[Path]:
+    """Newest result file with the same guild size, mode and time scale"""
+    keys = ("members", "modules", "roles_per_module", "mode", "time_scale")
+    for file in sorted(RESULTS_DIR.glob("*.json"), reverse=True):
+        try:
+            other = json.loads(file.read_text())["meta"]
+        except (OSError, ValueError, KeyError):
+            continue
+        if all(other.get(k) == meta[k] for k in keys):
+            return file
+    return None
+
+
+def compare(results: list[dict], baseline: list[dict]) -> list[str]:
+    """!
+    @return a line per measurement that regressed by more than REGRESSION_THRESHOLD
+    """
+    previous = {r["command"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["command"])
+        if old is None:
+            continue
+        for key in COMPARED:
+            if old.get(key) and result[key] > old[key] * (1 + REGRESSION_THRESHOLD):
+                regressions.append(
+                    f"{result['command']}: {key} {old[key]} -> {result[key]} (+{result[key] / old[key] - 1:.0%})"
+                )
+    return regressions
+
+
+def print_table(results: list[dict], baseline: list[dict]):
+    previous = {r["command"]: r for r in baseline}
+    header = f"{'command':<18}{'seconds':>10}{'api calls':>11}{'ops/s':>9}{'429s':>7}{'rss ready':>11}{'rss peak':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        old = previous.get(r["command"])
+        delta = f"  ({r['seconds'] / old['seconds'] - 1:+.0%} time)" if old and old.get("seconds") else ""
+        print(
+            f"{r['command']:<18}{r['seconds']:>10.2f}{r['api_calls']:>11}{r['ops_per_second'] or 0:>9.1f}"
+            f"{r['rate_limited'] + r['global_rate_limited']:>7}{r['rss_ready_mib']:>11.1f}{r['rss_peak_mib']:>10.1f}"
+            f"{delta}"
+        )
+
+
+async def run(args: argparse.Namespace) -> int:
+    fake = FakeDiscord(
+        time_scale=args.time_scale,
+        members=args.members,
+        modules=args.modules,
+        roles_per_module=args.roles_per_module,
+    )
+    runner = await fake.start()
+    meta = {
+        "time": time.time(),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "members": args.members,
+        "modules": args.modules,
+        "roles_per_module": args.roles_per_module,
+        "mode": args.mode,
+        "time_scale": args.time_scale,
+    }
+    baseline_file = args.baseline or find_baseline(meta)
+    baseline = json.loads(baseline_file.read_text())["results"] if baseline_file else []
+
+    results = []
+    try:
+        for command in args.commands:
+            print(f"Running {command} ({args.members} members, {args.mode} members)...", flush=True)
+            results.append(await run_command(fake, args, command))
+    finally:
+        await runner.cleanup()
+
+    print()
+    print_table(results, baseline)
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        file = RESULTS_DIR / f"{meta['time']:.0f}.json"
+        file.write_text(json.dumps({"meta": meta, "results": results}, indent=4))
+        print(f"\nResults written to {file}")
+
+    if baseline_file is None:
+        print("No earlier results to compare with.")
+        return 0
+    regressions = compare(results, baseline)
+    print(f"\nCompared with {baseline_file.name}: " + ("no regressions." if not regressions else "REGRESSIONS"))
+    for line in regressions:
+        print(f"  {line}")
+    return 1 if regressions else 0
+
+
+def main(argv: Optional[list[str]] = None):
+    sys.exit(asyncio.run(run(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    main()
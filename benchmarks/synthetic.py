@@ -0,0 +1,207 @@
+import random
+from datetime import datetime
+from datetime import timezone
+
+### @package synthetic
+#
+# A deterministic synthetic guild shaped like the university server the bot runs on:
+# one category of module channels, every module has a current role, an '(old)' role and a role per past semester.
+# The fake server serves it and the bot runner derives its input files (mappings, role backup) from it.
+#
+
+GUILD_ID = 400000000000000000
+BOT_ID = 500000000000000000
+APPLICATION_ID = BOT_ID
+ADMIN_ID = 500000000000000001
+CATEGORY_ID = 600000000000000000
+BLACKLIST_CHANNEL_ID = 600000000000000001
+# ids of roles, channels and members are counted up from these
+ROLE_BASE = 410000000000000000
+CHANNEL_BASE = 610000000000000000
+MEMBER_BASE = 700000000000000000
+
+TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc).isoformat()
+ADMINISTRATOR = str(1 << 3)
+
+
+def user_payload(user_id: int, name: str, bot: bool = False) -> dict:
+    return {
+        "id": str(user_id),
+        "username": name,
+        "global_name": name,
+        "discriminator": "0",
+        "avatar": None,
+        "bot": bot,
+    }
+
+
+class SyntheticGuild:
+    """
+    Payloads of a guild with 'members' members, 'modules' module channels and roles_per_module roles per module.
+    Every member has roles_per_member random module roles, the same seed gives the same guild.
+    """
+
+    def __init__(
+        self,
+        members: int = 30000,
+        modules: int = 78,
+        roles_per_module: int = 25,
+        roles_per_member: int = 5,
+        seed: int = 42,
+    ):
+        rng = random.Random(seed)
+        self.modules = [f"Mod{i:02}" for i in range(modules)]
+
+        # role id -> payload, position 0 is @everyone
+        self.roles: dict[int, dict] = {GUILD_ID: self.role_payload(GUILD_ID, "@everyone", 0)}
+        self.roles[ROLE_BASE] = self.role_payload(ROLE_BASE, "Admin", 1, permissions=ADMINISTRATOR)
+        self.module_roles: dict[str, list[int]] = {}
+        role_id = ROLE_BASE + 1
+        for module in self.modules:
+            names = [module, f"{module} (old)"] + [f"{module} (S{j:02})" for j in range(roles_per_module - 2)]
+            self.module_roles[module] = []
+            for name in names:
+                self.roles[role_id] = self.role_payload(role_id, name, len(self.roles))
+                self.module_roles[module].append(role_id)
+                role_id += 1
+        # the bot role is on top, so it may edit all others
+        self.roles[role_id] = self.role_payload(role_id, "Bot", len(self.roles), permissions=ADMINISTRATOR)
+        self.bot_role_id = role_id
+
+        # shuffle positions of the module roles, so 'sort' has something to do
+        module_role_ids = [r for ids in self.module_roles.values() for r in ids]
+        positions = list(range(2, 2 + len(module_role_ids)))
+        rng.shuffle(positions)
+        for r, position in zip(module_role_ids, positions):
+            self.roles[r]["position"] = position
+
+        self.channels: dict[int, dict] = {}
+        category_overwrites = [
+            {"id": str(GUILD_ID), "type": 0, "allow": "0", "deny": "1024"},
+            {"id": str(ROLE_BASE), "type": 0, "allow": "1024", "deny": "0"},
+        ]
+        self.channels[CATEGORY_ID] = self.channel_payload(CATEGORY_ID, "Modules", 4, None, category_overwrites)
+        self.channels[BLACKLIST_CHANNEL_ID] = self.channel_payload(
+            BLACKLIST_CHANNEL_ID, "blacklist", 0, CATEGORY_ID, category_overwrites
+        )
+        self.module_channels: list[int] = []
+        for i, module in enumerate(self.modules):
+            channel_id = CHANNEL_BASE + i
+            overwrites = category_overwrites + [
+                {"id": str(self.module_roles[module][0]), "type": 0, "allow": "1024", "deny": "0"}
+            ]
+            self.channels[channel_id] = self.channel_payload(
+                channel_id, module.lower(), 0, CATEGORY_ID, overwrites, position=i + 1
+            )
+            self.module_channels.append(channel_id)
+
+        self.members: dict[int, dict] = {}
+        for i in range(members):
+            member_id = MEMBER_BASE + i
+            self.members[member_id] = self.member_payload(
+                member_id, f"member{i}", sorted(rng.sample(module_role_ids, roles_per_member))
+            )
+        self.members[ADMIN_ID] = self.member_payload(ADMIN_ID, "admin", [ROLE_BASE])
+        self.members[BOT_ID] = self.member_payload(BOT_ID, "bench-bot", [self.bot_role_id], bot=True)
+
+        # channel id -> members that tutored the module
+        self.tutors = {c: rng.sample(list(self.members)[:members], 3) for c in self.module_channels} if members else {}
+
+    @staticmethod
+    def role_payload(role_id: int, name: str, position: int, permissions: str = "0") -> dict:
+        return {
+            "id": str(role_id),
+            "name": name,
+            "color": 0,
+            "hoist": False,
+            "position": position,
+            "permissions": permissions,
+            "managed": False,
+            "mentionable": False,
+            "flags": 0,
+        }
+
+    @staticmethod
+    def channel_payload(
+        channel_id: int, name: str, channel_type: int, parent_id, overwrites: list[dict], position: int = 0
+    ) -> dict:
+        return {
+            "id": str(channel_id),
+            "type": channel_type,
+            "guild_id": str(GUILD_ID),
+            "name": name,
+            "position": position,
+            "parent_id": str(parent_id) if parent_id else None,
+            "permission_overwrites": overwrites,
+            "nsfw": False,
+            "topic": None,
+            "last_message_id": None,
+            "rate_limit_per_user": 0,
+        }
+
+    @staticmethod
+    def member_payload(member_id: int, name: str, roles: list[int], bot: bool = False) -> dict:
+        return {
+            "user": user_payload(member_id, name, bot=bot),
+            "roles": [str(r) for r in roles],
+            "joined_at": TIMESTAMP,
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+            "nick": None,
+        }
+
+    def guild_payload(self, members: list[dict]) -> dict:
+        """Payload of GUILD_CREATE / GET /guilds/{id}"""
+        return {
+            "id": str(GUILD_ID),
+            "name": "Synthetic University",
+            "icon": None,
+            "owner_id": str(ADMIN_ID),
+            "roles": list(self.roles.values()),
+            "emojis": [],
+            "stickers": [],
+            "features": [],
+            "channels": list(self.channels.values()),
+            "members": members,
+            "member_count": len(self.members),
+            "large": True,
+            "threads": [],
+            "voice_states": [],
+            "presences": [],
+            "stage_instances": [],
+            "guild_scheduled_events": [],
+            "soundboard_sounds": [],
+            "unavailable": False,
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "nsfw_level": 0,
+            "premium_tier": 0,
+            "preferred_locale": "en-US",
+            "system_channel_flags": 0,
+            "joined_at": TIMESTAMP,
+        }
+
+    def role_mapping(self) -> dict[str, list[str]]:
+        """Mapping file of 'merge', 'sort' and 'checksum': module key -> names of all roles of the module"""
+        return {module: [self.roles[r]["name"] for r in ids] for module, ids in self.module_roles.items()}
+
+    def role_backup(self) -> dict[str, dict]:
+        """The guild as 'role_info_<time>.json' written by '/role_backup'"""
+        members_by_role: dict[int, list[int]] = {r: [] for r in self.roles}
+        for member_id, member in self.members.items():
+            for r in member["roles"]:
+                members_by_role[int(r)].append(member_id)
+        members_by_role[GUILD_ID] = list(self.members)
+
+        return {
+            str(r): {
+                "role_name": role["name"],
+                "count": len(members_by_role[r]),
+                "members": members_by_role[r],
+                "role_pos": role["position"],
+            }
+            for r, role in self.roles.items()
+        }
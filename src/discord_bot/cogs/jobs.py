@@ -0,0 +1,142 @@
+from typing import Optional
+
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from ..log_setup import logger
+from ..utils.bulk import ProgressReporter
+from ..utils.jobs import QUEUED
+from ..utils.jobs import RUNNING
+from ..utils.jobs import Job
+from ..utils.jobs import JobScheduler
+
+### @package jobs
+#
+# Slash commands to watch and steer the background jobs of a server (see utils/jobs.py).
+#
+
+
+class Jobs(commands.Cog):
+    """
+    Status, pause, resume, cancel and priority of background jobs
+    """
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+        self.scheduler: JobScheduler = bot.jobs
+
+    def describe(self, job: Job, details: bool = False) -> str:
+        """One line per job, with details the parameters, timestamps, the error and the progress of the bulk run"""
+        line = f"**#{job.id}** `{job.kind}` - {job.state}, priority {job.priority}, by <@{job.user_id}>"
+        if job.state == QUEUED:
+            line += f", position {self.scheduler.position(job)} in queue"
+        control = self.scheduler.running.get(job.id)
+        if control is not None and control.result is not None:
+            line += "\n" + ProgressReporter.render(control.result)
+        if not details:
+            return line
+
+        line += f"\nqueued <t:{job.created:.0f}:R>"
+        if job.started:
+            line += f", started <t:{job.started:.0f}:R>"
+        if job.finished:
+            line += f", finished <t:{job.finished:.0f}:R>"
+        if job.interrupted:
+            line += "\nwas interrupted by a restart and resumed from its journal"
+        line += f"\nparameters: `{job.params}`"
+        if job.error:
+            line += f"\nerror: `{job.error}`"
+        return line
+
+    async def get_job(self, interaction: discord.Interaction, job_id: int) -> Optional[Job]:
+        """The job if it belongs to the server of the interaction, answers the interaction if not"""
+        job = self.scheduler.store.get(job_id)
+        if job is None or job.guild_id != interaction.guild_id:
+            await interaction.response.send_message(f"There is no job #{job_id} on this server.", ephemeral=True)
+            return None
+        return job
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="jobs", description="Show the background jobs of this server or one job in detail")
+    @app_commands.guild_only
+    async def jobs(self, interaction: discord.Interaction, job_id: Optional[int] = None):
+        if job_id is not None:
+            job = await self.get_job(interaction, job_id)
+            if job is not None:
+                await interaction.response.send_message(self.describe(job, details=True)[:2000], ephemeral=True)
+            return
+
+        jobs = self.scheduler.store.jobs(interaction.guild_id)
+        if not jobs:
+            await interaction.response.send_message("No jobs on this server yet.", ephemeral=True)
+            return
+
+        text = "\n".join(self.describe(job) for job in jobs)
+        await interaction.response.send_message(text[:2000], ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="job_pause", description="Pause a queued or running job")
+    @app_commands.guild_only
+    async def job_pause(self, interaction: discord.Interaction, job_id: int):
+        """A running job stops sending requests after the ones in flight, it keeps its slot"""
+        job = await self.get_job(interaction, job_id)
+        if job is None:
+            return
+        if not self.scheduler.pause(job):
+            await interaction.response.send_message(f"Job #{job.id} is {job.state}, can't pause it.", ephemeral=True)
+            return
+
+        logger.info(f"{interaction.user} paused job #{job.id}")
+        await interaction.response.send_message(f"Paused job #{job.id}.", ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="job_resume", description="Resume a paused job")
+    @app_commands.guild_only
+    async def job_resume(self, interaction: discord.Interaction, job_id: int):
+        job = await self.get_job(interaction, job_id)
+        if job is None:
+            return
+        if not self.scheduler.resume(job):
+            await interaction.response.send_message(f"Job #{job.id} is {job.state}, not paused.", ephemeral=True)
+            return
+
+        logger.info(f"{interaction.user} resumed job #{job.id}")
+        state = self.scheduler.store.get(job.id).state
+        await interaction.response.send_message(
+            f"Resumed job #{job.id}, it's {'running' if state == RUNNING else 'queued'}.", ephemeral=True
+        )
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="job_cancel", description="Cancel a queued, paused or running job")
+    @app_commands.guild_only
+    async def job_cancel(self, interaction: discord.Interaction, job_id: int):
+        """
+        Members that were already edited by a cancelled job stay edited,
+        run the same command with resume to finish the operation later.
+        """
+        job = await self.get_job(interaction, job_id)
+        if job is None:
+            return
+        if not self.scheduler.cancel(job):
+            await interaction.response.send_message(f"Job #{job.id} is already {job.state}.", ephemeral=True)
+            return
+
+        logger.info(f"{interaction.user} cancelled job #{job.id}")
+        await interaction.response.send_message(f"Cancelling job #{job.id}.", ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="job_priority", description="Change the priority of a job, higher runs first")
+    @app_commands.guild_only
+    async def job_priority(self, interaction: discord.Interaction, job_id: int, priority: int):
+        job = await self.get_job(interaction, job_id)
+        if job is None:
+            return
+
+        self.scheduler.store.set_priority(job.id, priority)
+        self.scheduler.fill_slots()
+        await interaction.response.send_message(f"Job #{job.id} has priority {priority} now.", ephemeral=True)
+
+
+async def setup(bot):
+    await bot.add_cog(Jobs(bot))
@@ -3,10 +3,15 @@ import json
 import re
 import time
 from collections import defaultdict
+from functools import partial
 from pathlib import Path
 from pprint import pprint
+from typing import AsyncIterator
+from typing import Callable
+from typing import Iterable
 from typing import Literal
 from typing import Optional
+from typing import Union
 
 import discord
 from discord import Role
@@ -14,14 +19,49 @@ from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
 
+from ..environment import KEEP_REACTION_BOTS
 from ..log_setup import logger
 from ..utils import utils as ut
+from ..utils.backup_store import BackupStore
+from ..utils.bulk import BulkExecutor
+from ..utils.bulk import BulkJob
+from ..utils.bulk import BulkResult
+from ..utils.bulk import ProgressReporter
+from ..utils.bulk import with_retries
+from ..utils.jobs import Job
+from ..utils.jobs import JobControl
+from ..utils.journal import Journal
+from ..utils.mapping import RoleMapping
+from ..utils.members import AnyMember
+from ..utils.members import ensure_members
+from ..utils.planner import GuildPlan
+from ..utils.planner import MemberRolePlan
+from ..utils.ratelimit import channel_route
+from ..utils.ratelimit import emoji_clear_route
+from ..utils.ratelimit import message_route
+from ..utils.ratelimit import pin_route
+from ..utils.ratelimit import pins_route
+from ..utils.ratelimit import reaction_route
+from ..utils.ratelimit import reaction_users_route
+from ..utils.ratelimit import route_key
+from ..utils.reconcile import plan_repairs
+from ..utils.reconcile import reconcile
+from ..utils.role_index import RoleIndex
+from ..utils.snapshot import RoleSnapshot
+from ..utils.snapshot import collect_snapshot
+from ..utils.snapshot import invert_members
+from ..utils.snapshot import load_snapshot
+from ..utils.snapshot import write_snapshot
+from ..utils.tutor_store import TutorStore
 
 ### @package misc
 #
 # Collection of miscellaneous helpers.
 #
 
+# the single id of a mention line in a tutor message
+ID_PATTERN = re.compile(r"\d+")
+
 
 class Misc(commands.Cog):
     """
@@ -41,10 +81,31 @@ class Misc(commands.Cog):
             callback=self.remove_reactions,
         )
 
+        self.ctx_clear_reactions_fast = app_commands.ContextMenu(
+            name="clear_reactions_fast",
+            callback=self.remove_reactions_fast,
+        )
+
         self.bot.tree.add_command(self.ctx_tutor_message)
         self.bot.tree.add_command(self.ctx_clear_reactions)
+        self.bot.tree.add_command(self.ctx_clear_reactions_fast)
+
+        # channel id -> tutors, persisted in data/tutors.sqlite
+        self.tutors = TutorStore()
 
-        self.tutor_storage: dict[discord.TextChannel, list[int]] = defaultdict(list)
+        # incremental role backups
+        self.backup_store = BackupStore()
+
+        # name -> role lookup for all guilds, updated by the role listeners below
+        self.role_index = RoleIndex()
+
+        # runs member mutations concurrently, paced by the observed rate-limit buckets
+        self.executor = BulkExecutor(self.bot.rate_limits, metrics=self.bot.metrics)
+
+        # the bulk operations run as background jobs, see cogs/jobs.py
+        self.bot.jobs.register("merge", self.run_merge)
+        self.bot.jobs.register("move_to_old_role", self.run_move_to_old_role)
+        self.bot.jobs.register("checksum", self.run_checksum)
 
     # a chat based command
     @commands.command(name="ping", help="Check if Bot available")
@@ -74,6 +135,16 @@ class Misc(commands.Cog):
             ephemeral=ephemeral,
         )
 
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="prefix", description="Set the prefix for chat commands on this server")
+    @app_commands.guild_only
+    async def prefix(self, interaction: discord.Interaction, prefix: Optional[str] = None):
+        """Set a custom prefix for this guild, without prefix the default prefix is used again"""
+        await self.bot.prefixes.set(interaction.guild_id, prefix)
+        await interaction.response.send_message(
+            f"Prefix is now `{prefix or self.bot.prefixes.default_prefix}`", ephemeral=True
+        )
+
     # Example for an event listener
     # This one will be called on each message the bot receives
     @commands.Cog.listener()
@@ -126,7 +197,10 @@ class Misc(commands.Cog):
         await interaction.followup.send("Done", ephemeral=True)
 
     async def remove_reactions(self, interaction: discord.Interaction, message: discord.Message):
-
+        """
+        Remove the reactions of all users from the message, one request per reaction.
+        Reactions of the bots in KEEP_REACTION_BOTS (like the reaction role bot) stay.
+        """
         if not interaction.user.guild_permissions.administrator:
             await interaction.response.send_message("Only admins can do that. Sorry.", ephemeral=True)
             return
@@ -134,27 +208,82 @@ class Misc(commands.Cog):
         resp: discord.InteractionResponse = interaction.response
         await resp.defer(ephemeral=True, thinking=True)
 
-        RR_BOT_ID = 858052858418036736
-        rr_bot = interaction.guild.get_member(RR_BOT_ID)
+        route = reaction_route(message.channel.id)
 
-        if rr_bot is None:
-            await interaction.followup.send(f"cant fetch reaction role bot with id {RR_BOT_ID}")
+        async def removals():
+            for reaction in message.reactions:
+                logger.info(f"Processing Reaction: {reaction}")
+                async for reactor in self.reactors(reaction):
+                    if reactor.id in KEEP_REACTION_BOTS:
+                        logger.info(f"Found kept bot {reactor}. Not removing.")
+                        continue
+                    yield BulkJob(route, partial(reaction.remove, reactor), f"remove {reaction} for {reactor}")
+
+        # the executor removes reactions while the next pages of reactors are read
+        result = await self.executor.run(
+            removals(),
+            label=f"clear_reactions {message.id}",
+            progress=ProgressReporter(interaction, self.bot.rate_limits),
+        )
+
+        logger.info("Done")
+        await interaction.followup.send(f"wiped. {result}")
+
+    async def remove_reactions_fast(self, interaction: discord.Interaction, message: discord.Message):
+        """
+        Clear every emoji of the message with a single request, then react with it again so it's still offered.
+        Bots can only add their own reactions, so the reactions of KEEP_REACTION_BOTS are replaced by one of this bot.
+        Emojis none of the kept bots reacted with are removed for good.
+        """
+        if not interaction.user.guild_permissions.administrator:
+            await interaction.response.send_message("Only admins can do that. Sorry.", ephemeral=True)
             return
 
-        for reaction in message.reactions:
-            reactors = [user async for user in reaction.users()]
-            logger.info(f"Processing Reaction: {reaction}")
+        resp: discord.InteractionResponse = interaction.response
+        await resp.defer(ephemeral=True, thinking=True)
 
-            for reactor in reactors:
-                if reactor.id == rr_bot.id:
-                    logger.info(f"Found RR Bot. Not removing.")
-                    continue
+        # a reaction by a kept bot is the marker for an offered emoji
+        offered = [reaction.emoji for reaction in message.reactions if await self.kept_bot_reacted(reaction)]
+
+        for reaction in message.reactions:
+            logger.info(f"Clearing Reaction: {reaction}")
+            async with self.bot.rate_limits.paced(emoji_clear_route(message.channel.id)):
+                await with_retries(reaction.clear)
 
-                logger.info(f"removing {reaction} for {reactor}")
-                await reaction.remove(reactor)
+        # re-add in the original order, so the emojis stay in place
+        for emoji in offered:
+            async with self.bot.rate_limits.paced(reaction_route(message.channel.id, "PUT")):
+                await with_retries(partial(message.add_reaction, emoji))
 
         logger.info("Done")
-        await interaction.followup.send(f"wiped")
+        await interaction.followup.send(f"wiped {len(message.reactions)} emojis, restored {len(offered)}.")
+
+    async def reactors(self, reaction: discord.Reaction) -> AsyncIterator[Union[discord.User, discord.Member]]:
+        """All users that reacted, read page by page (100 per request) with every request paced"""
+        after = None
+        while True:
+            async with self.bot.rate_limits.paced(reaction_users_route(reaction.message.channel.id)):
+                page = [user async for user in reaction.users(limit=100, after=after)]
+            for user in page:
+                yield user
+            if len(page) < 100:
+                return
+            after = page[-1]
+
+    async def kept_bot_reacted(self, reaction: discord.Reaction) -> bool:
+        """!
+        Whether this bot or one of KEEP_REACTION_BOTS reacted.
+        Reactors are sorted by id, so each kept bot costs one request for the first reactor from its id on,
+        no matter how many users reacted.
+        """
+        if reaction.me:
+            return True
+        for bot_id in KEEP_REACTION_BOTS:
+            async with self.bot.rate_limits.paced(reaction_users_route(reaction.message.channel.id)):
+                first = [user async for user in reaction.users(limit=1, after=discord.Object(id=bot_id - 1))]
+            if first and first[0].id == bot_id:
+                return True
+        return False
 
     async def add_tutor_annotations(self, interaction: discord.Interaction, message: discord.Message):
         """
@@ -179,51 +308,124 @@ class Misc(commands.Cog):
 
         res_dict = await self.parse_message(message)
 
-        for k, v in res_dict.items():
-            self.tutor_storage[k].extend(v)
+        added = self.tutors.add_many((k.id, m) for k, v in res_dict.items() for m in v)
 
         logger.info(f"added message {message.id} to pool.")
 
-        await interaction.followup.send(f"Added message {message.id}.")
+        await interaction.followup.send(f"Added message {message.id}, {added} new tutors.")
 
     @app_commands.checks.has_permissions(administrator=True)
-    @app_commands.command(name="rm_tutor", description="Remove tutor from storage")
+    @app_commands.command(name="add_tutor_messages", description="Add all tutor messages of a channel or thread")
     @app_commands.guild_only
-    async def rm_tutor(self, interaction: discord.Interaction, member: discord.Member):
+    async def add_tutor_messages(
+        self,
+        interaction: discord.Interaction,
+        channel: Union[discord.TextChannel, discord.Thread],
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+    ):
+        """
+        Bulk version of 'add_tutor_annotations': parses every message in the channel or thread
+        (optionally only between the message ids 'after' and 'before') and adds all tutors in one step.
+        Channel ids of all messages are collected first, so each channel is resolved (and at worst fetched) once.
+        """
+        await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+
+        try:
+            after_obj = discord.Object(id=int(after)) if after else None
+            before_obj = discord.Object(id=int(before)) if before else None
+        except ValueError:
+            await interaction.followup.send("'after' and 'before' have to be message ids.", ephemeral=True)
+            return
+
+        parsed: list[dict[int, list[int]]] = []
+        async for message in channel.history(limit=None, after=after_obj, before=before_obj, oldest_first=True):
+            parsed_ids = self.parse_tutor_ids(message.content)
+            if parsed_ids:
+                parsed.append(parsed_ids)
 
+        channel_ids = {c for parsed_ids in parsed for c in parsed_ids}
+        channels = await self.resolve_channels(interaction.guild, channel_ids)
+
+        added = self.tutors.add_many(
+            (c, m) for parsed_ids in parsed for c, members in parsed_ids.items() if c in channels for m in members
+        )
+        logger.info(f"added {len(parsed)} tutor messages from {channel.name} to pool.")
+
+        unresolved = channel_ids - channels.keys()
+        await interaction.followup.send(
+            f"Parsed {len(parsed)} messages, added {added} new tutors for {len(channels)} channels."
+            + (f"\nCouldn't resolve channels: {', '.join(map(str, unresolved))}" if unresolved else ""),
+            ephemeral=True,
+        )
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="rm_tutor", description="Remove tutor from storage")
+    @app_commands.guild_only
+    async def rm_tutor(
+        self, interaction: discord.Interaction, member: discord.Member, channel: Optional[discord.TextChannel] = None
+    ):
+        """Remove the tutor from the pool of one channel or, if no channel is given, of all channels"""
         await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
 
-        v: list[int]
-        found_times = 0
-        for k, v in self.tutor_storage.items():
-            if member.id in v:
-                found_times += 1
-                v.remove(member.id)
-                self.tutor_storage[k] = v
-                logger.info(f"removed tutor {member.id} from '{k}'")
+        found_times = self.tutors.remove(member.id, channel.id if channel else None)
+        logger.info(f"removed tutor {member.id} from {found_times} channels")
 
         await interaction.followup.send(
             f"removed tutor {member.name}, {member.id} from {found_times} channels.", ephemeral=True
         )
 
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="clear_tutors", description="Remove all tutors from storage")
+    @app_commands.guild_only
+    async def clear_tutors(self, interaction: discord.Interaction, category: Optional[discord.CategoryChannel] = None):
+        """The pool survives restarts, clear it for a category (or entirely) once the semester is finished"""
+        await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+
+        removed = self.tutors.clear([c.id for c in category.channels] if category else None)
+        logger.info(f"cleared {removed} tutors from the pool")
+
+        await interaction.followup.send(f"Removed {removed} tutor entries.", ephemeral=True)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="import_tutors", description="Bulk import tutors from a json file")
+    @app_commands.guild_only
+    async def import_tutors(self, interaction: discord.Interaction, file: discord.Attachment):
+        """Import a json file of the format {"<channel-id>": [<member-id>, ...], ...} into the pool"""
+        await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+
+        try:
+            tutors: dict[str, list[int]] = json.loads(await file.read())
+        except json.JSONDecodeError as e:
+            await interaction.followup.send(f"Can't parse {file.filename}: {e}", ephemeral=True)
+            return
+
+        added = self.tutors.add_many((int(c), int(m)) for c, members in tutors.items() for m in members)
+        await interaction.followup.send(f"Imported {added} new tutors for {len(tutors)} channels.", ephemeral=True)
+
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="finish_channels", description="finish channels for semester")
     @app_commands.guild_only
     async def commit(self, interaction: discord.Interaction, category: discord.CategoryChannel, old_semester: str):
+        """
+        Send (and pin) the closure message with the tutors of the old semester to all channels of the category.
+        Channels are processed concurrently, channels that already have the same message pinned are skipped.
+        """
         await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
 
         header = f"**Achtung** hier drüber beginnt das Semester {old_semester}."
 
+        jobs = []
         for channel in category.channels:
 
             new_msg = header
 
-            tutors: list[int] = self.tutor_storage[channel]
+            # unique and in the order they were added, so a rerun produces the same message
+            tutors: list[int] = self.tutors.tutors(channel.id)
 
             if tutors:
                 tutor_header = f"\n\nTutor:innen im {old_semester} waren (evtl. unvollständig):\n"
 
-                tutors = list(set(tutors))
                 logger.info(f"Creating message for: {channel.name}, num of tutors: {len(tutors)}")
                 # mention the tutor manually - this accounts for members that might have left and would resolve to None.
                 # we encode the true id in a "faulty" ping. that preserves the raw data and discord handles the
@@ -232,53 +434,64 @@ class Misc(commands.Cog):
                 new_msg = new_msg + tutor_header + tutor_names
 
             logger.info(new_msg)
-            msg = await channel.send(new_msg)
-            logger.info(f"Sent message to {channel.name}, {channel.id}")
-            await msg.pin()
+            jobs.append(BulkJob(message_route(channel.id), partial(self.send_and_pin, channel, new_msg), channel.name))
 
-        await interaction.followup.send(f"Sent messages...", ephemeral=True)
+        result = await self.executor.run(
+            jobs,
+            label=f"finish_channels '{category.name}'",
+            progress=ProgressReporter(interaction, self.bot.rate_limits),
+        )
 
-    # This method was scratched with GPT4 and heavily modified by myself (honestly would have been faster on my own)
-    # parsing just ins't beautiful, but it came out better than I first envisioned
-    async def parse_message(self, message: discord.Message) -> dict[discord.TextChannel, list[int]]:
+        failed = "".join(f"\n- {name}: {e}" for name, e in result.failed)
+        await interaction.followup.send(f"Sent messages... {result}{failed}", ephemeral=True)
+
+    async def send_and_pin(self, channel: discord.TextChannel, content: str):
+        """
+        Send content to the channel and pin it, unless the same message is already pinned there.
+        Runs as a job paced on the message route, the pins request and the pin are paced on their own routes.
         """
-        Parse a discord message and build a dictionary of channels to members.
 
-        Args:
-            message (discord.Message): The discord message to parse.
+        async def fetch_pins() -> list[discord.Message]:
+            return [pin async for pin in channel.pins()]
 
-        Returns:
-            dict[discord.TextChannel, list[int]: A dictionary where each key is a discord channel,
-            and each value is a list of member-ids mentioned under that channel in the message.
-        """
-        guild = message.guild
+        async with self.bot.rate_limits.paced(pins_route(channel.id)):
+            pins = await with_retries(fetch_pins)
+        if any(pin.author == self.bot.user and pin.content == content for pin in pins):
+            logger.info(f"Message is already pinned in {channel.name}, {channel.id} - skipping")
+            return
 
-        parsed_dict = {}
-        lines = message.content.split("\n")
+        msg = await with_retries(partial(channel.send, content))
+        logger.info(f"Sent message to {channel.name}, {channel.id}")
+        async with self.bot.rate_limits.paced(pin_route(channel.id)):
+            await with_retries(msg.pin)
+
+    # This method was scratched with GPT4 and heavily modified by myself (honestly would have been faster on my own)
+    # parsing just ins't beautiful, but it came out better than I first envisioned
+    @staticmethod
+    def parse_tutor_ids(content: str) -> dict[int, list[int]]:
+        """!
+        Parse the text of a tutor message without any API calls
+
+        @param content message of the format described in add_tutor_annotations
+        @return channel id -> member ids mentioned under that channel, in the order of the message
+        """
+        parsed_dict: dict[int, list[int]] = {}
         current_channel = None
 
-        for line in lines:
+        for line in content.split("\n"):
             # Ignore lines that have more than one mention or no mentions at all
-            matches = re.findall(r"\d+", line)
+            matches = ID_PATTERN.findall(line)
             if len(matches) != 1:
                 continue
 
             # found a valid line: either a channel- or a member-id
-            elm_id = matches[0]
+            elm_id = int(matches[0])
 
             # Check which type of mention it is
             # (mention must be at the start of the line, otherwise we ignore it)
-
-            # Check if the line contains a channel mention
             if line.startswith("<#"):
-                # Extract the channel ID from the mention
-                current_channel = await guild.fetch_channel(elm_id)  # Get the channel object
-
-                if current_channel is None:
-                    logger.warning(f"Can't resolve channel id {elm_id} - continuing without adding that channel.")
-                    continue
-
-                parsed_dict[current_channel] = []  # Initialize the member list for this channel
+                current_channel = elm_id
+                parsed_dict.setdefault(current_channel, [])
 
             # Check if the line contains a user mention (prevent role mentions)
             elif line.startswith("<@") and not line.startswith("<@&"):
@@ -286,11 +499,58 @@ class Misc(commands.Cog):
                     logger.warning(f"Current-channel is None, can't add member {elm_id} to dict. Continuing...")
                     continue
 
-                # add member id
                 parsed_dict[current_channel].append(elm_id)
 
         return parsed_dict
 
+    async def resolve_channels(
+        self, guild: discord.Guild, channel_ids: Iterable[int]
+    ) -> dict[int, discord.abc.GuildChannel]:
+        """!
+        Resolve channel ids from the cache, only the misses are fetched (concurrently)
+
+        @return channel id -> channel, ids that can't be resolved are missing
+        """
+        channels = {}
+        misses = []
+        for channel_id in set(channel_ids):
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                misses.append(channel_id)
+            else:
+                channels[channel_id] = channel
+
+        async def fetch(channel_id: int) -> discord.abc.GuildChannel:
+            async with self.bot.rate_limits.paced(route_key("GET", f"/channels/{channel_id}")):
+                return await guild.fetch_channel(channel_id)
+
+        fetched = await asyncio.gather(*(fetch(c) for c in misses), return_exceptions=True)
+        for channel_id, channel in zip(misses, fetched):
+            if isinstance(channel, Exception):
+                logger.warning(f"Can't resolve channel id {channel_id} - continuing without adding that channel.")
+                continue
+            channels[channel_id] = channel
+
+        if misses:
+            logger.info(f"Resolved {len(channels)} channels, {len(misses)} of them weren't cached")
+        return channels
+
+    async def parse_message(self, message: discord.Message) -> dict[discord.TextChannel, list[int]]:
+        """
+        Parse a discord message and build a dictionary of channels to members.
+
+        Args:
+            message (discord.Message): The discord message to parse.
+
+        Returns:
+            dict[discord.TextChannel, list[int]: A dictionary where each key is a discord channel,
+            and each value is a list of member-ids mentioned under that channel in the message.
+        """
+        parsed_ids = self.parse_tutor_ids(message.content)
+        channels = await self.resolve_channels(message.guild, parsed_ids)
+
+        return {channels[c]: members for c, members in parsed_ids.items() if c in channels}
+
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(
         name="role_backup",
@@ -298,29 +558,35 @@ class Misc(commands.Cog):
         "using category as base.",
     )
     @app_commands.guild_only
-    async def role_backup(self, interaction: discord.Interaction):
-
+    async def role_backup(self, interaction: discord.Interaction, incremental: bool = False):
+        """
+        Backup all roles with their members to 'data/role_info_<time>.json'.
+        With incremental only the changes since the last incremental backup are stored (see BackupStore),
+        which makes it cheap to take a backup before every command.
+        """
         resp: discord.InteractionResponse = interaction.response
         await resp.defer(ephemeral=True, thinking=True)
 
+        await ensure_members(interaction.guild, self.bot.member_cache)
         roles = await interaction.guild.fetch_roles()
 
-        statistics = {}
-        for role in roles:
-            role_info = {
-                "role_name": role.name,
-                "count": len(role.members),
-                "members": [m.id for m in role.members],
-                "role_pos": role.position,
-            }
-            statistics[role.id] = role_info
+        # one pass over all members instead of one per role
+        statistics = collect_snapshot(interaction.guild, roles, self.guild_members(interaction.guild))
+
+        if incremental:
+            entry = await asyncio.to_thread(self.backup_store.add, statistics)
+            await interaction.followup.send(
+                f"Stored {entry['kind']} backup at time `{entry['time']}` ({entry['hash'][:12]}). "
+                f"Pass the time as snapshot to restore it.",
+                ephemeral=True,
+            )
+            return
 
         file_name = f"data/role_info_{time.time()}.json"
         file = Path(file_name)
-        file.touch()
-        text = json.dumps(statistics, indent=4)
-        file.write_text(text)
-        print(file_name)
+        # writing a few MB would block the event loop
+        await asyncio.to_thread(write_snapshot, file, statistics)
+        logger.info(f"Role backup written to {file_name}")
 
         await interaction.followup.send(f"Written to: {file.absolute()}", ephemeral=True, file=discord.File(file))
 
@@ -338,31 +604,58 @@ class Misc(commands.Cog):
         read: bool,
         write: bool,
         delete: bool = False,
+        additional_roles: Optional[str] = None,
     ):
+        """
+        Set the same overwrite for role (and all roles mentioned in additional_roles) on all channels of the category.
+        Channels that already have the desired overwrites are skipped, the others get one edit for all roles.
+        """
         resp: discord.InteractionResponse = interaction.response
         await resp.defer(ephemeral=True, thinking=True)
+
+        roles = [role]
+        for role_id in re.findall(r"\d{15,21}", additional_roles or ""):
+            additional_role = interaction.guild.get_role(int(role_id))
+            if additional_role is None:
+                await interaction.followup.send(f"Can't find role {role_id}, doing nothing.", ephemeral=True)
+                return
+            roles.append(additional_role)
+
+        overwrite: Optional[discord.PermissionOverwrite]
+        # we wanna set permissions explicitly (allow or forbid)
+        if read or (not read and not delete):
+            overwrite = discord.PermissionOverwrite(
+                read_messages=read, view_channel=read, send_messages=write, add_reactions=write
+            )
+        # we wanna delete
+        else:
+            overwrite = None
+
+        jobs = []
         for channel in category.channels:
-            read_messages: Optional[bool]
+            overwrites = dict(channel.overwrites)
+            for r in roles:
+                if overwrite is None:
+                    overwrites.pop(r, None)
+                else:
+                    overwrites[r] = overwrite
 
-            # we wanna set permissions explicitly (allow or forbid)
-            if read or (not read and not delete):
-                overwrite = discord.PermissionOverwrite(
-                    read_messages=read, view_channel=read, send_messages=write, add_reactions=write
-                )
-            # we wanna delete
-            elif not read and delete:
-                overwrite = None
-            # ???
-            else:
-                await interaction.followup.send(
-                    f"The chosen config is not possible in channel {channel.mention}, doing nothing fot it"
-                )
+            if overwrites == channel.overwrites:
+                logger.info(f"Overwrites of {channel.name}, {channel.id} are already set - skipping")
                 continue
 
-            await channel.set_permissions(role, overwrite=overwrite)
-            print(f"Done for {channel.name}, {channel.id}")
+            jobs.append(BulkJob(channel_route(channel.id), partial(channel.edit, overwrites=overwrites), channel.name))
 
-        await interaction.followup.send("Done :)")
+        result = await self.executor.run(
+            jobs,
+            label=f"toggle_role_for_category '{category.name}'",
+            progress=ProgressReporter(interaction, self.bot.rate_limits),
+        )
+
+        failed = "".join(f"\n- {name}: {e}" for name, e in result.failed)
+        await interaction.followup.send(
+            f"Done :) {len(category.channels) - len(jobs)} channels were already set. {result}{failed}"
+        )
 
     @commands.has_permissions(administrator=True)
     @commands.command(name="collect")
@@ -385,140 +678,261 @@ class Misc(commands.Cog):
 
         print(f"written to {data_file.as_posix()}")
 
-    @staticmethod
-    def get_role_by_name(guild: discord.Guild, role_name: str) -> discord.Role | None:
-        res = list(filter(lambda x: x.name == role_name, guild.roles))
+    def get_role_by_name(self, guild: discord.Guild, role_name: str) -> discord.Role | None:
+        """Role with that name if there is exactly one, uses the name index instead of scanning all roles"""
+        return self.role_index.get(guild, role_name)
 
-        if len(res) == 1:
-            return res[0]
+    # keep the role name index current
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        self.role_index.add(role)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        self.role_index.rename(before, after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.role_index.remove(role)
 
-        if len(res) > 1:
-            logger.warning(f"Multiple roles with name '{role_name}' found, returning None")
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild):
+        # sent again after a reconnect with a new session, role events missed in between are lost
+        self.role_index.forget(guild)
 
-        return None
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.role_index.forget(guild)
+        if self.bot.member_cache is not None:
+            self.bot.member_cache.forget(guild)
+
+    def guild_members(self, guild: discord.Guild) -> Iterable[AnyMember]:
+        """Members of the guild, from the compact cache if the bot uses one (see ensure_members)"""
+        if self.bot.member_cache is not None:
+            return self.bot.member_cache.members(guild)
+        return guild.members
+
+    def get_member(self, guild: discord.Guild, member_id: int) -> Optional[AnyMember]:
+        if self.bot.member_cache is not None:
+            return self.bot.member_cache.get_member(guild, member_id)
+        return guild.get_member(member_id)
+
+    def member_getter(self, guild: discord.Guild) -> Callable[[int], Optional[AnyMember]]:
+        """!
+        Member lookup for plans that are applied later: after a reconnect discord.py replaces the guild
+        and all its members, so the guild is looked up again on every call as well
+        """
+
+        def get(member_id: int) -> Optional[AnyMember]:
+            return self.get_member(self.bot.get_guild(guild.id) or guild, member_id)
+
+        return get
+
+    def queued_message(self, job: Job) -> str:
+        position = self.bot.jobs.position(job)
+        where = f"position {position} in the queue" if position is not None else "running"
+        return f"Queued as job #{job.id} ({where}). Progress is posted here, see `/jobs` for the status."
+
+    async def apply_member_plan(
+        self,
+        plan: MemberRolePlan,
+        label: str,
+        journal_name: str,
+        resume: bool = False,
+        channel: Optional[discord.abc.Messageable] = None,
+        control: Optional[JobControl] = None,
+    ) -> BulkResult:
+        """
+        Apply the member changes of a plan through the executor.
+        Every finished edit is checkpointed in a journal, so an interrupted run can be resumed.
+        A resumed run applies the plan saved with the journal instead of the given one,
+        which was planned from a guild the interrupted run already changed.
+        The journal is removed once all edits went through.
+        Progress of long runs is shown in a status message in channel, if one is given.
+        control is the handle of the background job the plan is applied in, if it's run in one.
+        """
+        journal = Journal(journal_name, resume=resume)
+        saved = journal.load_plan() if resume else None
+        if saved is not None:
+            logger.info(f"Resuming the plan saved in {journal.plan_path} ({len(saved)} members)")
+            plan.restore(saved, plan.get_member)
+        else:
+            await asyncio.to_thread(journal.save_plan, plan.changes)
+        progress = ProgressReporter(channel, self.bot.rate_limits) if channel is not None else None
+        result = None
+        try:
+            result = await self.executor.run(plan.jobs(journal), label=label, progress=progress, control=control)
+        finally:
+            journal.close(finished=result is not None and not result.failed)
+
+        return result
 
     @commands.has_permissions(administrator=True)
     @commands.command("merge")
-    async def merge(self, ctx: commands.Context):
+    async def merge(self, ctx: commands.Context, *flags: str):
+        """
+        Flatten the module roles following the mapping in 'data/fix.json'.
+        The merge is queued as a background job (see '/jobs'), pass '--priority=<n>' to run it before other jobs.
+        Pass '--dry-run' to only write the plan and its cost estimate without changing anything, this runs right away.
+        Pass '--resume' to continue an interrupted run, members that were already edited are skipped.
+        In a dry run renamed roles keep their old name, so later lookups may differ slightly from a real run.
+        """
+        params = {"dry_run": "--dry-run" in flags, "resume": "--resume" in flags}
+        if params["dry_run"]:
+            await self.run_merge(ctx.guild, ctx.channel, params)
+            return
+
+        priorities = [flag.removeprefix("--priority=") for flag in flags if flag.startswith("--priority=")]
+        try:
+            priority = int(priorities[-1]) if priorities else 0
+        except ValueError:
+            await ctx.send(f"'{priorities[-1]}' is not a priority, give a number like '--priority=5'.")
+            return
+
+        job = self.bot.jobs.enqueue("merge", ctx.guild, ctx.channel, ctx.author, params, priority)
+        await ctx.send(self.queued_message(job))
+
+    async def run_merge(
+        self,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable,
+        params: dict,
+        control: Optional[JobControl] = None,
+    ):
+        """Runner of the merge job, see merge(). Reports to channel."""
         roles_file = Path("data/roles_dump-edited.json")
         roles_file = Path("data/fix.json")
-        roles_dict: dict[str, list[str]] = json.loads(roles_file.read_text())
+        # compiled once: role name -> module key, current and old role
+        mapping = RoleMapping.load(roles_file)
+        if mapping.ambiguous:
+            await channel.send(f"{len(mapping.ambiguous)} role names are mapped to several keys, see log.")
+
+        await ensure_members(guild, self.bot.member_cache)
+        plan = GuildPlan(
+            "merge",
+            guild,
+            dry_run=params["dry_run"],
+            rate_limits=self.bot.rate_limits,
+            get_member=self.member_getter(guild),
+        )
 
-        # pprint(roles_dict)
+        # ambiguous names can't be resolved, better know about them up front
+        for name, role_ids in self.role_index.duplicates(guild).items():
+            logger.warning(f"Role name '{name}' is used by {len(role_ids)} roles: {role_ids}")
 
-        guild = ctx.guild
-        member_interaction_count = 0
+        # members per role in one pass, roles created by the plan have no members yet
+        holders = invert_members(guild, members=self.guild_members(guild))
+
+        # roles whose members are moved away, they're deleted once they're empty
+        deletion_candidates: list[discord.Role] = []
         for role in guild.roles:
 
-            no_move = False
-            for k, v in roles_dict.items():
-                if role.name in v:
-                    role_list = v
-                    break
-            else:
-                logger.warning(f"cant find role {role.name=}, {role.id} in mapping, skipping role...")
+            entry = mapping.get(role.name)
+            if entry is None:
+                logger.warning("cant find role role.name=%r, %s in mapping, skipping role...", role.name, role.id)
                 continue
 
-            if k.startswith("[NO MOVE]"):
-                no_move = True
-                k = k.replace("[NO MOVE]", "")
-
-            current_role_candidates = list(filter(lambda x: "(" not in x, role_list))
-            if not current_role_candidates:
-                logger.warning(f"There is no candidate role for {role.name}, skipping role")
+            k = entry.key
+            if entry.current_name is None:
+                logger.warning("There is no candidate role for %s, skipping role", role.name)
                 continue
 
-            current_role = self.get_role_by_name(guild, min(current_role_candidates)) or self.get_role_by_name(guild, k)
+            current_role = self.get_role_by_name(guild, entry.current_name) or self.get_role_by_name(guild, k)
             if current_role is None:
-                logger.warning(f"cant find role '{min(current_role_candidates)}' on guild, current_role is None")
+                logger.warning("cant find role '%s' on guild, current_role is None", entry.current_name)
 
-            if len(role_list) == 1:
-                old_role_name = f"{k} (old)"
-                logger.info(f"Only one role for key={k}, creating role with name '{old_role_name}'")
-                old_role = None
-                # TODO discord interaction (create role)
-                old_role = await guild.create_role(name=old_role_name, reason="did not exist yet")
+            # an interrupted run may have created or renamed the old role already
+            old_role_name = f"{k} (old)"
+            existing_old_role = self.get_role_by_name(guild, old_role_name)
+            if entry.create_old and existing_old_role is not None:
+                logger.info("Old role '%s' exists already, not creating it", old_role_name)
+                old_role = existing_old_role
 
-            else:
-                old_role_renamed_candidates = list(filter(lambda x: "(old)" in x, role_list))
-                if len(old_role_renamed_candidates) == 1:
-                    orc = old_role_renamed_candidates[0]
-                    old_role = self.get_role_by_name(guild, orc)
-                    if old_role is None:
-                        logger.warning(f"Cant find '{orc}',, skipping...")
-                        continue
-                    logger.info(f"Found old role {old_role.name}, {role.id}")
-                else:
-                    old_role_candidates = list(filter(lambda x: "(" in x, role_list))
-                    orc = max(old_role_candidates)
-                    old_role = self.get_role_by_name(guild, orc)
+            elif entry.create_old:
+                logger.info("Only one role for key=%s, creating role with name '%s'", k, old_role_name)
+                old_role = await plan.create_role(old_role_name, reason="did not exist yet")
 
+            else:
+                old_role = self.get_role_by_name(guild, entry.old_name) if entry.old_name else None
+                old_role = old_role or existing_old_role
                 if old_role is None:
-                    logger.warning(f"cant find role old role {orc} guild, skipping role...")
+                    logger.warning("cant find role old role %s guild, skipping role...", entry.old_name)
                     continue
 
+                if entry.old_renamed:
+                    logger.info("Found old role %s, %s", old_role.name, role.id)
+
             if current_role == old_role:
-                logger.error(f"Old role cannot be same as current role (skipping): {role=} ")
+                logger.error("Old role cannot be same as current role (skipping): role=%r ", role)
                 continue
 
             if role == current_role and role.name != k:
-                logger.info(f"Renaming role '{role.name}' to '{k}', {role.id=}")
-                # TODO discord interaction (rename role)
-                role = await current_role.edit(name=k)
+                logger.info("Renaming role '%s' to '%s', role.id=%s", role.name, k, role.id)
+                role = await plan.rename_role(current_role, k)
 
             if role == old_role:
-                logger.info(f"{role} is old role, not moving anyone. done with role.")
+                logger.info("%s is old role, not moving anyone. done with role.", role)
                 old_role_name = f"{k} (old)"
                 if old_role.name != old_role_name:
-                    logger.info(f"renaming role old role '{role.name}' to '{old_role_name}'")
-                    old_role = await old_role.edit(name=old_role_name)
+                    logger.info("renaming role old role '%s' to '%s'", role.name, old_role_name)
+                    old_role = await plan.rename_role(old_role, old_role_name)
 
                 continue
 
-            if no_move and role == current_role:
-                logger.info(f"Skipping moving of members for role: '{role.name}', {role.id}")
+            if entry.no_move and role == current_role:
+                logger.info("Skipping moving of members for role: '%s', %s", role.name, role.id)
                 continue
 
-            logger.info(f"Starting to move members from role {role} to {old_role}")
-            for member in role.members:
-                logger.debug(f"handling user {member.name}")
-                if old_role not in member.roles:
-                    # TODO discord interaction (give member old role)
-                    await member.add_roles(old_role)
-                    member_interaction_count += 1
-
-                # TODO discord interaction (remove member from current role)
-                await member.remove_roles(role)
-                member_interaction_count += 1
-                # TODO async sleep
-                await asyncio.sleep(0.4)  # please the goods of rate-limit
-
-                if member_interaction_count % 500 == 0:
-                    await ctx.send(f"{member_interaction_count} / ~24000")
-
-                if member_interaction_count % 200 == 0:
-                    logger.debug(f"{member_interaction_count} / ~24000")
-
-            role = await guild.fetch_role(role.id)
-            if len(role.members) == 0 and role != old_role and role != current_role:
-                # TODO discord interaction (delete role)
-                await role.delete(reason="Good bye...")
+            logger.info("Planning to move members from role %s to %s", role, old_role)
+            for member_id in holders.get(role.id, ()):
+                member = self.get_member(guild, member_id)
+                plan.members.add_role(member, old_role)
+                plan.members.remove_role(member, role)
+
+            if role != current_role:
+                deletion_candidates.append(role)
+
+        # apply all role changes at once, every member is touched at most one time
+        if not plan.dry_run:
+            result = await self.apply_member_plan(
+                plan.members,
+                "merge",
+                journal_name=f"merge_{guild.id}",
+                resume=params["resume"],
+                channel=channel,
+                control=control,
+            )
+            await channel.send(str(result))
+
+        for role in deletion_candidates:
+            if not plan.members.holders(role, self.guild_members(guild)):
+                await plan.delete_role(role, reason="Good bye...")
                 logger.info(f"Role {role=} is now empty, and neither current nor old role. deleting...")
-                # logger.info(f"Role {role.name}, {role.id} is ready for deletion")
             else:
                 logger.warning(f"Role {role=} is smh not empty, not ready for deletion...")
 
-        print(f"Done, total member interactions: {member_interaction_count}")
-        await ctx.send(f"Command finished.")
+        file = plan.write(self.bot.rate_limits)
+        await channel.send(plan.summary(self.bot.rate_limits), file=discord.File(file))
+        await channel.send(f"Command finished.")
 
     @commands.has_permissions(administrator=True)
     @commands.command("sort")
-    async def sort(self, ctx: commands.Context):
-        """needs a list of roles and then attempts to find the '(old)' role for this role and move it below the other role"""
+    async def sort(self, ctx: commands.Context, *flags: str):
+        """
+        needs a list of roles and then attempts to find the '(old)' role for this role and move it below the other role
+        Pass '--dry-run' to only write the plan and its cost estimate.
+        """
         roles_file = Path("data/roles_dump-edited.json")
         roles_dict: dict[str, list[str]] = json.loads(roles_file.read_text())
 
         guild = ctx.guild
+        plan = GuildPlan(
+            "sort",
+            guild,
+            dry_run="--dry-run" in flags,
+            rate_limits=self.bot.rate_limits,
+            get_member=self.member_getter(guild),
+        )
         for key in roles_dict:
             logger.info(f"key: {key}")
             role = self.get_role_by_name(guild, key)
@@ -536,119 +950,216 @@ class Misc(commands.Cog):
                 continue
 
             logger.info(f"moving {role.name}, {role.id} below {role.name}, {role.id}")
-            await old_role.edit(position=role.position - 1)
+            await plan.move_role(old_role, role.position - 1)
 
-            guild = await self.bot.fetch_guild(guild.id)
+            if not plan.dry_run:
+                async with self.bot.rate_limits.paced(route_key("GET", f"/guilds/{guild.id}")):
+                    guild = await self.bot.fetch_guild(guild.id)
 
+        file = plan.write(self.bot.rate_limits)
+        await ctx.send(plan.summary(self.bot.rate_limits), file=discord.File(file))
         logger.info(f"Command done")
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="move_members_a_to_b", description="move /copy members from A to B")
     @app_commands.guild_only
     async def move_members_a_to_b(
-        self, interaction: discord.Interaction, source: discord.Role, target: discord.Role, move: bool = True
+        self,
+        interaction: discord.Interaction,
+        target: discord.Role,
+        source: Optional[discord.Role] = None,
+        source_snapshot_id: Optional[str] = None,
+        snapshot_file: Optional[str] = None,
+        move: bool = True,
+        resume: bool = False,
     ):
+        """
+        Move or copy the members of source to target.
+        Instead of a live role the source can be the id of a role in a role backup, e.g. of a role that was deleted.
+        snapshot_file is the backup file or the time of an incremental backup, the newest backup is used if not given.
+        """
         await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+        await ensure_members(interaction.guild, self.bot.member_cache)
 
-        await self.move_members_to_role(source, target, move=move)
-        await interaction.followup.send("Done :)")
+        if (source is None) == (source_snapshot_id is None):
+            await interaction.followup.send("Give either a source role or a source_snapshot_id.", ephemeral=True)
+            return
 
-    async def move_members_to_role(self, source: Role, target: Role, move: bool = True):
-        members = source.members
+        snapshot = None
+        if source_snapshot_id is not None:
+            snapshot = await asyncio.to_thread(load_snapshot, snapshot_file)
+            if snapshot is None:
+                await interaction.followup.send(f"Can't find role backup '{snapshot_file}'", ephemeral=True)
+                return
 
-        # checksum_file = Path("data/role_info_1759966160.891391.json")
-        #
-        # checksum_dict: dict[str, dict[str, str, int, list[int]]] = json.loads(checksum_file.read_text())
-        #
-        # members = [interaction.guild.get_member(m) for m in checksum_dict["1221948359074381965"]["members"]]
+            source = int(source_snapshot_id)
+            if source not in snapshot:
+                await interaction.followup.send(f"Role {source} is not in {snapshot.name}", ephemeral=True)
+                return
 
-        logger.info(f"processing {len(members)} members")
-        for i, m in enumerate(members):
-            if m not in target.members:
-                await m.add_roles(target)
+        await self.move_members_to_role(
+            source, target, move=move, resume=resume, snapshot=snapshot, channel=interaction.channel
+        )
+        await interaction.followup.send("Done :)")
 
-            if move and m in source.members:
-                await m.remove_roles(source)
+    async def move_members_to_role(
+        self,
+        source: Union[Role, int],
+        target: Role,
+        move: bool = True,
+        plan: Optional[MemberRolePlan] = None,
+        resume: bool = False,
+        snapshot: Optional[RoleSnapshot] = None,
+        channel: Optional[discord.abc.Messageable] = None,
+    ):
+        """
+        Give all members of source the target role (and remove source if move is set).
+        Source is either a role or the id of a role in the snapshot, which may have been deleted since then.
+        If a plan is given the changes are only recorded in it, the caller applies them.
+        Otherwise they're applied right away, resume continues an interrupted run of the same move
+        and the progress is shown in channel.
+        """
+        if isinstance(source, Role):
+            guild = source.guild
+            source_role = source
+            source_name = source.name
+        else:
+            guild = target.guild
+            source_role = guild.get_role(source)
+            source_name = f"{snapshot.names[source]} ({snapshot.name})"
+
+        # membership of both roles as id sets, collected in one pass over the guild
+        holders = invert_members(
+            guild, {target.id} | ({source_role.id} if source_role else set()), self.guild_members(guild)
+        )
+        member_ids = holders[source_role.id] if isinstance(source, Role) else snapshot.members[source]
+
+        apply_now = plan is None
+        if apply_now:
+            plan = MemberRolePlan(guild, get_member=self.member_getter(guild), rate_limits=self.bot.rate_limits)
+
+        logger.info("processing %d members of '%s'", len(member_ids), source_name)
+        left = 0
+        for member_id in member_ids:
+            member = self.get_member(guild, member_id)
+            if member is None:
+                left += 1
+                continue
 
-            if i % 10 == 0:
-                logger.info(f"{i} / {len(members)}")
+            if member_id not in holders[target.id]:
+                plan.add_role(member, target)
+            if move and source_role is not None and member_id in holders[source_role.id]:
+                plan.remove_role(member, source_role)
+
+        if left:
+            logger.info(f"{left} members of '{source_name}' are not on the guild anymore")
+
+        if apply_now:
+            await self.apply_member_plan(
+                plan,
+                f"move '{source_name}' to '{target.name}'",
+                journal_name=f"move_{source if isinstance(source, int) else source.id}_{target.id}",
+                resume=resume,
+                channel=channel,
+            )
 
         logger.info("Done")
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="checksum", description="move /copy members from A to B")
     @app_commands.guild_only
-    async def checksum(self, interaction: discord.Interaction):
-        """guess you'll never need this again. it was for the flattening..."""
-        await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+    async def checksum(
+        self,
+        interaction: discord.Interaction,
+        dry_run: bool = False,
+        snapshot_file: str = "data/role_info_1759966160.891391.json",
+        priority: int = 0,
+    ):
+        """
+        guess you'll never need this again. it was for the flattening...
+        Compares every '<module> (old)' role with the members all roles of that module had in the snapshot
+        and repairs the differences. A report of all differences is sent along.
+        The repair is queued as a background job (see '/jobs'), a dry run runs right away.
+        """
+        params = {"dry_run": dry_run, "snapshot_file": snapshot_file}
+        if dry_run:
+            await interaction.response.send_message("Checking, the report follows in this channel.", ephemeral=True)
+            await self.run_checksum(interaction.guild, interaction.channel, params)
+            return
+
+        job = self.bot.jobs.enqueue(
+            "checksum", interaction.guild, interaction.channel, interaction.user, params, priority
+        )
+        await interaction.response.send_message(self.queued_message(job), ephemeral=True)
 
+    async def run_checksum(
+        self,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable,
+        params: dict,
+        control: Optional[JobControl] = None,
+    ):
+        """Runner of the checksum job, see checksum(). Reports to channel."""
+        snapshot_file = params["snapshot_file"]
         roles_file = Path("data/roles_dump-edited.json")
         # roles_file = Path("data/fix.json")
         roles_dict: dict[str, list[str]] = json.loads(roles_file.read_text())
 
-        checksum_file = Path("data/role_info_1759966160.891391.json")
-
-        checksum_dict: dict[str, dict[str, str, int, list[int]]] = json.loads(checksum_file.read_text())
-
-        aggregated_members: defaultdict[discord.Role, set[int]] = defaultdict(set)
-
-        for module_name, v in roles_dict.items():
-            logger.info(f"checking roles for '{module_name}'")
-
-            module_role = self.get_role_by_name(interaction.guild, f"{module_name} (old)")
-            if module_role is None:
-                logger.warning(f"Cant find role for {module_role}. skipping")
-                continue
-
-            for role_name in v:
-
-                # find role
-                for checksum_role_id, checksum_role_info in checksum_dict.items():
-                    if checksum_role_info["role_name"] == role_name:
-                        break
-                else:
-                    logger.warning(f"No role found for name '{role_name}', continuing...")
-                    continue
-
-                aggregated_members[module_role].update(checksum_role_info["members"])
-
-                checksum_role = interaction.guild.get_role(int(checksum_role_id))
+        snapshot = await asyncio.to_thread(load_snapshot, snapshot_file)
+        if snapshot is None:
+            await channel.send(f"Can't find role backup '{snapshot_file}'")
+            return
 
-                logger.info(
-                    f"Updated {module_role} with {role_name} {'(deleted)' if checksum_role is None else '(existing)'}"
-                )
+        await ensure_members(guild, self.bot.member_cache)
+        plan = GuildPlan(
+            "checksum",
+            guild,
+            dry_run=params["dry_run"],
+            rate_limits=self.bot.rate_limits,
+            get_member=self.member_getter(guild),
+        )
 
-            if len(aggregated_members[module_role]) == len(module_role.members):
-                logger.info(
-                    f"Sanity check for module {module_role.name} complete! (num members: {len(module_role.members)})"
+        members = list(self.guild_members(guild))
+        diffs, missing_modules = reconcile(guild, roles_dict, snapshot, self.get_role_by_name, members)
+        for diff in diffs:
+            if diff.ok:
+                logger.info(f"Sanity check for module {diff.module} complete! (num members: {diff.actual})")
+            else:
+                logger.warning(
+                    f"Missmatch for {diff.module} ({diff.role_id}): expected={diff.expected}, actual={diff.actual}, "
+                    f"to add {len(diff.to_add)}, to remove {len(diff.to_remove)}, left the guild {len(diff.left)}"
                 )
-                continue
 
-            logger.warning(
-                f"Missmatch for {module_role.name} ({module_role.id}): {len(aggregated_members[module_role])=}, {len(module_role.members)=}"
-            )
-
-            module_role_members_set = {m.id for m in module_role.members}
-            should_be_members = aggregated_members[module_role]
-            guild = interaction.guild
-            if len(should_be_members) < len(module_role.members):
-                to_remove = module_role_members_set - should_be_members
-                logger.info(f"To remove {len(to_remove)}: {to_remove}")
-                for m in to_remove:
-                    member = guild.get_member(m)
-                    await member.remove_roles(module_role)
-                logger.info(f"removed overshoot members")
+        plan_repairs(guild, diffs, plan.members, members)
+
+        report_file = Path(f"data/checksum_{time.time()}.json")
+        report = {
+            "snapshot": snapshot.name,
+            "modules_ok": sum(d.ok for d in diffs),
+            "modules_mismatched": sum(not d.ok for d in diffs),
+            "modules_missing": missing_modules,
+            "diffs": [d.to_dict() for d in diffs if not d.ok or d.left or d.unresolved],
+        }
+        report_file.write_text(json.dumps(report, indent=4))
+
+        file = plan.write(self.bot.rate_limits)
+        await channel.send(
+            f"{report['modules_ok']} modules match, {report['modules_mismatched']} don't, "
+            f"{len(missing_modules)} module roles are missing.\n{plan.summary(self.bot.rate_limits)}",
+            files=[discord.File(report_file), discord.File(file)],
+        )
+        if plan.dry_run:
+            return
 
-            else:
-                to_add = should_be_members - module_role_members_set
-                logger.info(f"To add {len(to_add)}: {to_add}")
-                for m in to_add:
-                    member = guild.get_member(m)
-                    await member.add_roles(module_role)
-                logger.info(f"added undershoot members")
+        result = await self.executor.run(
+            plan.members.jobs(),
+            label="checksum",
+            progress=ProgressReporter(channel, self.bot.rate_limits),
+            control=control,
+        )
 
         logger.info(f"Done")
-        await interaction.followup.send("Done :)", ephemeral=True)
+        await channel.send(f"Done :) {result}")
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="move_to_old_role", description="move from role to role (old)")
@@ -658,6 +1169,9 @@ class Misc(commands.Cog):
         interaction: discord.Interaction,
         category: discord.CategoryChannel,
         blacklist_channel: discord.TextChannel,
+        dry_run: bool = False,
+        resume: bool = False,
+        priority: int = 0,
     ):
         """
         Move all members from 'module-role' to 'module-role (old)' for a full category.
@@ -667,16 +1181,46 @@ class Misc(commands.Cog):
         - Channels mentioned will not be searched for module-role and hence no member is moved (useful for the select-roles channel)
         - Roles that might occur in some module channels but shall be excluded from the search for the module-channel role
             - Roles that are configured in the category itself are excluded by default
+
+        The move is queued as a background job (see '/jobs'), jobs with a higher priority run first.
+        With dry_run nothing is changed, the plan and its cost estimate are sent right away instead.
+        With resume an interrupted run is continued, members that were already moved are skipped.
         """
+        params = {
+            "category_id": category.id,
+            "blacklist_channel_id": blacklist_channel.id,
+            "dry_run": dry_run,
+            "resume": resume,
+        }
+        if dry_run:
+            await interaction.response.send_message("Planning, the plan follows in this channel.", ephemeral=True)
+            await self.run_move_to_old_role(interaction.guild, interaction.channel, params)
+            return
 
-        await interaction.response.defer(ephemeral=True, thinking=True)  # okay discord. we got it.
+        job = self.bot.jobs.enqueue(
+            "move_to_old_role", interaction.guild, interaction.channel, interaction.user, params, priority
+        )
+        await interaction.response.send_message(self.queued_message(job), ephemeral=True)
+
+    async def run_move_to_old_role(
+        self,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable,
+        params: dict,
+        control: Optional[JobControl] = None,
+    ):
+        """Runner of the move_to_old_role job, see move_to_old_role(). Reports to channel."""
+        category = guild.get_channel(params["category_id"])
+        blacklist_channel = guild.get_channel(params["blacklist_channel_id"])
+        if category is None or blacklist_channel is None:
+            await channel.send("The category or the blacklist channel doesn't exist anymore.")
+            return
 
         # do blacklist processing
         maybe_blacklist_message = [message async for message in blacklist_channel.history(limit=1)]
         if len(maybe_blacklist_message) != 1:
-            await interaction.followup.send(
+            await channel.send(
                 f"There is not exactly ONE blacklist message in channel {blacklist_channel.mention}.\nIf you don't want a blacklist, send a message containing no mentions.",
-                ephemeral=True,
             )
             return
 
@@ -685,26 +1229,49 @@ class Misc(commands.Cog):
         blacklist_channels = blacklist_message.channel_mentions
         blacklist_channels.append(blacklist_channel)
 
-        # walk channels and move members
-        for channel in category.channels:
+        await ensure_members(guild, self.bot.member_cache)
+
+        # walk channels and collect the member moves, so members of several channels are edited only once
+        plan = GuildPlan(
+            "move_to_old_role",
+            guild,
+            dry_run=params["dry_run"],
+            rate_limits=self.bot.rate_limits,
+            get_member=self.member_getter(guild),
+        )
+        for module_channel in category.channels:
 
-            if channel in blacklist_channels:
-                logger.info(f"Channel {channel.mention} is on blacklist - skipping")
+            if module_channel in blacklist_channels:
+                logger.info(f"Channel {module_channel.mention} is on blacklist - skipping")
                 continue
 
-            logger.info(f"Processing channel {channel.name}")
-            channel_role = self.get_channel_role(channel, category, blacklist_roles)
+            logger.info(f"Processing channel {module_channel.name}")
+            channel_role = self.get_channel_role(module_channel, category, blacklist_roles)
 
             old_role_name = f"{channel_role.name} (old)"
-            old_role = self.get_role_by_name(interaction.guild, old_role_name)
+            old_role = self.get_role_by_name(guild, old_role_name)
 
             if old_role is None:
                 logger.warning(f"Created '{old_role_name}' because it didn't exist yet.")
-                old_role = await interaction.guild.create_role(name=old_role_name, reason="did not exist yet")
+                old_role = await plan.create_role(old_role_name, reason="did not exist yet")
+
+            await self.move_members_to_role(channel_role, old_role, plan=plan.members)
 
-            await self.move_members_to_role(channel_role, old_role)
+        file = plan.write(self.bot.rate_limits)
+        await channel.send(plan.summary(self.bot.rate_limits), file=discord.File(file))
+        if plan.dry_run:
+            return
+
+        await self.apply_member_plan(
+            plan.members,
+            f"move_to_old_role '{category.name}'",
+            journal_name=f"move_to_old_role_{category.id}",
+            resume=params["resume"],
+            channel=channel,
+            control=control,
+        )
 
-        await interaction.followup.send(f"Done. For all channels :)", ephemeral=True)
+        await channel.send(f"Done. For all channels :)")
         logger.info(f"Done :)")
 
 
@@ -97,3 +97,15 @@ PREFIX = load_env("PREFIX", "b!", config_dict=cfg_dict)
 OWNER_NAME = load_env("OWNER_NAME", "unknown", config_dict=cfg_dict)  # owner name with tag e.g. pi#3141
 OWNER_ID = int(load_env("OWNER_ID", "100000000000000000", config_dict=cfg_dict))  # discord id of the owner
 ACTIVITY_NAME = load_env("ACTIVITY_NAME", f"{PREFIX}help", config_dict=cfg_dict)  # activity bot plays
+# comma separated ids of bots whose reactions survive 'clear_reactions' (e.g. the reaction role bot)
+KEEP_REACTION_BOTS = [
+    int(bot_id) for bot_id in load_env("KEEP_REACTION_BOTS", "858052858418036736", config_dict=cfg_dict).split(",")
+]
+# don't load the member lists of all guilds at startup, commands load them when they need them (true / false)
+LAZY_MEMBERS = load_env("LAZY_MEMBERS", "false", config_dict=cfg_dict).lower() in ("true", "1", "yes")
+# keep only the role ids of members instead of full member objects, implies LAZY_MEMBERS (true / false)
+COMPACT_MEMBERS = load_env("COMPACT_MEMBERS", "false", config_dict=cfg_dict).lower() in ("true", "1", "yes")
+# serve metrics in the Prometheus format on http://127.0.0.1:<port>/metrics, disabled if empty
+METRICS_PORT = int(load_env("METRICS_PORT", "0", config_dict=cfg_dict) or 0)
+# number of background jobs (merge, move_to_old_role, checksum) running at the same time, never more than one per server
+JOB_CONCURRENCY = int(load_env("JOB_CONCURRENCY", "2", config_dict=cfg_dict) or 2)
@@ -1,30 +1,90 @@
+import atexit
 import logging
 import os
+import queue
+from collections import defaultdict
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from logging.handlers import RotatingFileHandler
 
 ### @package log_setup
 #
 # Setup of logging
 #
+# Loggers only put records into a queue, a background thread formats them and writes them to the console and
+# the (rotating) log file, so logging never blocks the event loop with disk writes.
+# The logs of discord.py go through the same queue.
+#
+# In hot loops use %-style arguments ('logger.info("moved %s", member_id)'), the message is only built
+# if the record passes the level, and log_sampled() to log only every n-th iteration.
+#
 
 # path for databases or config files
 if not os.path.exists("data/"):
     os.mkdir("data/")
 
+# rotate 'data/events.log' at this size, keeping this many old files (events.log.1, ...)
+LOG_MAX_BYTES = 10 * 2**20
+LOG_BACKUP_COUNT = 5
+
 # set logging format
 formatter = logging.Formatter("[{asctime}] [{levelname}] [{module}.{funcName}] {message}", style="{")
 
 # logger for writing to file
-file_logger = logging.FileHandler("data/events.log")
+file_logger = RotatingFileHandler("data/events.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
 file_logger.setFormatter(formatter)
 
 # logger for console prints
 console_logger = logging.StreamHandler()
 console_logger.setFormatter(formatter)
 
+
+class LocalQueueHandler(QueueHandler):
+    """
+    QueueHandler for a queue in the same process.
+    The default one formats every record before enqueuing it (to make it picklable),
+    this leaves formatting to the listener thread as well.
+    Arguments are formatted a moment later, so don't pass objects that are modified right after logging.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler = LocalQueueHandler(log_queue)
+
+# the only place that does IO, in its own thread
+listener = QueueListener(log_queue, file_logger, console_logger, respect_handler_level=True)
+listener.start()
+# flush what's left in the queue on shutdown
+atexit.register(listener.stop)
+
 # get new logger
 logger = logging.getLogger("my-bot")
 logger.setLevel(logging.INFO)
 
 # register loggers
-logger.addHandler(file_logger)
-logger.addHandler(console_logger)  # discord handles this logger
+logger.addHandler(queue_handler)
+
+# discord.py logs to the same file, 'bot.run' is started without its own log handler
+discord_logger = logging.getLogger("discord")
+discord_logger.setLevel(logging.INFO)
+discord_logger.addHandler(queue_handler)
+
+_sample_counts: dict[str, int] = defaultdict(int)
+
+
+def log_sampled(key: str, every: int, msg: str, *args, level: int = logging.INFO):
+    """!
+    Log only the first and then every n-th call with the same key, for loops over thousands of items
+
+    @param key identifies the loop, e.g. the command name
+    @param every log one of this many calls
+    @param msg %-style message, formatted only if the call is logged
+    """
+    count = _sample_counts[key]
+    _sample_counts[key] = count + 1
+    if count % every == 0:
+        # the record should name the caller, not this function
+        logger.log(level, msg, *args, stacklevel=2)
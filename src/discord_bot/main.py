@@ -1,24 +1,54 @@
 #!/bin/env python
 
+import asyncio
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Optional
+
 import discord
+from discord import app_commands
 from discord.ext import commands
 from discord.ext.commands import Context
 
 from .environment import ACTIVITY_NAME
+from .environment import COMPACT_MEMBERS
+from .environment import JOB_CONCURRENCY
+from .environment import LAZY_MEMBERS
+from .environment import METRICS_PORT
 from .environment import PREFIX
 from .environment import TOKEN
 
 # setup of logging and env-vars
 # logging must be initialized before environment, to enable logging in environment
-from .log_setup import console_logger
 from .log_setup import formatter
 from .log_setup import logger
+from .utils.jobs import JobScheduler
+from .utils.members import CompactMemberCache
+from .utils.members import format_memory
+from .utils.metrics import Metrics
+from .utils.prefixes import PrefixStore
+from .utils.ratelimit import RateLimitObserver
 
 """
 This bot is based on a template by nonchris
 https://github.com/nonchris/discord-bot
 """
 
+# hash of the last command tree pushed to each guild, guilds with an unchanged tree aren't synced again
+COMMAND_HASHES_FILE = Path("data/command_hashes.json")
+# number of guilds synced at the same time
+SYNC_CONCURRENCY = 4
+
+
+def lazy_intents() -> discord.Intents:
+    """Only what the bot uses: the members intent is needed for 'guild.chunk()', message content for chat commands"""
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    return intents
+
 
 class MyBot(commands.Bot):
     """!
@@ -32,9 +62,48 @@ class MyBot(commands.Bot):
 
     """
 
-    def __init__(self, intents: discord.Intents = discord.Intents.all()):
-        """Initialize bot with intents and init super"""
-        super().__init__(command_prefix=self._prefix_callable, intents=intents)
+    def __init__(
+        self,
+        intents: discord.Intents = discord.Intents.all(),
+        lazy_members: bool = False,
+        compact_members: bool = False,
+    ):
+        """!
+        Initialize bot with intents and init super
+
+        @param lazy_members don't chunk the guilds at startup, commands that need members call 'ensure_members'
+        @param compact_members don't cache member objects, keep only their role ids in a CompactMemberCache
+        """
+        self.started = time.monotonic()
+        self.lazy_members = lazy_members or compact_members
+        # None if discord.py caches the members itself
+        self.member_cache: Optional[CompactMemberCache] = CompactMemberCache() if compact_members else None
+        # watches the rate-limit headers of all requests, used to pace bulk operations
+        self.rate_limits = RateLimitObserver()
+        # command latency, requests per route, rate-limit hits and bulk throughput, see METRICS_PORT
+        self.metrics = Metrics()
+        self.metrics.attach(self.rate_limits.trace_config)
+        self.metrics.add_gauge(
+            "discord_gateway_latency_seconds", "Heartbeat latency of the gateway", lambda: self.latency
+        )
+        super().__init__(
+            command_prefix=self._prefix_callable,
+            intents=intents,
+            http_trace=self.rate_limits.trace_config,
+            chunk_guilds_at_startup=not self.lazy_members,
+            member_cache_flags=discord.MemberCacheFlags.none() if compact_members else None,
+        )
+        if self.member_cache is not None:
+            self.member_cache.install(self._connection)
+        self.command_hashes: dict[str, str] = self.__load_command_hashes()
+        # custom prefixes per guild, stored in data/prefixes.json
+        self.prefixes = PrefixStore(PREFIX)
+        # long-running admin operations queued as background jobs, stored in data/jobs.sqlite
+        self.jobs = JobScheduler(self, concurrency=JOB_CONCURRENCY)
+        self.metrics.add_gauge("jobs_running", "Background jobs running", lambda: len(self.jobs.running))
+        self.metrics.add_gauge(
+            "jobs_queued", "Background jobs waiting for a slot", lambda: len(self.jobs.store.queued())
+        )
 
     async def setup_hook(self):
         """!
@@ -42,6 +111,12 @@ class MyBot(commands.Bot):
         This performs an asynchronous setup after the bot is logged in,
         but before it has connected to the Websocket (quoted from d.py docs)
         """
+        # the mention prefixes need our user id, which is known after login
+        self.prefixes.set_user(self.user.id)
+
+        self.tree.on_error = self.__on_app_command_error
+        if METRICS_PORT:
+            await self.metrics.serve(METRICS_PORT)
 
     # login message
     async def on_ready(self):
@@ -55,6 +130,7 @@ class MyBot(commands.Bot):
         bot.remove_command("help")  # unload default help message
         # TODO: Register your extensions here
         initial_extensions = [
+            ".cogs.jobs",
             ".cogs.misc",
             ".cogs.help",
         ]
@@ -62,74 +138,133 @@ class MyBot(commands.Bot):
         for extension in initial_extensions:
             await bot.load_extension(extension, package=__package__)
 
-        # Walk all guilds, report connected guilds and push commands to guilds
+        # the cogs registered their job runners, interrupted jobs continue now
+        self.jobs.start()
+
+        # Walk all guilds, report connected guilds
         member_count = 0
         guild_string = ""
         for g in bot.guilds:
             guild_string += f"{g.name} - {g.id} - Members: {g.member_count}\n"
             member_count += g.member_count
 
-            # PUSHING Commands
-            # copy all commands to all guilds one after an other
-            # this is inefficient, but a fast way to push new commands to all guilds
-            await self.__sync_commands_to_guild(g)
+        # PUSHING Commands
+        # copy all commands to all guilds, only guilds whose command tree changed are synced
+        await self.__sync_commands_to_guilds(bot.guilds)
 
         logger.info(
             f"\n---\n"
             f"Bot '{bot.user.name}' has connected, active on {len(self.guilds)} guilds:\n{guild_string}"
             f"---\n"
         )
+        # compare LAZY_MEMBERS=true and false with these numbers to choose the mode for a deployment
+        logger.info(
+            f"Startup ({'compact' if self.member_cache else 'lazy' if self.lazy_members else 'eager'} members) took {time.monotonic() - self.started:.1f}s, "
+            f"{len(self.users)} users cached, memory: {format_memory()}"
+        )
 
         # set the status of the bot
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=ACTIVITY_NAME))
 
+    async def close(self):
+        """!
+        Stop the background jobs before disconnecting, running jobs are resumed after the next start
+        """
+        await self.jobs.stop()
+        await super().close()
+
     async def on_guild_join(self, guild: discord.Guild):
         """!
         Function called when bot is invited onto a new server
         """
         logger.info(f"Bot joined guild: '{guild.name}'")
+        # a guild that removed the bot and invites it again lost its commands, the stored hash doesn't know that
+        self.command_hashes.pop(str(guild.id), None)
         # try to push slash commands to new server
-        await self.__sync_commands_to_guild(guild)
+        await self.__sync_commands_to_guilds([guild])
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        self.metrics.observe_command_since(command.qualified_name, interaction.created_at)
+
+    async def __on_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        """Count the failed command, then log it like the default handler of the command tree"""
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        self.metrics.observe_command_since(name, interaction.created_at, failed=True)
+        await app_commands.CommandTree.on_error(self.tree, interaction, error)
+
+    async def on_command_completion(self, ctx: Context):
+        self.metrics.observe_command_since(ctx.command.qualified_name, ctx.message.created_at)
+
+    async def on_command_error(self, ctx: Context, error: commands.CommandError, /):
+        if ctx.command is not None:
+            self.metrics.observe_command_since(ctx.command.qualified_name, ctx.message.created_at, failed=True)
+        await super().on_command_error(ctx, error)
+
+    @staticmethod
+    def __load_command_hashes() -> dict[str, str]:
+        if not COMMAND_HASHES_FILE.exists():
+            return {}
+        try:
+            return json.loads(COMMAND_HASHES_FILE.read_text())
+        except json.JSONDecodeError:
+            logger.warning(f"Can't read '{COMMAND_HASHES_FILE}', syncing commands to all guilds")
+            return {}
+
+    def __command_tree_hash(self, guild: discord.Guild) -> str:
+        """Hash of the serialized commands of a guild, the same payload discord gets on sync"""
+        payload = [command.to_dict(self.tree) for command in self.tree.get_commands(guild=guild)]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
 
     async def __sync_commands_to_guild(self, guild: discord.Guild):
         """!
         Function to push all commands to a guild
-        Doing this for all guilds on startup is is inefficient, but a fast way to push new commands to all guilds
+        The push is skipped if the guild got the same command tree before.
+        Delete 'data/command_hashes.json' to force a push to all guilds.
         """
+        self.tree.copy_global_to(guild=guild)
+        tree_hash = self.__command_tree_hash(guild)
+        if self.command_hashes.get(str(guild.id)) == tree_hash:
+            logger.info(f"Commands of {guild.name} are up to date")
+            return
+
         try:
-            self.tree.copy_global_to(guild=guild)
-            await bot.tree.sync(guild=guild)
+            await self.tree.sync(guild=guild)
+            self.command_hashes[str(guild.id)] = tree_hash
             logger.info(f"Pushed commands to: {guild.name}")
         except discord.errors.Forbidden:
             logger.warning(f"Don't have the permissions to push slash commands to: '{guild.name}'")
 
+    async def __sync_commands_to_guilds(self, guilds: list[discord.Guild]):
+        """Push commands to all guilds concurrently, at most SYNC_CONCURRENCY at a time"""
+        semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+        async def sync(guild: discord.Guild):
+            async with semaphore:
+                await self.__sync_commands_to_guild(guild)
+
+        await asyncio.gather(*(sync(g) for g in guilds))
+        COMMAND_HASHES_FILE.write_text(json.dumps(self.command_hashes, indent=4))
+
     # inspired by https://github.com/Rapptz/RoboDanny
     # This function will be evaluated for each message
-    # you can define specific behaviours for different messages or guilds, like custom prefixes for a guild etc...
+    # the prefix tuples are precomputed per guild (see PrefixStore), so this is a single dict lookup
     @staticmethod
-    def _prefix_callable(_bot, msg: discord.Message):
+    def _prefix_callable(_bot: "MyBot", msg: discord.Message):
         """!
         Function that evaluates whether a (chat)-command was triggered by a message
         Inspired by https://github.com/Rapptz/RoboDanny
         """
-        user_id = _bot.user.id
-        # way discord expresses mentions
-        # mobile and desktop have a different syntax how mentions are sent, so we handle both
-        prefixes = [f"<@!{user_id}> ", f"<@{user_id}> "]
-        if msg.guild is None:  # we're in DMs, using default prefix
-            prefixes.append(PREFIX)
-            return prefixes
-
-        # TODO: This would be the place to add guild specific custom prefixes
-        # you've got the current message hence the guild-id which is perfect to store and load prefixes for a guild
-        # just append them to base and only append the default prefix if there is no custom prefix for that guild
-
-        prefixes.append(PREFIX)
-        return prefixes
+        # DMs (guild is None) use the default prefix
+        return _bot.prefixes.get(msg.guild.id if msg.guild is not None else None)
 
 
 # Create instance of our bot
-bot = MyBot()
+if COMPACT_MEMBERS:
+    bot = MyBot(intents=lazy_intents(), compact_members=True)
+elif LAZY_MEMBERS:
+    bot = MyBot(intents=lazy_intents(), lazy_members=True)
+else:
+    bot = MyBot()
 
 
 @bot.command("r")
@@ -140,9 +275,12 @@ async def reload(ctx: Context):
 
 
 # Entrypoint function called from __init__.py
-def start_bot(token=None, log_handler=console_logger, log_formatter=formatter, root_logger=False):
-    """Start the bot, takes token, uses token from env if none is given"""
-    # TODO: Logs from d.py don't appear in the log file (note for the dev, not the template user)
+def start_bot(token=None, log_handler=None, log_formatter=formatter, root_logger=False):
+    """!
+    Start the bot, takes token, uses token from env if none is given
+    Logs of d.py already go to console and log file through the queue of log_setup,
+    only pass a log_handler to get them somewhere else in addition.
+    """
     if token is not None:
         bot.run(token, log_handler=log_handler, log_formatter=log_formatter, root_logger=root_logger)
     if TOKEN is not None:
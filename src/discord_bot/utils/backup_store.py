@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from ..log_setup import logger
+
+### @package backup_store
+#
+# Incremental role backups. Instead of a full 'role_info_<time>.json' for every backup, most backups are stored
+# as delta against the previous one. Every FULL_BACKUP_EVERY-th backup is a full snapshot,
+# so restoring any point in time needs at most that many deltas.
+#
+# Files are content-addressed ('<sha256>.json'), identical snapshots or deltas are only stored once.
+# 'index.json' lists all backups in order: {"time": float, "kind": "full" | "delta", "hash": str}
+#
+
+BACKUP_DIR = Path("data/role_backups")
+FULL_BACKUP_EVERY = 10
+
+
+def _members_as_sets(snapshot: dict) -> dict[str, dict]:
+    """Normalize a snapshot to str keys and member sets, so deltas can be computed and applied"""
+    return {
+        str(role_id): {"role_name": info["role_name"], "role_pos": info["role_pos"], "members": set(info["members"])}
+        for role_id, info in snapshot.items()
+    }
+
+
+def compute_delta(old: dict[str, dict], new: dict[str, dict]) -> dict:
+    """!
+    Difference between two normalized snapshots
+
+    @return roles that were added or changed name/position, removed roles and added/removed member ids per role
+    """
+    delta = {"roles": {}, "removed_roles": [], "members_added": {}, "members_removed": {}}
+    for role_id, info in new.items():
+        before = old.get(role_id)
+        if before is None or before["role_name"] != info["role_name"] or before["role_pos"] != info["role_pos"]:
+            delta["roles"][role_id] = {"role_name": info["role_name"], "role_pos": info["role_pos"]}
+
+        members_before = before["members"] if before else set()
+        if info["members"] - members_before:
+            delta["members_added"][role_id] = sorted(info["members"] - members_before)
+        if members_before - info["members"]:
+            delta["members_removed"][role_id] = sorted(members_before - info["members"])
+
+    delta["removed_roles"] = sorted(role_id for role_id in old if role_id not in new)
+    return delta
+
+
+def apply_delta(snapshot: dict[str, dict], delta: dict) -> dict[str, dict]:
+    """Apply a delta to a normalized snapshot, returns a new snapshot"""
+    result = {role_id: {**info, "members": set(info["members"])} for role_id, info in snapshot.items()}
+    for role_id in delta["removed_roles"]:
+        result.pop(role_id, None)
+    for role_id, meta in delta["roles"].items():
+        result.setdefault(role_id, {"members": set()}).update(meta)
+    for role_id, members in delta["members_added"].items():
+        result[role_id]["members"].update(members)
+    for role_id, members in delta["members_removed"].items():
+        result[role_id]["members"].difference_update(members)
+
+    return result
+
+
+class BackupStore:
+    """
+    Chain of full and delta role backups in BACKUP_DIR.
+    All methods do file IO, call them through asyncio.to_thread from the bot.
+    """
+
+    def __init__(self, directory: Path = BACKUP_DIR):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.directory / "index.json"
+        self.index: list[dict] = json.loads(self.index_file.read_text()) if self.index_file.exists() else []
+        # the newest snapshot, kept so the next delta doesn't need to replay the chain
+        self._head: Optional[dict[str, dict]] = None
+        # add() runs in worker threads (asyncio.to_thread), overlapping backups must not build on the same head
+        self._lock = threading.Lock()
+
+    def _write_object(self, obj: dict) -> str:
+        text = json.dumps(obj, sort_keys=True)
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        file = self.directory / f"{digest}.json"
+        if not file.exists():
+            file.write_text(text)
+        return digest
+
+    def _read_object(self, digest: str) -> dict:
+        return json.loads((self.directory / f"{digest}.json").read_text())
+
+    def _write_index(self):
+        tmp = self.index_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.index, indent=4))
+        os.replace(tmp, self.index_file)
+
+    def add(self, snapshot: dict) -> dict:
+        """!
+        Store a snapshot (format of 'role_info_<time>.json') as full backup or delta to the previous one.
+        Thread safe, backups added at the same time are chained one after the other.
+
+        @return the index entry of the new backup
+        """
+        with self._lock:
+            return self._add(snapshot)
+
+    def _add(self, snapshot: dict) -> dict:
+        new = _members_as_sets(snapshot)
+        full = len(self.index) % FULL_BACKUP_EVERY == 0
+        if full:
+            obj = {role_id: {**info, "members": sorted(info["members"])} for role_id, info in new.items()}
+        else:
+            obj = compute_delta(self.head(), new)
+
+        entry = {"time": time.time(), "kind": "full" if full else "delta", "hash": self._write_object(obj)}
+        self.index.append(entry)
+        self._write_index()
+        self._head = new
+
+        logger.info(f"Stored {entry['kind']} role backup {entry['hash']}")
+        return entry
+
+    def head(self) -> dict[str, dict]:
+        if self._head is None:
+            self._head = self._reconstruct(len(self.index) - 1) if self.index else {}
+        return self._head
+
+    def _reconstruct(self, position: int) -> dict[str, dict]:
+        """Replay the chain from the last full backup up to the backup at position"""
+        start = position
+        while self.index[start]["kind"] != "full":
+            start -= 1
+
+        snapshot = _members_as_sets(self._read_object(self.index[start]["hash"]))
+        for entry in self.index[start + 1 : position + 1]:
+            snapshot = apply_delta(snapshot, self._read_object(entry["hash"]))
+
+        return snapshot
+
+    def load(self, at: Optional[float] = None) -> Optional[tuple[float, dict]]:
+        """!
+        Restore the backup that was current at a point in time
+
+        @param at unix time, the newest backup if None
+        @return time of the backup and the snapshot in the format of 'role_info_<time>.json', None if there is none
+        """
+        candidates = [i for i, entry in enumerate(self.index) if at is None or entry["time"] <= at]
+        if not candidates:
+            return None
+
+        position = candidates[-1]
+        snapshot = self._reconstruct(position)
+        for info in snapshot.values():
+            info["members"] = sorted(info["members"])
+            info["count"] = len(info["members"])
+
+        return self.index[position]["time"], snapshot
@@ -0,0 +1,325 @@
+import asyncio
+import time
+from contextlib import nullcontext
+from contextlib import suppress
+from typing import AsyncIterable
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+from typing import NamedTuple
+from typing import Optional
+from typing import Union
+
+import aiohttp
+import discord
+
+from ..log_setup import logger
+from .jobs import JobControl
+from .metrics import Metrics
+from .ratelimit import RateLimitObserver
+from .ratelimit import message_edit_route
+from .ratelimit import message_route
+from .ratelimit import original_response_route
+
+### @package bulk
+#
+# Concurrent execution of many small discord API calls (e.g. role changes for thousands of members).
+#
+
+
+# seconds between two updates of a progress message, runs that finish faster don't post one at all
+PROGRESS_INTERVAL = 10.0
+
+# errors that are worth another try, everything else (like missing permissions) fails right away
+TRANSIENT_ERRORS = (discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def with_retries(call: Callable[[], Awaitable], attempts: int = 3, delay: float = 1.0):
+    """!
+    Await call, retrying transient errors with exponential backoff
+
+    @param call coroutine function without arguments
+    @param attempts number of tries before the error is raised
+    @param delay seconds to wait before the first retry, doubled for each further retry
+    @return whatever call returns
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call()
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts:
+                raise
+            logger.warning("Attempt %d/%d failed: %r, retrying in %ss", attempt, attempts, e, delay)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+class BulkJob(NamedTuple):
+    """A single API call, the rate-limit route it hits and a description for logging"""
+
+    route: str
+    call: Callable[[], Awaitable]
+    description: str = ""
+
+
+class BulkResult:
+    """
+    Outcome of a bulk run
+    """
+
+    def __init__(self, label: str, total: int = 0):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.failed: list[tuple[str, Exception]] = []
+        # description of the job that was started last
+        self.current = ""
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def ops_per_second(self) -> float:
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.label}: {self.done} done, {len(self.failed)} failed "
+            f"in {self.elapsed:.1f}s ({self.ops_per_second:.2f} ops/s)"
+        )
+
+
+def format_duration(seconds: float) -> str:
+    """'1h 05m', '3m 20s' or '42s'"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:
+    """
+    A single status message that is edited while a bulk run goes on,
+    with progress against the real number of jobs, ops/s, ETA, errors and the current job.
+
+    The message is posted after the first interval and then edited at most once per interval,
+    runs that finish before don't cost a single request.
+    Edits are paced like the jobs, so they never push a bucket over its limit.
+
+    Slash commands pass their (deferred, ephemeral) interaction instead of a channel: the progress is shown
+    in the response only the admin sees, instead of a public message in e.g. the channel that is cleaned up.
+    Interaction tokens expire after 15 minutes, later updates are skipped.
+    """
+
+    def __init__(
+        self,
+        channel: Union[discord.abc.Messageable, discord.Interaction],
+        rate_limits: Optional[RateLimitObserver] = None,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        """!
+        @param channel where the status message is posted, e.g. 'ctx.channel',
+            or the deferred interaction whose original response is edited
+        @param rate_limits paces the message edits, they're sent right away if None
+        @param interval seconds between two edits
+        """
+        self.channel = channel
+        self.rate_limits = rate_limits
+        self.interval = interval
+        self.message: Optional[discord.Message] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reported = -1
+
+    @staticmethod
+    def render(result: BulkResult, final: bool = False) -> str:
+        finished = result.done + len(result.failed)
+        rate = finished / result.elapsed if result.elapsed > 0 else 0.0
+        share = f" ({finished / result.total:.0%})" if result.total else ""
+
+        lines = [f"**{result.label}**: {finished}/{result.total}{share}{' - done' if final else ''}"]
+        timing = f"{rate:.1f} ops/s, elapsed {format_duration(result.elapsed)}"
+        if not final:
+            eta = format_duration((result.total - finished) / rate) if rate > 0 else "unknown"
+            timing += f", ETA {eta}"
+        lines.append(timing)
+
+        errors = f"{len(result.failed)} failed"
+        if result.failed:
+            errors += f", last: {result.failed[-1][0]}: {result.failed[-1][1]}"
+        lines.append(errors)
+        if result.current and not final:
+            lines.append(f"current: {result.current}")
+
+        # discords limit for message content
+        return "\n".join(lines)[:2000]
+
+    def _paced(self, route: str):
+        return self.rate_limits.paced(route) if self.rate_limits is not None else nullcontext()
+
+    async def _update(self, content: str):
+        """Post or edit the status message, a failed update is logged but never fails the run"""
+        if isinstance(self.channel, discord.Interaction):
+            await self._update_response(self.channel, content)
+            return
+
+        try:
+            if self.message is None:
+                async with self._paced(message_route(self.channel.id)):
+                    self.message = await self.channel.send(content)
+            else:
+                async with self._paced(message_edit_route(self.channel.id)):
+                    await self.message.edit(content=content)
+        except discord.HTTPException as e:
+            logger.warning("Can't update progress message in %s: %s", self.channel, e)
+
+    async def _update_response(self, interaction: discord.Interaction, content: str):
+        if interaction.is_expired():
+            logger.debug("Interaction of the progress message expired, not updating it")
+            return
+        try:
+            async with self._paced(original_response_route(interaction.application_id, interaction.token)):
+                self.message = await interaction.edit_original_response(content=content)
+        except discord.HTTPException as e:
+            logger.warning("Can't update progress response of %s: %s", interaction.command, e)
+
+    async def _report(self, result: BulkResult):
+        while True:
+            await asyncio.sleep(self.interval)
+            finished = result.done + len(result.failed)
+            # nothing happened, e.g. all workers wait for a rate-limit
+            if finished == self._reported:
+                continue
+            self._reported = finished
+            logger.info("%s: %d/%d finished, %.1f ops/s", result.label, finished, result.total, result.ops_per_second)
+            await self._update(self.render(result))
+
+    def start(self, result: BulkResult):
+        self._task = asyncio.create_task(self._report(result))
+
+    async def stop(self, result: BulkResult):
+        """Stop updating, the message shows the final numbers if one was posted"""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        if self.message is not None:
+            await self._update(self.render(result, final=True))
+
+
+class BulkExecutor:
+    """
+    Worker pool that runs jobs concurrently.
+    Every job waits for a permit of its rate-limit bucket, so the pool runs exactly as fast as discord allows.
+    """
+
+    def __init__(self, rate_limits: RateLimitObserver, workers: int = 8, metrics: Optional[Metrics] = None):
+        """!
+        @param rate_limits observer that knows the state of the rate-limit buckets
+        @param workers upper bound of concurrent requests
+        @param metrics records done/failed/in-flight jobs and throughput per command
+        """
+        self.rate_limits = rate_limits
+        self.workers = workers
+        self.metrics = metrics
+
+    async def _worker(self, queue: asyncio.Queue, result: BulkResult, metric: str, control: Optional[JobControl]):
+        while True:
+            job: Optional[BulkJob] = await queue.get()
+            # no more jobs
+            if job is None:
+                return
+
+            if control is not None:
+                # waits while the job is paused
+                await control.checkpoint()
+            await self.rate_limits.acquire(job.route)
+            result.current = job.description
+            if self.metrics is not None:
+                self.metrics.bulk_in_flight[metric] += 1
+            try:
+                await job.call()
+                result.done += 1
+                if self.metrics is not None:
+                    self.metrics.bulk_done[metric] += 1
+                    self.metrics.bulk_ops_per_second[metric] = result.ops_per_second
+            except (discord.HTTPException, *TRANSIENT_ERRORS) as e:
+                logger.warning("%s: failed to %s: %s", result.label, job.description, e)
+                result.failed.append((job.description, e))
+                if self.metrics is not None:
+                    self.metrics.bulk_failed[metric] += 1
+            finally:
+                self.rate_limits.release(job.route)
+                if self.metrics is not None:
+                    self.metrics.bulk_in_flight[metric] -= 1
+
+    @staticmethod
+    async def _feed(jobs: AsyncIterable[BulkJob], queue: asyncio.Queue, result: BulkResult, workers: int):
+        async for job in jobs:
+            result.total += 1
+            await queue.put(job)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def run(
+        self,
+        jobs: Union[Iterable[BulkJob], AsyncIterable[BulkJob]],
+        label: str = "bulk",
+        progress: Optional[ProgressReporter] = None,
+        control: Optional[JobControl] = None,
+    ) -> BulkResult:
+        """!
+        Run all jobs and wait until they are done.
+        HTTP and transient errors are counted per job in the result,
+        any other error cancels the remaining workers and is raised once they stopped.
+
+        @param jobs API calls to make, order is only preserved per worker.
+            Jobs of an async iterable are run while it still produces them (e.g. while paging through reactions)
+        @param label name for logging
+        @param progress reports the run in a status message while it goes on
+        @param control of the background job this run belongs to, pausing it pauses the run
+        @return result with counts and throughput
+        """
+        result = BulkResult(label)
+        tasks = []
+        if isinstance(jobs, AsyncIterable):
+            # bounded, so producing jobs never runs far ahead of sending them
+            queue = asyncio.Queue(maxsize=2 * self.workers)
+            workers = self.workers
+            tasks.append(asyncio.create_task(self._feed(jobs, queue, result, workers)))
+            logger.info(f"{label}: running jobs with {workers} workers while they're produced")
+        else:
+            queue = asyncio.Queue()
+            for job in jobs:
+                queue.put_nowait(job)
+            result.total = queue.qsize()
+            workers = min(self.workers, result.total)
+            for _ in range(workers):
+                queue.put_nowait(None)
+            logger.info(f"{label}: running {result.total} jobs with {workers} workers")
+
+        # labels carry ids or names of the target, the command name is enough as metric label
+        metric = label.split(" ", 1)[0]
+        if control is not None:
+            control.result = result
+        if progress is not None:
+            progress.start(result)
+        tasks += [asyncio.create_task(self._worker(queue, result, metric, control)) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # an unexpected error in one job (or in producing them) stops the whole run: no worker may go on editing
+            # (or write to the journal of the caller) after run() returned
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            result.finished = time.monotonic()
+            if progress is not None:
+                await progress.stop(result)
+
+        logger.info(str(result))
+        return result
@@ -0,0 +1,331 @@
+import asyncio
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Awaitable
+from typing import Callable
+from typing import NamedTuple
+from typing import Optional
+
+import discord
+from discord.ext import tasks
+
+from ..log_setup import logger
+
+### @package jobs
+#
+# Background jobs for long-running admin operations (merge, move_to_old_role, checksum).
+# The commands only queue a job, the JobScheduler runs queued jobs ordered by priority, at most one per guild
+# and 'concurrency' in total, since jobs of the same guild would share (and fight over) the same rate-limit buckets.
+# Jobs are stored in 'data/jobs.sqlite': jobs that were running when the bot stopped are queued again on startup
+# and resumed from their journal.
+#
+
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# seconds between two looks at the queue, jobs are also started right when they're queued or a slot gets free
+DISPATCH_INTERVAL = 30
+
+# runner(guild, channel, params, control), 'params' are the ones given to enqueue()
+JobRunner = Callable[[discord.Guild, discord.abc.Messageable, dict, Optional["JobControl"]], Awaitable]
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    guild_id: int
+    channel_id: int
+    user_id: int
+    params: dict
+    priority: int
+    state: str
+    created: float
+    started: Optional[float]
+    finished: Optional[float]
+    # was running when the bot stopped, it's resumed from its journal
+    interrupted: bool
+    error: Optional[str]
+
+
+class JobStore:
+    """
+    SQLite backed list of all jobs, the queue is every job in state 'queued',
+    highest priority first and in the order they were queued within the same priority.
+    """
+
+    def __init__(self, path: Path = Path("data/jobs.sqlite")):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, guild_id INTEGER NOT NULL, "
+            "channel_id INTEGER NOT NULL, user_id INTEGER NOT NULL, params TEXT NOT NULL, "
+            "priority INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, created REAL NOT NULL, "
+            "started REAL, finished REAL, interrupted INTEGER NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority)")
+        self.db.commit()
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        values = list(row)
+        values[5] = json.loads(values[5])
+        values[11] = bool(values[11])
+        return Job(*values)
+
+    def add(self, kind: str, guild_id: int, channel_id: int, user_id: int, params: dict, priority: int = 0) -> Job:
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (kind, guild_id, channel_id, user_id, params, priority, state, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, guild_id, channel_id, user_id, json.dumps(params), priority, QUEUED, time.time()),
+            )
+        return self.get(cursor.lastrowid)
+
+    def get(self, job_id: int) -> Optional[Job]:
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def queued(self) -> list[Job]:
+        """The queue in the order jobs are started"""
+        rows = self.db.execute("SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id", (QUEUED,))
+        return [self._job(row) for row in rows]
+
+    def jobs(self, guild_id: int, limit: int = 15) -> list[Job]:
+        """Unfinished jobs of a guild, then the most recent finished ones, up to limit"""
+        rows = self.db.execute(
+            "SELECT * FROM jobs WHERE guild_id = ? "
+            f"ORDER BY state IN ({', '.join('?' * len(FINISHED))}), priority DESC, id DESC LIMIT ?",
+            (guild_id, *FINISHED, limit),
+        )
+        return [self._job(row) for row in rows]
+
+    def set_state(self, job_id: int, state: str, error: Optional[str] = None):
+        with self.db:
+            self.db.execute("UPDATE jobs SET state = ?, error = ? WHERE id = ?", (state, error, job_id))
+            if state == RUNNING:
+                self.db.execute("UPDATE jobs SET started = COALESCE(started, ?) WHERE id = ?", (time.time(), job_id))
+            elif state in FINISHED:
+                self.db.execute("UPDATE jobs SET finished = ? WHERE id = ?", (time.time(), job_id))
+
+    def set_priority(self, job_id: int, priority: int):
+        with self.db:
+            self.db.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id))
+
+    def requeue_interrupted(self) -> int:
+        """!
+        On startup: jobs that were running when the bot stopped are queued again and marked as interrupted.
+        Paused jobs that had already started stay paused, but are resumed from their journal as well.
+
+        @return number of queued jobs
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET interrupted = 1 WHERE started IS NOT NULL AND state IN (?, ?)", (RUNNING, PAUSED)
+            )
+            cursor = self.db.execute("UPDATE jobs SET state = ? WHERE state = ?", (QUEUED, RUNNING))
+        return cursor.rowcount
+
+
+class JobControl:
+    """
+    Handle of a running job.
+    Pausing closes a gate the bulk executor waits at before every request, requests in flight still finish.
+    """
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+        # the bulk run currently going on, set by the executor, shown by '/jobs'
+        self.result = None
+        self._running = asyncio.Event()
+        self._running.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    async def checkpoint(self):
+        """Return right away, or once the job is resumed if it's paused"""
+        await self._running.wait()
+
+
+class JobScheduler:
+    """
+    Runs queued jobs in the background.
+    Runners for each kind of job are registered by the cogs, jobs of kinds without a runner stay queued.
+    """
+
+    def __init__(self, bot: discord.Client, concurrency: int = 2, store: Optional[JobStore] = None):
+        """!
+        @param concurrency number of jobs running at the same time, never more than one per guild
+        """
+        self.bot = bot
+        self.concurrency = concurrency
+        self.store = store if store is not None else JobStore()
+        self.runners: dict[str, JobRunner] = {}
+        # job id -> control of the running job
+        self.running: dict[int, JobControl] = {}
+
+    def register(self, kind: str, runner: JobRunner):
+        self.runners[kind] = runner
+
+    def start(self):
+        """Queue the jobs interrupted by the last shutdown and start dispatching"""
+        if self.dispatch.is_running():
+            return
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            logger.info(f"Queued {requeued} jobs again that were interrupted by the last shutdown")
+        self.dispatch.start()
+
+    async def stop(self):
+        """Stop dispatching and running jobs, running jobs are queued again on the next start"""
+        self.dispatch.cancel()
+        for control in list(self.running.values()):
+            control.task.cancel()
+        await asyncio.gather(*(c.task for c in self.running.values()), return_exceptions=True)
+
+    def enqueue(
+        self,
+        kind: str,
+        guild: discord.Guild,
+        channel: discord.abc.Messageable,
+        user: discord.abc.User,
+        params: dict,
+        priority: int = 0,
+    ) -> Job:
+        """!
+        Queue a job, it's started as soon as a slot is free
+
+        @param params json serializable arguments of the runner
+        @param priority jobs with a higher priority are started first
+        """
+        job = self.store.add(kind, guild.id, channel.id, user.id, params, priority)
+        logger.info(f"Queued job #{job.id} ({kind}) with priority {priority} for '{guild.name}'")
+        self.fill_slots()
+        return job
+
+    def position(self, job: Job) -> Optional[int]:
+        """1 based position in the queue, None if the job isn't queued"""
+        ids = [queued.id for queued in self.store.queued()]
+        return ids.index(job.id) + 1 if job.id in ids else None
+
+    @tasks.loop(seconds=DISPATCH_INTERVAL)
+    async def dispatch(self):
+        self.fill_slots()
+
+    def fill_slots(self):
+        """Start the next queued jobs as long as slots are free, skipping jobs of guilds that have a running job"""
+        busy_guilds = {control.job.guild_id for control in self.running.values()}
+        for job in self.store.queued():
+            if len(self.running) >= self.concurrency:
+                return
+            if job.guild_id in busy_guilds or job.kind not in self.runners:
+                continue
+
+            control = JobControl(job)
+            self.running[job.id] = control
+            self.store.set_state(job.id, RUNNING)
+            control.task = asyncio.create_task(self._run(control), name=f"job-{job.id}")
+            busy_guilds.add(job.guild_id)
+
+    async def _run(self, control: JobControl):
+        job = control.job
+        started = time.monotonic()
+        channel = None
+        try:
+            guild = self.bot.get_guild(job.guild_id)
+            channel = guild.get_channel_or_thread(job.channel_id) if guild is not None else None
+            if channel is None:
+                raise RuntimeError(f"Guild {job.guild_id} or channel {job.channel_id} isn't available anymore")
+
+            logger.info(f"Starting job #{job.id} ({job.kind}){' after an interruption' if job.interrupted else ''}")
+            # an interrupted job continues where it stopped, the runners pass this on to their journal
+            params = {**job.params, "resume": True} if job.interrupted else job.params
+            await self.runners[job.kind](guild, channel, params, control)
+
+        except asyncio.CancelledError:
+            if not control.cancelled:
+                # shutdown: the job stays 'running' in the store and is queued again on the next start
+                raise
+            self.store.set_state(job.id, CANCELLED)
+            logger.info(f"Cancelled job #{job.id} ({job.kind})")
+            await self._notify(channel, f"Job #{job.id} ({job.kind}) was cancelled.")
+
+        except Exception as e:
+            logger.exception(f"Job #{job.id} ({job.kind}) failed")
+            self.store.set_state(job.id, FAILED, error=repr(e))
+            await self._notify(channel, f"Job #{job.id} ({job.kind}) failed: {e}")
+
+        else:
+            self.store.set_state(job.id, DONE)
+            logger.info(f"Job #{job.id} ({job.kind}) done in {time.monotonic() - started:.1f}s")
+
+        finally:
+            self.running.pop(job.id, None)
+
+        self.fill_slots()
+
+    @staticmethod
+    async def _notify(channel: Optional[discord.abc.Messageable], content: str):
+        if channel is None:
+            return
+        try:
+            await channel.send(content)
+        except discord.HTTPException as e:
+            logger.warning(f"Can't send job notification to {channel}: {e}")
+
+    def pause(self, job: Job) -> bool:
+        """@return False if the job is neither queued nor running"""
+        if job.state == RUNNING and job.id in self.running:
+            self.running[job.id].pause()
+        elif job.state != QUEUED:
+            return False
+        self.store.set_state(job.id, PAUSED)
+        return True
+
+    def resume(self, job: Job) -> bool:
+        """@return False if the job isn't paused"""
+        if job.state != PAUSED:
+            return False
+        if job.id in self.running:
+            self.running[job.id].resume()
+            self.store.set_state(job.id, RUNNING)
+        else:
+            self.store.set_state(job.id, QUEUED)
+            self.fill_slots()
+        return True
+
+    def cancel(self, job: Job) -> bool:
+        """!
+        Cancel a queued, paused or running job.
+        A running job stops after the requests in flight, its journal is kept so the operation can be resumed.
+
+        @return False if the job is already finished
+        """
+        if job.state in FINISHED:
+            return False
+        control = self.running.get(job.id)
+        if control is None:
+            self.store.set_state(job.id, CANCELLED)
+            return True
+
+        control.cancelled = True
+        # a paused job has to get past its checkpoint to notice
+        control.resume()
+        control.task.cancel()
+        return True
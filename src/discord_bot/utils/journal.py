@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from ..log_setup import logger
+
+### @package journal
+#
+# Crash-safe checkpoints for long-running bulk commands.
+# Every finished member edit is appended and synced to disk, a resumed run skips those members.
+# Edits finishing while a sync is going on are written together with the next one, off the event loop.
+# The planned member changes are stored next to the journal: a resumed run applies those instead of planning again,
+# since the guild (role names, created roles) isn't in the state the plan was made from anymore.
+#
+
+
+class Journal:
+    """
+    Append-only journal of members whose edit went through, stored as json lines in 'data/journal_<name>.jsonl'.
+    A member only counts as done once its line is synced to disk, so a crash loses at most the edits in flight.
+    """
+
+    def __init__(self, name: str, resume: bool = False):
+        """!
+        @param name identifies the command and its target, e.g. 'merge_<guild-id>'
+        @param resume load the existing journal and skip its members instead of starting over
+        """
+        self.path = Path(f"data/journal_{name}.jsonl")
+        self.plan_path = Path(f"data/journal_{name}.plan.json")
+        self.done: set[int] = self._load() if resume else set()
+        if resume:
+            logger.info(f"Resuming from {self.path}: {len(self.done)} members already done")
+
+        self._file = open(self.path, "a" if resume else "w")
+        # records waiting for the next sync, one sync runs at a time
+        self._pending: list[tuple[int, str]] = []
+        self._sync_lock = asyncio.Lock()
+        # terminate a line that was cut off by the crash, so the next record starts on its own line
+        if resume and self._file.tell() > 0 and not self.path.read_bytes().endswith(b"\n"):
+            self._file.write("\n")
+
+    def _load(self) -> set[int]:
+        done = set()
+        if not self.path.exists():
+            logger.warning(f"No journal found at {self.path}, starting from scratch")
+            return done
+
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    done.add(json.loads(line)["member"])
+                # the last line might be cut off by the crash
+                except (json.JSONDecodeError, KeyError):
+                    logger.warning(f"Ignoring broken journal line: {line!r}")
+
+        return done
+
+    def __contains__(self, member_id: int) -> bool:
+        return member_id in self.done
+
+    async def record(self, member_id: int, role_ids: set[int]):
+        """Append a finished member edit, returns once it's synced to disk"""
+        self._pending.append(
+            (member_id, json.dumps({"member": member_id, "roles": sorted(role_ids), "time": time.time()}))
+        )
+        async with self._sync_lock:
+            # empty if the sync before this one already took the record
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            await asyncio.to_thread(self._write, [line for _, line in batch])
+            self.done.update(member for member, _ in batch)
+
+    def _write(self, lines: list[str]):
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def save_plan(self, changes: dict[int, dict[int, bool]]):
+        """Store the planned changes (member id -> role id -> add / remove) this journal checkpoints, blocking"""
+        data = {str(member): {str(role): add for role, add in roles.items()} for member, roles in changes.items()}
+        tmp = self.plan_path.with_suffix(".tmp")
+        with open(tmp, "w") as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        # a crash while writing leaves the previous plan in place
+        os.replace(tmp, self.plan_path)
+
+    def load_plan(self) -> Optional[dict[int, dict[int, bool]]]:
+        """The changes stored by save_plan(), None if there are none"""
+        if not self.plan_path.exists():
+            return None
+        data = json.loads(self.plan_path.read_text())
+        return {int(member): {int(role): add for role, add in roles.items()} for member, roles in data.items()}
+
+    def close(self, finished: bool = False):
+        """!
+        Close the journal
+
+        @param finished the command completed without failures, the journal and its plan aren't needed anymore
+                        and are removed
+        """
+        self._file.close()
+        if finished:
+            self.path.unlink(missing_ok=True)
+            self.plan_path.unlink(missing_ok=True)
@@ -0,0 +1,91 @@
+import json
+from pathlib import Path
+from typing import NamedTuple
+from typing import Optional
+
+from ..log_setup import logger
+
+### @package mapping
+#
+# The role mapping files ('data/roles_dump.json' and its edited versions) map a module key
+# to all role names that belong to this module, e.g.:
+# {"Analysis": ["Analysis", "Analysis I", "Analysis (old)"], "[NO MOVE]Info": ["Info"]}
+#
+
+NO_MOVE = "[NO MOVE]"
+
+
+class MappingEntry(NamedTuple):
+    """Everything merge needs to know about a module key, resolved once when the mapping is compiled"""
+
+    key: str
+    no_move: bool
+    names: list[str]
+    # name of the role that stays the current role, None if there is no candidate
+    current_name: Optional[str]
+    # name of the role that becomes the '(old)' role, None if it can't be determined
+    old_name: Optional[str]
+    # the module has only one role, the '(old)' role must be created
+    create_old: bool
+    # the old role was already renamed to '<key> (old)'
+    old_renamed: bool
+
+
+class RoleMapping:
+    """
+    Inverted index of a mapping file: role name -> entry of the module the role belongs to.
+    Names listed under several keys are reported as ambiguous, the first key wins (like in the file order).
+    """
+
+    def __init__(self, roles_dict: dict[str, list[str]]):
+        self.entries: dict[str, MappingEntry] = {}
+        self.by_name: dict[str, MappingEntry] = {}
+        # role name -> all keys listing it
+        self.ambiguous: dict[str, list[str]] = {}
+
+        for raw_key, names in roles_dict.items():
+            entry = self.compile_entry(raw_key, names)
+            self.entries[entry.key] = entry
+
+            for name in names:
+                if name in self.by_name:
+                    self.ambiguous.setdefault(name, [self.by_name[name].key]).append(entry.key)
+                    continue
+                self.by_name[name] = entry
+
+        for name, keys in self.ambiguous.items():
+            logger.warning(f"Role '{name}' is mapped to several keys {keys}, using '{keys[0]}'")
+
+    @staticmethod
+    def compile_entry(raw_key: str, names: list[str]) -> MappingEntry:
+        no_move = raw_key.startswith(NO_MOVE)
+        key = raw_key.replace(NO_MOVE, "")
+
+        current_candidates = [n for n in names if "(" not in n]
+        renamed_candidates = [n for n in names if "(old)" in n]
+        old_candidates = [n for n in names if "(" in n]
+
+        old_renamed = len(renamed_candidates) == 1
+        if len(names) == 1:
+            old_name = None
+        elif old_renamed:
+            old_name = renamed_candidates[0]
+        else:
+            old_name = max(old_candidates) if old_candidates else None
+
+        return MappingEntry(
+            key=key,
+            no_move=no_move,
+            names=names,
+            current_name=min(current_candidates) if current_candidates else None,
+            old_name=old_name,
+            create_old=len(names) == 1,
+            old_renamed=old_renamed,
+        )
+
+    @classmethod
+    def load(cls, file: Path) -> "RoleMapping":
+        return cls(json.loads(file.read_text()))
+
+    def get(self, role_name: str) -> Optional[MappingEntry]:
+        return self.by_name.get(role_name)
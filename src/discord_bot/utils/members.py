@@ -0,0 +1,208 @@
+import os
+import sys
+import time
+from array import array
+from pathlib import Path
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+from typing import Union
+
+import discord
+
+from ..log_setup import logger
+
+### @package members
+#
+# On demand member caching. With LAZY_MEMBERS the guilds aren't chunked at startup,
+# commands that walk the members of a guild load them right before they need them.
+# With COMPACT_MEMBERS discord.py doesn't cache members at all, the CompactMemberCache keeps only their role ids.
+#
+
+EMPTY_ROLES = array("Q")
+
+
+def resident_memory_mb() -> Optional[float]:
+    """Current resident memory of the process in MiB, None if the platform doesn't tell us"""
+    statm = Path("/proc/self/statm")
+    if statm.exists():
+        return int(statm.read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak instead of current usage, bytes on macOS and KiB everywhere else
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def format_memory() -> str:
+    memory = resident_memory_mb()
+    return f"{memory:.1f} MiB" if memory is not None else "unknown"
+
+
+async def ensure_members(guild: discord.Guild, compact_cache: Optional["CompactMemberCache"] = None):
+    """!
+    Load the member list of a guild if it isn't cached (yet).
+    Without LAZY_MEMBERS the guild was chunked at startup and this returns right away.
+
+    @param compact_cache the bots compact cache if it uses one, the guild is loaded into it instead
+    """
+    if compact_cache is not None:
+        if not compact_cache.loaded(guild):
+            await compact_cache.load(guild)
+        return
+
+    if guild.chunked:
+        return
+
+    started = time.monotonic()
+    await guild.chunk()
+    logger.info(
+        f"Chunked {guild.member_count} members of '{guild.name}' in {time.monotonic() - started:.1f}s, "
+        f"memory: {format_memory()}"
+    )
+
+
+class CompactMember:
+    """
+    Lightweight view of a member in the CompactMemberCache.
+    Has the attributes the planner and the snapshot helpers use: 'id', '_roles' (role ids without @everyone)
+    and 'edit(roles=...)'.
+    """
+
+    __slots__ = ("id", "guild", "_last_roles", "_cache")
+
+    def __init__(self, member_id: int, guild: discord.Guild, roles: array, cache: dict[int, array]):
+        self.id = member_id
+        self.guild = guild
+        self._last_roles = roles
+        self._cache = cache
+
+    @property
+    def _roles(self) -> array:
+        """The roles in the cache right now, every member update replaces the entry (the last known if they left)"""
+        return self._cache.get(self.id, self._last_roles)
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    def __str__(self):
+        return str(self.id)
+
+    async def edit(self, *, roles: Iterable[discord.abc.Snowflake], reason: Optional[str] = None):
+        """Replace the roles of the member, the same request 'discord.Member.edit(roles=...)' makes"""
+        role_ids = sorted({r.id for r in roles})
+        await self.guild._state.http.edit_member(
+            self.guild.id, self.id, reason=reason, roles=[str(role_id) for role_id in role_ids]
+        )
+        # the member update event will do the same, but the plan may ask again before it arrives
+        self._last_roles = array("Q", role_ids)
+        self._cache[self.id] = self._last_roles
+
+
+class CompactMemberCache:
+    """
+    Members of large guilds as member id -> array of role ids instead of full 'discord.Member' objects.
+    The bot runs with 'MemberCacheFlags.none()', guilds are loaded on demand (see ensure_members)
+    and kept current by hooking the member events of the gateway before discord.py parses them.
+    Updates sent while the bot was disconnected are lost after a new session (READY) or when a guild is sent again
+    (GUILD_CREATE, e.g. after an outage), those guilds are dropped and loaded again when a command needs them.
+    """
+
+    def __init__(self):
+        self._guilds: dict[int, dict[int, array]] = {}
+        self._loaded: set[int] = set()
+
+    def install(self, state):
+        """!
+        Hook into the gateway parsers of the connection state ('bot._connection').
+        discord.py drops updates of uncached members without an event, so they are read from the raw payload.
+        """
+        hooks = {
+            "GUILD_MEMBER_ADD": self._on_member_data,
+            "GUILD_MEMBER_UPDATE": self._on_member_data,
+            "GUILD_MEMBER_REMOVE": self._on_member_remove,
+            "READY": self._on_ready,
+            "GUILD_CREATE": self._on_guild_create,
+        }
+        for event, hook in hooks.items():
+            state.parsers[event] = self._chain(hook, state.parsers[event])
+
+    @staticmethod
+    def _chain(hook: Callable[[dict], None], parser: Callable[[dict], None]) -> Callable[[dict], None]:
+        def parse(data: dict):
+            hook(data)
+            parser(data)
+
+        return parse
+
+    def _on_member_data(self, data: dict):
+        members = self._guilds.get(int(data["guild_id"]))
+        if members is not None:
+            members[int(data["user"]["id"])] = self._role_array(data["roles"])
+
+    def _on_member_remove(self, data: dict):
+        members = self._guilds.get(int(data["guild_id"]))
+        if members is not None:
+            members.pop(int(data["user"]["id"]), None)
+
+    def _on_ready(self, data: dict):
+        # a new session, nothing that happened since the old one was lost is replayed
+        if self._guilds:
+            logger.info(f"New gateway session, dropping {len(self._guilds)} guilds from the compact member cache")
+        self._guilds.clear()
+        self._loaded.clear()
+
+    def _on_guild_create(self, data: dict):
+        guild_id = int(data["id"])
+        if guild_id in self._guilds:
+            logger.info(f"Guild {guild_id} was sent again, dropping it from the compact member cache")
+        self._guilds.pop(guild_id, None)
+        self._loaded.discard(guild_id)
+
+    @staticmethod
+    def _role_array(role_ids: Iterable) -> array:
+        # members without roles share one array, it's never mutated
+        return array("Q", sorted(map(int, role_ids))) if role_ids else EMPTY_ROLES
+
+    def loaded(self, guild: discord.Guild) -> bool:
+        return guild.id in self._loaded
+
+    async def load(self, guild: discord.Guild):
+        """Page through all members of the guild (1000 per request), only their role ids are kept"""
+        started = time.monotonic()
+        # registered before loading, so events arriving in the meantime aren't lost
+        members = self._guilds.setdefault(guild.id, {})
+        async for member in guild.fetch_members(limit=None):
+            members[member.id] = self._role_array(member._roles)
+
+        if self._guilds.get(guild.id) is not members:
+            # reconnected while loading, the next command loads the guild again
+            logger.warning(f"Members of '{guild.name}' were dropped while loading them")
+            return
+        self._loaded.add(guild.id)
+        logger.info(
+            f"Loaded {len(members)} members of '{guild.name}' into the compact cache "
+            f"in {time.monotonic() - started:.1f}s, memory: {format_memory()}"
+        )
+
+    def forget(self, guild: discord.Guild):
+        self._guilds.pop(guild.id, None)
+        self._loaded.discard(guild.id)
+
+    def members(self, guild: discord.Guild) -> Iterator[CompactMember]:
+        members = self._guilds.get(guild.id, {})
+        return (CompactMember(member_id, guild, roles, members) for member_id, roles in list(members.items()))
+
+    def get_member(self, guild: discord.Guild, member_id: int) -> Optional[CompactMember]:
+        members = self._guilds.get(guild.id, {})
+        roles = members.get(member_id)
+        return CompactMember(member_id, guild, roles, members) if roles is not None else None
+
+
+# what the member helpers accept: a cached discord.py member or a view of the compact cache
+AnyMember = Union[discord.Member, CompactMember]
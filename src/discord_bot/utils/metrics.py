@@ -0,0 +1,192 @@
+import bisect
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Callable
+
+import aiohttp
+from aiohttp import web
+
+from ..log_setup import logger
+from .ratelimit import route_key
+
+### @package metrics
+#
+# In-process metrics of the bot in the Prometheus text format (version 0.0.4).
+# Served on 'http://127.0.0.1:<METRICS_PORT>/metrics' if METRICS_PORT is set.
+#
+
+# seconds, from a quick ping to a merge over thousands of members
+COMMAND_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, like a Prometheus histogram"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # only the first matching bucket is counted, render() accumulates
+        position = bisect.bisect_left(self.bounds, value)
+        if position < len(self.bounds):
+            self.counts[position] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Collects command latency, HTTP calls per route, rate-limit hits and bulk throughput.
+    Recording is a few dict operations, the text is only built when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self.command_latency: dict[str, Histogram] = {}
+        self.command_errors: Counter[str] = Counter()
+        # (method + route, status) -> count
+        self.http_requests: Counter[tuple[str, int]] = Counter()
+        self.http_latency: dict[str, Histogram] = {}
+        self.rate_limited: Counter[str] = Counter()
+        self.retry_after_seconds: Counter[str] = Counter()
+        # per bulk label
+        self.bulk_done: Counter[str] = Counter()
+        self.bulk_failed: Counter[str] = Counter()
+        self.bulk_in_flight: Counter[str] = Counter()
+        self.bulk_ops_per_second: dict[str, float] = {}
+        # name -> (help, callable), evaluated on scrape
+        self.gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def attach(self, trace_config: aiohttp.TraceConfig):
+        """Count every request of the bots HTTP session, pass the same trace config as the RateLimitObserver"""
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+
+    async def _on_request_start(self, _session, ctx, _params):
+        ctx.metrics_started = time.monotonic()
+
+    async def _on_request_end(self, _session, ctx, params: aiohttp.TraceRequestEndParams):
+        route = route_key(params.method, params.url.path)
+        status = params.response.status
+        self.http_requests[route, status] += 1
+        if route not in self.http_latency:
+            self.http_latency[route] = Histogram(HTTP_BUCKETS)
+        self.http_latency[route].observe(time.monotonic() - getattr(ctx, "metrics_started", time.monotonic()))
+
+        if status == 429:
+            self.rate_limited[route] += 1
+            try:
+                self.retry_after_seconds[route] += float(params.response.headers.get("Retry-After", 0))
+            except ValueError:
+                pass
+
+    def observe_command(self, name: str, seconds: float, failed: bool = False):
+        if name not in self.command_latency:
+            self.command_latency[name] = Histogram(COMMAND_BUCKETS)
+        self.command_latency[name].observe(seconds)
+        if failed:
+            self.command_errors[name] += 1
+
+    def observe_command_since(self, name: str, created_at: datetime, failed: bool = False):
+        """Command latency from the time discord created the message/interaction, gateway delay included"""
+        self.observe_command(name, max(time.time() - created_at.timestamp(), 0.0), failed)
+
+    def add_gauge(self, name: str, help_text: str, value: Callable[[], float]):
+        self.gauges[name] = (help_text, value)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = [
+            "# HELP discord_command_duration_seconds Time from the command message/interaction to its completion",
+            "# TYPE discord_command_duration_seconds histogram",
+        ]
+        for name, histogram in self.command_latency.items():
+            lines += histogram.render("discord_command_duration_seconds", f'command="{_escape(name)}"')
+
+        lines += [
+            "# HELP discord_command_errors_total Commands that raised",
+            "# TYPE discord_command_errors_total counter",
+        ]
+        lines += [f'discord_command_errors_total{{command="{_escape(n)}"}} {c}' for n, c in self.command_errors.items()]
+
+        lines += ["# HELP discord_http_requests_total Requests per route", "# TYPE discord_http_requests_total counter"]
+        lines += [
+            f'discord_http_requests_total{{route="{_escape(route)}",status="{status}"}} {count}'
+            for (route, status), count in self.http_requests.items()
+        ]
+
+        lines += [
+            "# HELP discord_http_request_duration_seconds Duration of requests per route",
+            "# TYPE discord_http_request_duration_seconds histogram",
+        ]
+        for route, histogram in self.http_latency.items():
+            lines += histogram.render("discord_http_request_duration_seconds", f'route="{_escape(route)}"')
+
+        counters = (
+            ("discord_rate_limited_total", "Responses with status 429", self.rate_limited),
+            ("discord_retry_after_seconds_total", "Sum of Retry-After of 429 responses", self.retry_after_seconds),
+            ("bulk_jobs_done_total", "Finished jobs per bulk label", self.bulk_done),
+            ("bulk_jobs_failed_total", "Failed jobs per bulk label", self.bulk_failed),
+        )
+        for name, help_text, counter in counters:
+            label = "route" if name.startswith("discord") else "label"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            lines += [f'{name}{{{label}="{_escape(key)}"}} {value}' for key, value in counter.items()]
+
+        gauges = (
+            ("bulk_jobs_in_flight", "Jobs currently running per bulk label", self.bulk_in_flight),
+            ("bulk_ops_per_second", "Throughput of the current or last run per bulk label", self.bulk_ops_per_second),
+        )
+        for name, help_text, values in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f'{name}{{label="{_escape(key)}"}} {value}' for key, value in values.items()]
+
+        for name, (help_text, value) in self.gauges.items():
+            current = value()
+            # e.g. the gateway latency before the first heartbeat, Prometheus spells it 'NaN'
+            lines += [
+                f"# HELP {name} {help_text}",
+                f"# TYPE {name} gauge",
+                f"{name} {'NaN' if current != current else current}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+        """!
+        Serve the metrics on 'http://<host>:<port>/metrics'
+
+        @return the runner, call 'cleanup()' on it to stop serving
+        """
+
+        async def handle(_request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return runner
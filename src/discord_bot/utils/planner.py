@@ -0,0 +1,325 @@
+import json
+import time
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+from typing import Union
+
+import discord
+
+from ..log_setup import log_sampled
+from ..log_setup import logger
+from .bulk import BulkJob
+from .journal import Journal
+from .ratelimit import GLOBAL_RATE
+from .ratelimit import RateLimitObserver
+from .ratelimit import member_route
+from .ratelimit import role_positions_route
+from .ratelimit import role_route
+from .ratelimit import route_key
+
+### @package planner
+#
+# Planning of role changes for many members at once.
+# Instead of one request per added or removed role, every member gets a single edit with their final roles.
+#
+
+
+class MemberRolePlan:
+    """
+    Collects role additions and removals per member and applies them with one 'member.edit(roles=...)' each.
+
+    'member.edit(roles=...)' replaces ALL roles of the member. The final role set is computed from the members
+    cached roles (kept current by the gateway) right before each request is sent, so roles someone picks while
+    a long run is going on are kept. Only a change that lands between that moment and the request is overwritten.
+    The member is looked up again for that by id: after a reconnect discord.py replaces all member objects,
+    the ones captured while planning don't get updates anymore.
+    """
+
+    def __init__(
+        self,
+        guild: discord.Guild,
+        get_member: Optional[Callable[[int], Optional[discord.Member]]] = None,
+        rate_limits: Optional[RateLimitObserver] = None,
+    ):
+        """!
+        @param get_member looks up a cached member by id when its edit is sent, 'guild.get_member' if None
+        @param rate_limits paces fetching members that aren't cached, unpaced if None
+        """
+        self.guild = guild
+        self.get_member = get_member if get_member is not None else guild.get_member
+        self.rate_limits = rate_limits
+        # member id -> role id -> True (add) / False (remove), the last call for a role wins
+        self.changes: dict[int, dict[int, bool]] = {}
+        self.members: dict[int, discord.Member] = {}
+        # members whose edit was rejected by discord
+        self.failed: set[int] = set()
+        # the changes handed out as jobs, kept so the plan can still be reported after it was applied
+        self.submitted: Optional[list[tuple[discord.Member, set[int], set[int]]]] = None
+
+    def add_role(self, member: discord.Member, role: discord.abc.Snowflake):
+        self.members[member.id] = member
+        self.changes.setdefault(member.id, {})[role.id] = True
+
+    def remove_role(self, member: discord.Member, role: discord.abc.Snowflake):
+        self.members[member.id] = member
+        self.changes.setdefault(member.id, {})[role.id] = False
+
+    def final_role_ids(self, member: discord.Member) -> set[int]:
+        """Roles the member will have after the plan was applied (without @everyone)"""
+        # _roles holds the plain ids without @everyone, for discord.py members and CompactMember
+        role_ids = set(member._roles)
+        for role_id, add in self.changes.get(member.id, {}).items():
+            if add:
+                role_ids.add(role_id)
+            else:
+                role_ids.discard(role_id)
+
+        return role_ids
+
+    def restore(self, changes: dict[int, dict[int, bool]], get_member: Callable[[int], Optional[discord.Member]]):
+        """!
+        Replace the planned changes with the ones an earlier, interrupted run saved (see Journal.save_plan)
+
+        @param get_member looks up the members by id, members that left the guild in between are dropped
+        """
+        self.changes = {}
+        self.members = {}
+        for member_id, roles in changes.items():
+            member = get_member(member_id)
+            if member is not None:
+                self.members[member_id] = member
+                self.changes[member_id] = roles
+
+    def pending(self) -> Iterable[tuple[discord.Member, set[int], set[int]]]:
+        """Members whose roles actually change, with their current and final role set"""
+        for member_id, member in self.members.items():
+            current = set(member._roles)
+            final = self.final_role_ids(member)
+            if final != current:
+                yield member, current, final
+
+    def diff(self) -> list[tuple[discord.Member, set[int], set[int]]]:
+        """The changes that were submitted, or the pending ones if the plan wasn't applied yet"""
+        if self.submitted is not None:
+            return self.submitted
+        return list(self.pending())
+
+    def holders(self, role: discord.Role, members: Optional[Iterable[discord.Member]] = None) -> list[discord.Member]:
+        """!
+        Members that have the role after the plan was applied, taking failed edits into account
+
+        @param members all members of the guild (e.g. from the compact cache), 'role.members' if None
+        """
+        candidates = role.members if members is None else (m for m in members if role.id in m._roles)
+        return [m for m in candidates if m.id in self.failed or role.id in self.final_role_ids(m)]
+
+    async def _current_member(self, member_id: int) -> discord.Member:
+        """The member as cached right now, fetched if the cache doesn't know them (anymore)"""
+        member = self.get_member(member_id)
+        if member is not None:
+            return member
+
+        route = route_key("GET", f"/guilds/{self.guild.id}/members/{member_id}")
+        async with self.rate_limits.paced(route) if self.rate_limits is not None else nullcontext():
+            return await self.guild.fetch_member(member_id)
+
+    async def _edit(self, member_id: int, journal: Optional[Journal]):
+        """Send the final roles of the member, computed from the cache at this moment and not when the job was built"""
+        member = await self._current_member(member_id)
+        role_ids = self.final_role_ids(member)
+        if role_ids == set(member._roles):
+            # someone else made the same change in the meantime
+            log_sampled(
+                "member_edit_skipped", 100, "Roles of %s are already up to date (every 100th is logged)", member
+            )
+        else:
+            try:
+                await member.edit(roles=[discord.Object(id=r) for r in role_ids])
+            except discord.HTTPException:
+                self.failed.add(member.id)
+                raise
+            log_sampled("member_edit", 500, "Edited roles of %s (every 500th edit is logged)", member)
+
+        if journal is not None:
+            await journal.record(member.id, role_ids)
+
+    def jobs(self, journal: Optional[Journal] = None) -> list[BulkJob]:
+        """!
+        One edit per member whose roles change, members without a change are skipped
+
+        @param journal checkpoint every finished edit, members already in the journal are skipped
+        """
+        route = member_route(self.guild.id)
+        self.submitted = list(self.pending())
+        if journal is not None:
+            self.submitted = [change for change in self.submitted if change[0].id not in journal]
+            logger.info(f"{len(journal.done)} members are already done according to the journal")
+
+        return [
+            BulkJob(route, partial(self._edit, member.id, journal), self._describe(member, current, final))
+            for member, current, final in self.submitted
+        ]
+
+    def _describe(self, member: discord.Member, current: set[int], final: set[int]) -> str:
+        """'edit roles of <member> (+added, -removed)', shown for failed jobs and in the progress message"""
+        changes = [f"+{self._role_name(r)}" for r in sorted(final - current)]
+        changes += [f"-{self._role_name(r)}" for r in sorted(current - final)]
+        return f"edit roles of {member} ({', '.join(changes)})"
+
+    def _role_name(self, role_id: int) -> str:
+        role = self.guild.get_role(role_id)
+        return role.name if role is not None else str(role_id)
+
+    def __len__(self):
+        return len(self.members)
+
+
+class PlannedRole:
+    """
+    Stand-in for a role that would be created by a dry run.
+    Uses negative ids, so it can't collide with real roles.
+    """
+
+    _next_id = -1
+
+    def __init__(self, name: str):
+        self.id = PlannedRole._next_id
+        PlannedRole._next_id -= 1
+        self.name = name
+        self.members: list[discord.Member] = []
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f"<PlannedRole id={self.id} name='{self.name}'>"
+
+
+class GuildPlan:
+    """
+    Records all changes a bulk command makes to a guild: role creations, renames, deletions, position moves
+    and member role changes. In a dry run the changes are only recorded, otherwise they're executed as well.
+
+    The plan can estimate the number of HTTP calls and the time they take under discords rate-limits
+    and is written to a json file, so strategies can be compared before running them.
+    """
+
+    def __init__(
+        self,
+        command: str,
+        guild: discord.Guild,
+        dry_run: bool = False,
+        rate_limits: Optional[RateLimitObserver] = None,
+        get_member: Optional[Callable[[int], Optional[discord.Member]]] = None,
+    ):
+        """!
+        @param rate_limits paces the role requests like the member edits, unpaced if None
+        @param get_member looks up the current member objects when the member edits are sent, see MemberRolePlan
+        """
+        self.command = command
+        self.guild = guild
+        self.dry_run = dry_run
+        self.rate_limits = rate_limits
+        self.members = MemberRolePlan(guild, get_member=get_member, rate_limits=rate_limits)
+        self.created: list[dict] = []
+        self.renamed: list[dict] = []
+        self.deleted: list[dict] = []
+        self.moved: list[dict] = []
+
+    async def create_role(self, name: str, reason: Optional[str] = None) -> Union[discord.Role, PlannedRole]:
+        self.created.append({"name": name, "reason": reason})
+        if self.dry_run:
+            return PlannedRole(name)
+        async with self._paced(role_route(self.guild.id, "POST")):
+            return await self.guild.create_role(name=name, reason=reason)
+
+    async def rename_role(self, role: discord.Role, name: str) -> discord.Role:
+        self.renamed.append({"id": role.id, "from": role.name, "to": name})
+        if self.dry_run:
+            return role
+        async with self._paced(role_route(self.guild.id, "PATCH")):
+            return await role.edit(name=name)
+
+    async def delete_role(self, role: discord.Role, reason: Optional[str] = None):
+        self.deleted.append({"id": role.id, "name": role.name, "reason": reason})
+        if not self.dry_run:
+            async with self._paced(role_route(self.guild.id, "DELETE")):
+                await role.delete(reason=reason)
+
+    async def move_role(self, role: discord.Role, position: int):
+        self.moved.append({"id": role.id, "name": role.name, "from": role.position, "to": position})
+        if not self.dry_run:
+            async with self._paced(role_positions_route(self.guild.id)):
+                await role.edit(position=position)
+
+    def _paced(self, route: str):
+        return self.rate_limits.paced(route) if self.rate_limits is not None else nullcontext()
+
+    def http_calls(self) -> dict[str, int]:
+        """Number of requests per rate-limit route this plan needs"""
+        calls = {
+            role_route(self.guild.id, "POST"): len(self.created),
+            role_route(self.guild.id, "PATCH"): len(self.renamed),
+            role_route(self.guild.id, "DELETE"): len(self.deleted),
+            role_positions_route(self.guild.id): len(self.moved),
+            member_route(self.guild.id): len(self.members.diff()),
+        }
+        return {route: n for route, n in calls.items() if n}
+
+    def estimate(self, rate_limits: RateLimitObserver) -> dict:
+        """!
+        Estimate the wall-clock time of this plan.
+        Routes are processed one after another, each as fast as its bucket allows and never faster than the global limit.
+
+        @return dict with calls and seconds per route and the totals
+        """
+        routes = {}
+        for route, calls in self.http_calls().items():
+            limit, window = rate_limits.rate(route)
+            routes[route] = {"calls": calls, "limit": limit, "window": window, "seconds": calls / limit * window}
+
+        total_calls = sum(r["calls"] for r in routes.values())
+        seconds = max(sum(r["seconds"] for r in routes.values()), total_calls / GLOBAL_RATE)
+        return {"routes": routes, "total_calls": total_calls, "seconds": round(seconds, 1)}
+
+    def to_dict(self, rate_limits: RateLimitObserver) -> dict:
+        members = []
+        for member, current, final in self.members.diff():
+            members.append(
+                {
+                    "id": member.id,
+                    # views of the compact member cache don't know the name
+                    "name": getattr(member, "name", None),
+                    "add": sorted(final - current),
+                    "remove": sorted(current - final),
+                }
+            )
+
+        return {
+            "command": self.command,
+            "guild": self.guild.id,
+            "dry_run": self.dry_run,
+            "time": time.time(),
+            "roles": {"create": self.created, "rename": self.renamed, "delete": self.deleted, "move": self.moved},
+            "members": members,
+            "estimate": self.estimate(rate_limits),
+        }
+
+    def write(self, rate_limits: RateLimitObserver) -> Path:
+        """Write the plan to 'data/plan_<command>_<time>.json'"""
+        file = Path(f"data/plan_{self.command}_{time.time()}.json")
+        file.write_text(json.dumps(self.to_dict(rate_limits), indent=4))
+        return file
+
+    def summary(self, rate_limits: RateLimitObserver) -> str:
+        estimate = self.estimate(rate_limits)
+        edits = estimate["routes"].get(member_route(self.guild.id), {}).get("calls", 0)
+        return (
+            f"{'Dry run' if self.dry_run else 'Plan'} for {self.command}: create {len(self.created)}, "
+            f"rename {len(self.renamed)}, delete {len(self.deleted)}, move {len(self.moved)} roles, edit {edits} members.\n"
+            f"{estimate['total_calls']} HTTP calls, about {estimate['seconds']}s"
+        )
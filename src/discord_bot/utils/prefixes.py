@@ -0,0 +1,83 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from ..log_setup import logger
+
+### @package prefixes
+#
+# Per guild custom command prefixes, persisted in 'data/prefixes.json' as {"<guild-id>": "<prefix>", ...}.
+#
+
+PREFIXES_FILE = Path("data/prefixes.json")
+
+
+class PrefixStore:
+    """
+    Custom prefixes per guild with a cache of the complete prefix tuple for every guild.
+    The tuples are built once and only rebuilt when a prefix changes,
+    so a lookup is a single dict access without any string formatting or new lists.
+    """
+
+    def __init__(self, default_prefix: str, file: Path = PREFIXES_FILE):
+        self.default_prefix = default_prefix
+        self.file = file
+        self.custom: dict[int, str] = self.__load()
+        # built as soon as the bots user id is known (see set_user)
+        self._mentions: tuple[str, ...] = ()
+        self._default: tuple[str, ...] = (default_prefix,)
+        self._cache: dict[int, tuple[str, ...]] = {}
+        # one change at a time, so a write never drops the change of another one
+        self._lock = asyncio.Lock()
+
+    def __load(self) -> dict[int, str]:
+        if not self.file.exists():
+            return {}
+        try:
+            return {int(guild_id): prefix for guild_id, prefix in json.loads(self.file.read_text()).items()}
+        except (json.JSONDecodeError, ValueError):
+            logger.warning(f"Can't read '{self.file}', using the default prefix for all guilds")
+            return {}
+
+    def __save(self, custom: dict[int, str]):
+        tmp = self.file.with_suffix(".tmp")
+        tmp.write_text(json.dumps({str(guild_id): prefix for guild_id, prefix in custom.items()}, indent=4))
+        os.replace(tmp, self.file)
+
+    def set_user(self, user_id: int):
+        """Build the mention prefixes, mobile and desktop have a different syntax how mentions are sent"""
+        self._mentions = (f"<@!{user_id}> ", f"<@{user_id}> ")
+        self._default = (*self._mentions, self.default_prefix)
+        self._cache = {guild_id: (*self._mentions, prefix) for guild_id, prefix in self.custom.items()}
+
+    def get(self, guild_id: Optional[int]) -> tuple[str, ...]:
+        """!
+        @param guild_id None in DMs
+        @return the mention prefixes and the custom prefix of the guild or the default prefix
+        """
+        return self._cache.get(guild_id, self._default)
+
+    async def set(self, guild_id: int, prefix: Optional[str]):
+        """!
+        Change the prefix of a guild and rebuild its cache entry.
+        Only the file is written in a worker thread, the cache is changed on the event loop once it's saved.
+
+        @param prefix None to return to the default prefix
+        """
+        async with self._lock:
+            custom = dict(self.custom)
+            if prefix is None or prefix == self.default_prefix:
+                custom.pop(guild_id, None)
+            else:
+                custom[guild_id] = prefix
+            await asyncio.to_thread(self.__save, custom)
+
+            self.custom = custom
+            if guild_id in custom:
+                self._cache[guild_id] = (*self._mentions, prefix)
+            else:
+                self._cache.pop(guild_id, None)
+
+        logger.info(f"Prefix of guild {guild_id} is now '{prefix or self.default_prefix}'")
@@ -0,0 +1,269 @@
+import asyncio
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiohttp
+
+from ..log_setup import logger
+
+### @package ratelimit
+#
+# Observes the rate-limit headers discord sends with every REST response.
+# Bulk operations use this to run as fast as the bucket allows instead of sleeping a fixed amount of time.
+#
+
+SNOWFLAKE = re.compile(r"^\d{15,21}$")
+API_PREFIX = re.compile(r"^/api/v\d+")
+# the first id after these path segments identifies the bucket (discord calls them major parameters)
+MAJOR_PARAMETERS = ("guilds", "channels", "webhooks")
+# assumed budget (requests, seconds) of buckets we didn't see any headers for yet
+DEFAULT_RATE = (5, 5.0)
+# discord allows 50 requests per second across all routes
+GLOBAL_RATE = 50
+# requests per second handed out by acquire(), the rest is left for requests that aren't paced (commands, events)
+GLOBAL_BUDGET = 45
+
+
+def route_key(method: str, path: str) -> str:
+    """!
+    Normalize a request to a key that identifies its rate-limit bucket.
+    Major parameters are kept, all other ids are replaced with placeholders.
+
+    @param method HTTP method like 'PUT'
+    @param path request path with or without the '/api/vX' prefix
+    @return key like 'PUT /guilds/123/members/{id}/roles/{id}'
+    """
+    parts = API_PREFIX.sub("", path).split("/")
+    normalized = []
+    for i, part in enumerate(parts):
+        previous = parts[i - 1] if i > 0 else ""
+        if previous == "reactions":
+            normalized.append("{emoji}")
+        elif SNOWFLAKE.match(part) and not (i == 2 and previous in MAJOR_PARAMETERS):
+            normalized.append("{id}")
+        else:
+            normalized.append(part)
+
+    return f"{method.upper()} {'/'.join(normalized)}"
+
+
+def member_route(guild_id: int) -> str:
+    """Route key of 'member.edit()'"""
+    return route_key("PATCH", f"/guilds/{guild_id}/members/0000000000000000")
+
+
+def member_role_route(guild_id: int, method: str) -> str:
+    """Route key of 'member.add_roles()' (PUT) and 'member.remove_roles()' (DELETE) with a single role"""
+    return route_key(method, f"/guilds/{guild_id}/members/0000000000000000/roles/0000000000000000")
+
+
+def channel_route(channel_id: int) -> str:
+    """Route key of 'channel.edit()'"""
+    return route_key("PATCH", f"/channels/{channel_id}")
+
+
+def message_route(channel_id: int) -> str:
+    """Route key of 'channel.send()'"""
+    return route_key("POST", f"/channels/{channel_id}/messages")
+
+
+def message_edit_route(channel_id: int) -> str:
+    """Route key of 'message.edit()'"""
+    return route_key("PATCH", f"/channels/{channel_id}/messages/0000000000000000")
+
+
+def pins_route(channel_id: int) -> str:
+    """Route key of 'channel.pins()'"""
+    return route_key("GET", f"/channels/{channel_id}/messages/pins")
+
+
+def pin_route(channel_id: int) -> str:
+    """Route key of 'message.pin()'"""
+    return route_key("PUT", f"/channels/{channel_id}/messages/pins/0000000000000000")
+
+
+def original_response_route(application_id: int, token: str) -> str:
+    """Route key of 'interaction.edit_original_response()', every interaction token has its own bucket"""
+    return route_key("PATCH", f"/webhooks/{application_id}/{token}/messages/@original")
+
+
+def reaction_route(channel_id: int, method: str = "DELETE") -> str:
+    """Route key of 'reaction.remove()' (DELETE) and 'message.add_reaction()' (PUT)"""
+    user = "@me" if method == "PUT" else "0000000000000000"
+    return route_key(method, f"/channels/{channel_id}/messages/0000000000000000/reactions/emoji/{user}")
+
+
+def reaction_users_route(channel_id: int) -> str:
+    """Route key of 'reaction.users()', one request per page of up to 100 users"""
+    return route_key("GET", f"/channels/{channel_id}/messages/0000000000000000/reactions/emoji")
+
+
+def emoji_clear_route(channel_id: int) -> str:
+    """Route key of 'reaction.clear()', which removes one emoji of all users"""
+    return route_key("DELETE", f"/channels/{channel_id}/messages/0000000000000000/reactions/emoji")
+
+
+def role_route(guild_id: int, method: str) -> str:
+    """Route key of 'guild.create_role()' (POST), 'role.edit()' (PATCH) and 'role.delete()' (DELETE)"""
+    if method == "POST":
+        return route_key(method, f"/guilds/{guild_id}/roles")
+    return route_key(method, f"/guilds/{guild_id}/roles/0000000000000000")
+
+
+def role_positions_route(guild_id: int) -> str:
+    """Route key of 'role.edit(position=...)' which moves roles in bulk"""
+    return route_key("PATCH", f"/guilds/{guild_id}/roles")
+
+
+class Bucket:
+    """
+    Last known state of a rate-limit bucket plus the requests we sent but did not get an answer for yet
+    """
+
+    __slots__ = ("limit", "remaining", "reset_at", "window", "pending", "changed")
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: int = 1
+        self.reset_at: float = 0.0
+        # length of a full bucket window in seconds, learned from the first request of a window
+        self.window: Optional[float] = None
+        self.pending: int = 0
+        self.changed = asyncio.Event()
+
+    def available(self, now: float) -> int:
+        """Number of requests that can be sent right now without hitting the limit"""
+        # nothing known yet: allow one request to learn the limits from its headers
+        if self.limit is None:
+            return 1 - self.pending
+
+        remaining = self.limit if now >= self.reset_at else self.remaining
+        return remaining - self.pending
+
+    def notify(self):
+        """Wake everyone waiting for this bucket"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class RateLimitObserver:
+    """
+    Reads 'X-RateLimit-*' headers from all responses of the bots HTTP session via an aiohttp trace
+    and hands out permits so concurrent bulk operations never exceed the bucket budget.
+    Pass 'trace_config' as 'http_trace' to the bot.
+    """
+
+    def __init__(self):
+        self.buckets: dict[str, Bucket] = {}
+        # times of the permits handed out in the last global_window seconds, for the global limit
+        self.sent: deque[float] = deque()
+        self.global_window = 1.0
+        # set by a global 429, nothing is sent before that
+        self.global_reset_at = 0.0
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_end.append(self._on_request_end)
+
+    def bucket(self, route: str) -> Bucket:
+        if route not in self.buckets:
+            self.buckets[route] = Bucket()
+        return self.buckets[route]
+
+    async def _on_request_end(self, _session, _ctx, params: aiohttp.TraceRequestEndParams):
+        """Update the bucket of the finished request with the headers of the response"""
+        headers = params.response.headers
+        if "X-RateLimit-Remaining" not in headers:
+            return
+
+        bucket = self.bucket(route_key(params.method, params.url.path))
+        try:
+            bucket.limit = int(headers.get("X-RateLimit-Limit", bucket.limit or 1))
+            bucket.remaining = int(headers["X-RateLimit-Remaining"])
+            reset_after = float(
+                headers.get("Retry-After" if params.response.status == 429 else "X-RateLimit-Reset-After", 0)
+            )
+        except ValueError:
+            logger.warning("Can't parse rate-limit headers for %s %s", params.method, params.url.path)
+            return
+
+        bucket.reset_at = time.monotonic() + reset_after
+        if bucket.remaining == bucket.limit - 1 and reset_after > 0:
+            bucket.window = reset_after
+        if params.response.status == 429:
+            bucket.remaining = 0
+            if headers.get("X-RateLimit-Global") == "true" or headers.get("X-RateLimit-Scope") == "global":
+                self.global_reset_at = time.monotonic() + reset_after
+                logger.warning("Hit the global rate-limit, pausing all paced requests for %ss", reset_after)
+            logger.warning(
+                "Hit rate-limit on '%s', retry after %ss", route_key(params.method, params.url.path), reset_after
+            )
+
+        bucket.notify()
+
+    def rate(self, route: str) -> tuple[int, float]:
+        """!
+        Budget of a route as observed from discord, falls back to DEFAULT_RATE for unknown routes
+
+        @return number of requests per window and window length in seconds
+        """
+        bucket = self.buckets.get(route)
+        if bucket is None or bucket.limit is None or bucket.window is None:
+            return DEFAULT_RATE
+        return bucket.limit, bucket.window
+
+    async def acquire(self, route: str):
+        """!
+        Wait until a request on this route can be sent without exceeding the bucket.
+        Must be paired with a call to release() once the request is done.
+        """
+        bucket = self.bucket(route)
+        while True:
+            now = time.monotonic()
+            global_wait = self.global_wait(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            if bucket.available(now) > 0:
+                bucket.pending += 1
+                self.sent.append(now)
+                return
+
+            changed = bucket.changed
+            # when the budget is used up nothing will change before the reset, so sleep until then
+            timeout = max(bucket.reset_at - now, 0.05) if bucket.limit is not None else None
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def global_wait(self, now: float) -> float:
+        """Seconds until the next request fits into the global limit, 0 if it can be sent right away"""
+        if now < self.global_reset_at:
+            return self.global_reset_at - now
+
+        while self.sent and self.sent[0] <= now - self.global_window:
+            self.sent.popleft()
+        if len(self.sent) >= GLOBAL_BUDGET:
+            return self.sent[0] + self.global_window - now
+        return 0.0
+
+    @asynccontextmanager
+    async def paced(self, route: str):
+        """!
+        Send a single request paced like the bulk jobs:
+        'async with rate_limits.paced(route): await role.edit(...)'
+        """
+        await self.acquire(route)
+        try:
+            yield
+        finally:
+            self.release(route)
+
+    def release(self, route: str):
+        """Mark a request acquired on this route as done"""
+        bucket = self.bucket(route)
+        bucket.pending -= 1
+        bucket.notify()
@@ -0,0 +1,124 @@
+from typing import Callable
+from typing import Iterable
+from typing import NamedTuple
+from typing import Optional
+
+import discord
+
+from ..log_setup import logger
+from .planner import MemberRolePlan
+from .snapshot import RoleSnapshot
+from .snapshot import invert_members
+
+### @package reconcile
+#
+# Comparison of the module roles after the flattening with the membership a role snapshot says they should have.
+#
+
+
+class ModuleDiff(NamedTuple):
+    """Difference between expected and actual members of one module role"""
+
+    module: str
+    role_id: int
+    expected: int
+    actual: int
+    # ids of members that are on the guild and need the role / need to lose it
+    to_add: set[int]
+    to_remove: set[int]
+    # ids of expected members that left the guild
+    left: set[int]
+    # role names of the module that aren't in the snapshot
+    unresolved: list[str]
+
+    @property
+    def ok(self) -> bool:
+        return not self.to_add and not self.to_remove
+
+    def to_dict(self) -> dict:
+        return {
+            "module": self.module,
+            "role_id": self.role_id,
+            "expected": self.expected,
+            "actual": self.actual,
+            "add": sorted(self.to_add),
+            "remove": sorted(self.to_remove),
+            "left": sorted(self.left),
+            "unresolved": self.unresolved,
+        }
+
+
+def reconcile(
+    guild: discord.Guild,
+    roles_dict: dict[str, list[str]],
+    snapshot: RoleSnapshot,
+    get_role: Callable[[discord.Guild, str], Optional[discord.Role]],
+    members: Optional[Iterable] = None,
+) -> tuple[list[ModuleDiff], list[str]]:
+    """!
+    Compute for every module '<key> (old)' which members it should have: the union of the members
+    all roles of the module had in the snapshot. Actual membership is collected in a single pass over the guild.
+
+    @param roles_dict mapping of module key -> role names
+    @param snapshot role backup taken before the flattening
+    @param get_role lookup of a role by name
+    @param members members of the guild (e.g. from the compact cache), 'guild.members' if None
+    @return diff per module and the keys whose module role can't be found
+    """
+    module_roles: dict[str, discord.Role] = {}
+    missing_modules = []
+    for module_name in roles_dict:
+        module_role = get_role(guild, f"{module_name} (old)")
+        if module_role is None:
+            logger.warning(f"Cant find role for '{module_name} (old)'. skipping")
+            missing_modules.append(module_name)
+            continue
+        module_roles[module_name] = module_role
+
+    members = list(guild.members if members is None else members)
+    actual = invert_members(guild, (r.id for r in module_roles.values()), members)
+    on_guild = {m.id for m in members}
+
+    diffs = []
+    for module_name, module_role in module_roles.items():
+        expected: set[int] = set()
+        unresolved = []
+        for role_name in roles_dict[module_name]:
+            role_id = snapshot.role_id(role_name)
+            if role_id is None:
+                unresolved.append(role_name)
+                continue
+            expected |= snapshot.members[role_id]
+
+        has_role = actual[module_role.id]
+        diffs.append(
+            ModuleDiff(
+                module=module_name,
+                role_id=module_role.id,
+                expected=len(expected),
+                actual=len(has_role),
+                to_add=(expected - has_role) & on_guild,
+                to_remove=has_role - expected,
+                left=expected - on_guild,
+                unresolved=unresolved,
+            )
+        )
+
+    return diffs, missing_modules
+
+
+def plan_repairs(
+    guild: discord.Guild, diffs: list[ModuleDiff], plan: MemberRolePlan, members: Optional[Iterable] = None
+):
+    """!
+    Record the changes that make every module role match the snapshot
+
+    @param members members of the guild (e.g. from the compact cache), 'guild.members' if None
+    """
+    by_id = {m.id: m for m in (guild.members if members is None else members)}
+    for diff in diffs:
+        role = discord.Object(id=diff.role_id)
+        for member_id in diff.to_add:
+            plan.add_role(by_id[member_id], role)
+        for member_id in diff.to_remove:
+            plan.remove_role(by_id[member_id], role)
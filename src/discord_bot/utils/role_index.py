@@ -0,0 +1,82 @@
+from typing import Optional
+
+import discord
+
+from ..log_setup import logger
+
+### @package role_index
+#
+# Lookup of roles by name without scanning all roles of a guild.
+#
+
+
+class RoleIndex:
+    """
+    Per guild index of role name -> role ids.
+    Built on the first lookup for a guild and kept current by feeding it the role create/update/delete events.
+    Ids are resolved through the guild cache, so lookups always return the current role object,
+    a role that doesn't carry the name anymore makes the guild be indexed again.
+    Events missed while the bot was disconnected aren't replayed after a new session, the cog drops the index
+    of guilds that become available again.
+    """
+
+    def __init__(self):
+        self._guilds: dict[int, dict[str, list[int]]] = {}
+
+    def _index(self, guild: discord.Guild) -> dict[str, list[int]]:
+        if guild.id not in self._guilds:
+            index: dict[str, list[int]] = {}
+            for role in guild.roles:
+                index.setdefault(role.name, []).append(role.id)
+            self._guilds[guild.id] = index
+            logger.info(f"Indexed {len(guild.roles)} roles of '{guild.name}'")
+
+        return self._guilds[guild.id]
+
+    def get(self, guild: discord.Guild, name: str) -> Optional[discord.Role]:
+        """!
+        Find a role by its name
+
+        @return the role if exactly one role has that name, None if there is none or the name is ambiguous
+        """
+        role_ids = self._index(guild).get(name, [])
+        role = guild.get_role(role_ids[0]) if len(role_ids) == 1 else None
+        if len(role_ids) == 1 and (role is None or role.name != name):
+            # a rename or delete was missed, e.g. while the bot was disconnected
+            logger.warning(f"Role index of '{guild.name}' is outdated ('{name}'), rebuilding it")
+            self.forget(guild)
+            role_ids = self._index(guild).get(name, [])
+            role = guild.get_role(role_ids[0]) if len(role_ids) == 1 else None
+
+        if len(role_ids) > 1:
+            logger.warning(f"Multiple roles with name '{name}' found, returning None")
+
+        return role
+
+    def duplicates(self, guild: discord.Guild) -> dict[str, list[int]]:
+        """Names that are used by more than one role with the ids of those roles"""
+        return {name: ids for name, ids in self._index(guild).items() if len(ids) > 1}
+
+    def add(self, role: discord.Role):
+        index = self._guilds.get(role.guild.id)
+        # guilds that weren't looked up yet are indexed on their first lookup
+        if index is not None:
+            index.setdefault(role.name, []).append(role.id)
+
+    def remove(self, role: discord.Role):
+        index = self._guilds.get(role.guild.id)
+        if index is None or role.id not in index.get(role.name, []):
+            return
+
+        index[role.name].remove(role.id)
+        if not index[role.name]:
+            del index[role.name]
+
+    def rename(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name:
+            self.remove(before)
+            self.add(after)
+
+    def forget(self, guild: discord.Guild):
+        """Drop the index of a guild, it's rebuilt on the next lookup"""
+        self._guilds.pop(guild.id, None)
@@ -0,0 +1,162 @@
+import json
+from pathlib import Path
+from typing import Iterable
+from typing import Optional
+
+import discord
+
+from ..log_setup import logger
+from .backup_store import BACKUP_DIR
+from .backup_store import BackupStore
+
+### @package snapshot
+#
+# Role snapshots as written by '/role_backup' ('data/role_info_<time>.json'):
+# {"<role-id>": {"role_name": str, "count": int, "members": [member-ids], "role_pos": int}, ...}
+#
+
+
+class RoleSnapshot:
+    """
+    A role backup indexed by role id and role name, member lists are kept as sets
+    """
+
+    def __init__(self, data: dict[str, dict], name: str = ""):
+        self.name = name
+        self.names: dict[int, str] = {}
+        self.positions: dict[int, int] = {}
+        self.members: dict[int, set[int]] = {}
+        self.by_name: dict[str, list[int]] = {}
+
+        for role_id, info in data.items():
+            role_id = int(role_id)
+            self.names[role_id] = info["role_name"]
+            self.positions[role_id] = info["role_pos"]
+            self.members[role_id] = set(info["members"])
+            self.by_name.setdefault(info["role_name"], []).append(role_id)
+
+    @classmethod
+    def load(cls, file: Path) -> "RoleSnapshot":
+        logger.info(f"Loading role snapshot {file}")
+        return cls(json.loads(file.read_text()), name=file.name)
+
+    def role_id(self, name: str) -> Optional[int]:
+        """Id of the role with that name at the time of the snapshot, the first one if the name was used twice"""
+        role_ids = self.by_name.get(name, [])
+        if len(role_ids) > 1:
+            logger.warning(f"Snapshot {self.name} has {len(role_ids)} roles named '{name}', using {role_ids[0]}")
+        return role_ids[0] if role_ids else None
+
+    def __contains__(self, role_id: int) -> bool:
+        return role_id in self.members
+
+
+def snapshot_time(file: Path) -> Optional[float]:
+    """Time in the name of a 'role_info_<time>.json', None for files named otherwise (e.g. 'role_info_before_merge.json')"""
+    try:
+        return float(file.stem.removeprefix("role_info_"))
+    except ValueError:
+        return None
+
+
+def latest_snapshot_file() -> Optional[Path]:
+    """The newest 'data/role_info_<time>.json', files without a time in their name are ignored"""
+    files = [f for f in Path("data").glob("role_info_*.json") if snapshot_time(f) is not None]
+    if not files:
+        return None
+    return max(files, key=snapshot_time)
+
+
+def load_snapshot(ref: Optional[str] = None) -> Optional[RoleSnapshot]:
+    """!
+    Load a full backup file or restore an incremental backup.
+    This does file IO, run it in a thread (asyncio.to_thread) from the bot.
+
+    @param ref path of a 'role_info_<time>.json',
+        a unix time to restore the incremental backup that was current at that time
+        or None for the newest backup of both kinds
+    @return the snapshot, None if there is no such backup
+    """
+    if ref is not None and Path(ref).exists():
+        return RoleSnapshot.load(Path(ref))
+
+    if ref is not None:
+        try:
+            at = float(ref)
+        except ValueError:
+            logger.warning(f"'{ref}' is neither a backup file nor a point in time")
+            return None
+        restored = BackupStore().load(at)
+        return RoleSnapshot(restored[1], name=f"incremental backup {restored[0]}") if restored else None
+
+    store = BackupStore() if BACKUP_DIR.exists() else None
+    store_time = store.index[-1]["time"] if store and store.index else 0.0
+    file = latest_snapshot_file()
+    if file is not None and snapshot_time(file) >= store_time:
+        return RoleSnapshot.load(file)
+
+    if store_time:
+        restored_time, restored = store.load()
+        return RoleSnapshot(restored, name=f"incremental backup {restored_time}")
+
+    return None
+
+
+def invert_members(
+    guild: discord.Guild, role_ids: Optional[Iterable[int]] = None, members: Optional[Iterable] = None
+) -> dict[int, set[int]]:
+    """!
+    Member ids per role, computed in one pass over the member cache.
+    'role.members' walks all members of the guild each time it's accessed, this does it once for all roles.
+
+    @param role_ids only collect these roles, all roles if None
+    @param members members to walk (e.g. from the compact cache), 'guild.members' if None
+    @return role id -> ids of the members that have the role
+    """
+    wanted = set(role_ids) if role_ids is not None else None
+    result: dict[int, set[int]] = {r: set() for r in wanted} if wanted is not None else {}
+
+    for member in guild.members if members is None else members:
+        # member._roles holds the plain ids, member.roles would build role objects for every member
+        for role_id in member._roles:
+            if wanted is None or role_id in wanted:
+                result.setdefault(role_id, set()).add(member.id)
+
+    return result
+
+
+def collect_snapshot(
+    guild: discord.Guild, roles: Iterable[discord.Role], members: Optional[Iterable] = None
+) -> dict[int, dict]:
+    """!
+    Build the backup of the given roles from a single pass over the guilds members
+
+    @param members members to walk (e.g. from the compact cache), 'guild.members' if None
+    @return role id -> info in the format of 'data/role_info_<time>.json'
+    """
+    members = list(guild.members if members is None else members)
+    members_by_role = invert_members(guild, members=members)
+    snapshot = {}
+    for role in roles:
+        # @everyone isn't stored on the members, everyone has it
+        role_members = [m.id for m in members] if role.is_default() else list(members_by_role.get(role.id, ()))
+        snapshot[role.id] = {
+            "role_name": role.name,
+            "count": len(role_members),
+            "members": role_members,
+            "role_pos": role.position,
+        }
+
+    return snapshot
+
+
+def write_snapshot(file: Path, snapshot: dict[int, dict]):
+    """!
+    Write a snapshot role by role instead of building the whole json text in memory.
+    This blocks, run it in a thread (asyncio.to_thread) to keep the bot responsive.
+    """
+    with open(file, "w") as f:
+        f.write("{")
+        for i, (role_id, info) in enumerate(snapshot.items()):
+            f.write(f"{',' if i else ''}\n{json.dumps(str(role_id))}: {json.dumps(info)}")
+        f.write("\n}\n")
@@ -0,0 +1,84 @@
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+from typing import Optional
+
+from ..log_setup import logger
+
+### @package tutor_store
+#
+# Persistent pool of tutors per module channel, used for the closure message of '/finish_channels'.
+#
+
+
+class TutorStore:
+    """
+    SQLite backed set of (channel id, member id) pairs.
+    The pair is the primary key, so adding and removing a single tutor is an index lookup
+    and a tutor can't be in a channel twice. Tutors are returned in the order they were added.
+    """
+
+    def __init__(self, path: Path = Path("data/tutors.sqlite")):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tutors ("
+            "channel_id INTEGER NOT NULL, member_id INTEGER NOT NULL, PRIMARY KEY (channel_id, member_id))"
+        )
+        # rm_tutor looks up a member across all channels
+        self.db.execute("CREATE INDEX IF NOT EXISTS tutors_member ON tutors (member_id)")
+        self.db.commit()
+
+    def add(self, channel_id: int, member_id: int) -> bool:
+        """@return False if the tutor was already in the pool for that channel"""
+        with self.db:
+            cursor = self.db.execute("INSERT OR IGNORE INTO tutors VALUES (?, ?)", (channel_id, member_id))
+        return cursor.rowcount == 1
+
+    def add_many(self, pairs: Iterable[tuple[int, int]]) -> int:
+        """!
+        Bulk import in a single transaction
+
+        @param pairs (channel id, member id)
+        @return number of pairs that weren't in the pool yet
+        """
+        with self.db:
+            added = self.db.executemany("INSERT OR IGNORE INTO tutors VALUES (?, ?)", pairs).rowcount
+
+        logger.info(f"Added {added} tutors to the pool")
+        return added
+
+    def remove(self, member_id: int, channel_id: Optional[int] = None) -> int:
+        """!
+        Remove a tutor from one channel or from all channels
+
+        @return number of channels the tutor was removed from
+        """
+        with self.db:
+            if channel_id is None:
+                cursor = self.db.execute("DELETE FROM tutors WHERE member_id = ?", (member_id,))
+            else:
+                cursor = self.db.execute(
+                    "DELETE FROM tutors WHERE channel_id = ? AND member_id = ?", (channel_id, member_id)
+                )
+        return cursor.rowcount
+
+    def tutors(self, channel_id: int) -> list[int]:
+        """Member ids of the tutors of a channel in the order they were added"""
+        rows = self.db.execute("SELECT member_id FROM tutors WHERE channel_id = ? ORDER BY rowid", (channel_id,))
+        return [member_id for (member_id,) in rows]
+
+    def clear(self, channel_ids: Optional[Iterable[int]] = None) -> int:
+        """!
+        Empty the pool for some channels or entirely
+
+        @return number of removed pairs
+        """
+        with self.db:
+            if channel_ids is None:
+                cursor = self.db.execute("DELETE FROM tutors")
+            else:
+                cursor = self.db.executemany("DELETE FROM tutors WHERE channel_id = ?", ((c,) for c in channel_ids))
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM tutors").fetchone()[0]
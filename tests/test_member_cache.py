@@ -0,0 +1,88 @@
+import unittest
+from types import SimpleNamespace
+
+from discord_bot.utils.members import CompactMemberCache
+from discord_bot.utils.members import ensure_members
+
+GUILD_ID = 400000000000000000
+
+
+class FakeGuild:
+    """The parts of a guild CompactMemberCache.load uses, 'server' is the member list as discord knows it"""
+
+    def __init__(self, server: dict[int, list[int]]):
+        self.id = GUILD_ID
+        self.name = "guild"
+        self.server = server
+        self.fetches = 0
+
+    async def fetch_members(self, limit=None):
+        self.fetches += 1
+        for member_id, roles in list(self.server.items()):
+            yield SimpleNamespace(id=member_id, _roles=list(roles))
+
+
+def member_payload(member_id: int, roles: list[int]) -> dict:
+    return {"guild_id": str(GUILD_ID), "user": {"id": str(member_id)}, "roles": [str(r) for r in roles]}
+
+
+class CompactMemberCacheReconnectTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.parsed = []
+        events = ("GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE", "READY", "GUILD_CREATE")
+        # stands in for discord.py's parsers, which run after the hooks of the cache
+        self.state = SimpleNamespace(parsers={event: self.parsed.append for event in events})
+        self.cache = CompactMemberCache()
+        self.cache.install(self.state)
+        self.guild = FakeGuild({1: [10], 2: [20]})
+        await ensure_members(self.guild, self.cache)
+
+    def roles(self, member_id: int) -> list[int]:
+        return list(self.cache.get_member(self.guild, member_id)._roles)
+
+    async def test_updates_while_connected_are_applied(self):
+        self.guild.server[1] = [10, 11]
+        self.state.parsers["GUILD_MEMBER_UPDATE"](member_payload(1, [10, 11]))
+
+        self.assertEqual(self.roles(1), [10, 11])
+        await ensure_members(self.guild, self.cache)
+        self.assertEqual(self.guild.fetches, 1)
+
+    async def test_update_missed_during_reconnect_is_reloaded(self):
+        # changed while the bot was disconnected, the event never arrives
+        self.guild.server[2] = [20, 21]
+        self.assertEqual(self.roles(2), [20])
+
+        # new session: READY, then every guild is sent again
+        self.state.parsers["READY"]({"guilds": [{"id": str(GUILD_ID), "unavailable": True}]})
+        self.state.parsers["GUILD_CREATE"]({"id": str(GUILD_ID)})
+        self.assertFalse(self.cache.loaded(self.guild))
+
+        await ensure_members(self.guild, self.cache)
+        self.assertEqual(self.guild.fetches, 2)
+        self.assertEqual(self.roles(2), [20, 21])
+        # discord.py still gets the events
+        self.assertEqual(len(self.parsed), 2)
+
+    async def test_guild_sent_again_is_reloaded(self):
+        self.guild.server[1] = []
+        self.state.parsers["GUILD_CREATE"]({"id": str(GUILD_ID)})
+
+        await ensure_members(self.guild, self.cache)
+        self.assertEqual(self.roles(1), [])
+
+    async def test_reconnect_while_loading_is_not_marked_loaded(self):
+        guild = FakeGuild({3: [30]})
+        state = self.state
+
+        async def fetch_members(limit=None):
+            yield SimpleNamespace(id=3, _roles=[30])
+            state.parsers["READY"]({})
+
+        guild.fetch_members = fetch_members
+        await self.cache.load(guild)
+        self.assertFalse(self.cache.loaded(guild))
+
+
+if __name__ == "__main__":
+    unittest.main()